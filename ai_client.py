@@ -0,0 +1,37 @@
+"""Shared Anthropic client and response helpers for the Claude calls in api.py and vision.py."""
+import os
+import re
+import threading
+
+import anthropic
+
+# One client per process: its HTTP connection pool keeps the TLS session to
+# api.anthropic.com alive across requests instead of reconnecting per call.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_ai_client():
+    """Return the shared Anthropic client, creating it on first use.
+
+    One client per process means every Claude call, including the threaded
+    validation fan-out and /identify, reuses the SDK's keep-alive connection
+    pool. API endpoints check ANTHROPIC_API_KEY first and return a 500 if it
+    is unset; without it the SDK raises here.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    return _client
+
+
+# Claude sometimes wraps JSON answers in a ```json ... ``` markdown fence
+_FENCE_RE = re.compile(r"^```[\w-]*[ \t]*\n(.*?)\n?```\s*$", re.DOTALL)
+
+
+def strip_code_fence(text):
+    """Return the body of a fenced markdown code block, or text unchanged."""
+    m = _FENCE_RE.match(text)
+    return m.group(1) if m else text
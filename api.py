@@ -1,18 +1,41 @@
+import decimal
+import functools
+import hashlib
+import hmac
 import json
 import logging
+import mmap
 import os
-import tempfile
+import re
+import threading
 import time as _time
-
-import anthropic
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from itertools import groupby, islice
+from operator import itemgetter
+from tempfile import SpooledTemporaryFile
+
+import orjson
 import psycopg2
 import requests as http_requests
+from psycopg2.errors import UndefinedTable
 from psycopg2.extras import RealDictCursor
-from flask import Flask, jsonify, redirect, request, send_from_directory
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from flask import (Flask, Request, Response, g, has_request_context, jsonify, redirect, request,
+                   send_from_directory, stream_with_context)
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flasgger import Swagger
+from werkzeug.http import http_date
+from werkzeug.routing import BaseConverter
+from dotenv import load_dotenv
+
+# Resolve .env before importing database, which reads DATABASE_URL at import
+# time; this runs once per gunicorn worker as well as under `python api.py`
+load_dotenv()
 
 from mapping import (
     map_product, map_product_legacy, map_clothing_type, map_material,
@@ -23,35 +46,138 @@ from mapping import (
     BRAND_MATERIAL_OVERRIDES,
 )
 from mapping_v2 import map_product_v2
-from database import (create_table, upsert_product, update_qfix_mapping,
-                      upsert_action_ranking, get_action_ranking,
+from ai_client import get_ai_client, strip_code_fence
+from database import (create_table, bulk_upsert_products, bulk_update_qfix_mappings,
+                      bulk_update_article_qfix_mappings,
+                      defer_commit_flush, delete_unlisted_protocol_products,
+                      refresh_remap_coverage,
+                      upsert_action_ranking, get_action_ranking, get_action_rankings,
                       DATABASE_URL, DATABASE_WRITE_URL)
 from protocol_parser import parse_protocol_xlsx
 from vision import classify_and_map
 from brands import BRAND_ROUTES, BRAND_SLUG
-from catalog import catalog
+from catalog import catalog, index_actions_by_name, service_key_for_slug
+
+# ── JSON serialization ───────────────────────────────────────────────────
+# Same output rules as Flask's default provider (sorted keys, HTTP dates,
+# Decimal as string), but encoded by orjson
+_ORJSON_OPTS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+                | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def _orjson_default(obj):
+    """Serialize the types orjson hands back to us, as Flask would."""
+    if isinstance(obj, date):  # includes datetime
+        return http_date(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class _OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; used by every jsonify() call."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = _ORJSON_OPTS | orjson.OPT_APPEND_NEWLINE
+        if self._app.debug:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(
+            orjson.dumps(obj, default=_orjson_default, option=option),
+            mimetype=self.mimetype,
+        )
+
+
+class _Request(Request):
+    """Request that keeps protocol uploads in memory up to MAX_CONTENT_LENGTH.
+
+    Werkzeug spools every file over 500KB to a temp file on disk; an xlsx
+    read by openpyxl would then go through the disk and back. Other uploads
+    (identify images) keep the default spooling.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.path == "/v2/upload":
+            return SpooledTemporaryFile(max_size=app.config["MAX_CONTENT_LENGTH"], mode="rb+")
+        return super()._get_file_stream(total_content_length, content_type, filename,
+                                        content_length)
+
 
 app = Flask(__name__)
+app.request_class = _Request
+app.json = _OrjsonProvider(app)
 CORS(app)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
 
 
+class BrandConverter(BaseConverter):
+    """URL converter matching only known brand slugs.
+
+    Routes declared with <brand:brand_slug> never run for unknown brands;
+    routing answers them with the JSON 404 below.
+    """
+
+    regex = "|".join(re.escape(slug) for slug in BRAND_ROUTES)
+
+
+app.url_map.converters["brand"] = BrandConverter
+
+
+@app.errorhandler(404)
+def _not_found(error):
+    return jsonify({"error": "Not found"}), 404
+
+
 # ── Rate limiting ─────────────────────────────────────────────────────────
 def _rate_limit_key():
-    """Use API key if provided, otherwise fall back to IP address."""
-    api_key = request.headers.get("X-API-Key", "")
-    if api_key:
-        return "key:" + api_key
-    return "ip:" + get_remote_address()
+    """Use API key if provided, otherwise fall back to IP address.
+
+    Flask-Limiter asks once per applicable limit, so the key is kept on g.
+    """
+    key = g.get("rate_limit_key")
+    if key is None:
+        api_key = request.headers.get("X-API-Key")
+        key = g.rate_limit_key = f"key:{api_key}" if api_key else f"ip:{get_remote_address()}"
+    return key
 
 
+# Point RATELIMIT_STORAGE_URI at Redis (redis://host:6379/0) when running
+# several workers, so limits are shared instead of counted per process
 limiter = Limiter(
     app=app,
     key_func=_rate_limit_key,
     default_limits=["100 per minute", "1000 per hour"],
-    storage_uri="memory://",
+    storage_uri=os.environ.get("RATELIMIT_STORAGE_URI", "memory://"),
+    strategy="fixed-window",
 )
 
+
+# Brand read routes, which check the brand's X-API-Key themselves
+_BRAND_KEY_ENDPOINTS = {"get_brand_product", "list_brand_products"}
+
+
+@limiter.request_filter
+def _has_valid_api_key():
+    """Brand integrations are not rate limited on their own read routes.
+
+    The key must belong to the brand in the URL; admin and other routes
+    stay limited whatever key is sent.
+    """
+    if request.endpoint not in _BRAND_KEY_ENDPOINTS:
+        return False
+    provided = request.headers.get("X-API-Key", "")
+    return bool(provided) and _key_to_brand.get(provided) == request.view_args.get("brand_slug")
+
+
 # ── API key authentication ────────────────────────────────────────────────
 # Format: "brand1:key1,brand2:key2"  — if unset, auth is disabled.
 _api_keys = {}
@@ -62,6 +188,7 @@ if _raw_keys:
         if ":" in pair:
             slug, key = pair.split(":", 1)
             _api_keys[slug.strip()] = key.strip()
+_key_to_brand = {key: slug for slug, key in _api_keys.items()}
 
 
 def _check_api_key(brand_slug):
@@ -73,7 +200,7 @@ def _check_api_key(brand_slug):
     if not expected:
         return None  # no key configured for this brand
     provided = request.headers.get("X-API-Key", "")
-    if provided != expected:
+    if not hmac.compare_digest(provided.encode(), expected.encode()):
         return jsonify({"error": "Invalid or missing API key"}), 401
     return None
 
@@ -88,7 +215,7 @@ def _require_admin():
     if not _admin_token:
         return None  # dev mode — no auth required
     provided = request.headers.get("Authorization", "")
-    if provided == f"Bearer {_admin_token}":
+    if hmac.compare_digest(provided.encode(), f"Bearer {_admin_token}".encode()):
         return None
     return jsonify({"error": "Unauthorized"}), 401
 
@@ -151,39 +278,243 @@ swagger_template = {
 
 swagger = Swagger(app, config=swagger_config, template=swagger_template)
 
+# Load the QFix catalog off the request path and keep it fresh
+catalog.start_refresher()
+
+# flasgger re-parses every route docstring on each /apispec.json hit. The
+# docstrings cannot change while the process runs, so build the spec once.
+_apispec_body = None
+_apispec_lock = threading.Lock()
+
+
+def _serve_apispec():
+    global _apispec_body
+    if _apispec_body is None:
+        with _apispec_lock:
+            if _apispec_body is None:
+                _apispec_body = app.json.dumps(swagger.get_apispecs("apispec"))
+    response = Response(_apispec_body, mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
+
+
+app.view_functions["flasgger.apispec"] = _serve_apispec
+
 logger = logging.getLogger(__name__)
 
 
 # ── Request logging ───────────────────────────────────────────────────────
+# Cache-Control for successful GETs of the read-only product endpoints.
+# s-maxage lets shared caches hold the unauthenticated routes; the brand
+# routes sit behind an API key, so they are private to the caller's cache.
+_PRODUCT_CACHE = "public, max-age=600, s-maxage=600"
+_PRODUCTS_CACHE = "public, max-age=300, s-maxage=300"
+_CACHE_CONTROL_BY_ENDPOINT = {
+    "get_brand_product": "private, max-age=600",
+    "list_brand_products": "private, max-age=300",
+    "get_product": _PRODUCT_CACHE,
+    "shop_kappahl_product": _PRODUCT_CACHE,
+    "v2_get_by_article": _PRODUCT_CACHE,
+    "v2_get_by_gtin": _PRODUCT_CACHE,
+    "v3_get_product": _PRODUCT_CACHE,
+    "v3_search": _PRODUCT_CACHE,
+    "v4_get_product": _PRODUCT_CACHE,
+    "v4_search": _PRODUCT_CACHE,
+    "widget_product": _PRODUCT_CACHE,
+    "list_products": _PRODUCTS_CACHE,
+    "docs_brand_products": _PRODUCTS_CACHE,
+    "remap_products": _PRODUCTS_CACHE,
+    "v2_list_products": _PRODUCTS_CACHE,
+    "v3_list_products": _PRODUCTS_CACHE,
+    "v4_list_products": _PRODUCTS_CACHE,
+}
+
+
 @app.before_request
 def _log_request_start():
-    request._start_time = _time.time()
+    request._start_ns = _time.perf_counter_ns()
 
 
 @app.after_request
 def _log_request(response):
-    duration_ms = (_time.time() - getattr(request, "_start_time", _time.time())) * 1000
+    if request.method == "GET" and response.status_code == 200:
+        cache_control = _CACHE_CONTROL_BY_ENDPOINT.get(request.endpoint)
+        if cache_control:
+            response.headers.setdefault("Cache-Control", cache_control)
+            # Revalidation: an unchanged body costs the client a 304 with
+            # no payload. Streamed lists have no body to hash up front.
+            if not response.is_streamed:
+                response.add_etag()
+                response.make_conditional(request)
+    start_ns = getattr(request, "_start_ns", None)
+    duration_ms = (_time.perf_counter_ns() - start_ns) / 1e6 if start_ns else 0.0
     logger.info("%s %s %s %.1fms", request.method, request.path,
                 response.status_code, duration_ms)
-    # Add Cache-Control for read-only GET product endpoints
-    if (request.method == "GET" and response.status_code == 200
-            and request.path not in ("/health", "/apidocs/", "/apispec.json")):
-        if "/product/" in request.path:
-            response.headers.setdefault("Cache-Control", "public, max-age=600")
-        elif "/products" in request.path:
-            response.headers.setdefault("Cache-Control", "public, max-age=300")
     return response
 
 
+# ── In-process caches ────────────────────────────────────────────────────
+class _LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry.
+
+    With ttl (seconds), entries also expire that long after they were set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= _time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = _time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 # --- DB connections with retry and timeout ---
 
+# Per DSN: connections kept open between requests, and the cap on
+# connections checked out at once
+DB_POOL_IDLE = 4
+DB_POOL_MAX = 20
+# How long a request waits for a free connection once DB_POOL_MAX are out
+DB_POOL_WAIT_SECONDS = 10
+
+
+def _checkout_owner():
+    """The current request's g, or None outside a request."""
+    return g._get_current_object() if has_request_context() else None
+
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection whose close() hands it back to its pool.
+
+    Handlers keep calling conn.close() as before; the pool decides whether
+    to keep the connection for the next request or really close it. A
+    checkout belongs to the request that made it: a repeated close() from
+    an earlier owner neither returns a connection another request is using
+    nor closes one that is idle in the pool.
+    """
+
+    # Set while checked out
+    pool = None
+    owner = None
+    # The pool this connection belongs to, checked out or not
+    home = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names of statements PREPAREd on this server session
+        self.prepared = set()
+
+    def close(self):
+        pool = self.pool
+        if pool is None:
+            home = self.home
+            if home is not None and not home.closed and self in home._pool:
+                return  # already back in the pool
+            super().close()
+            return
+        if self.owner is not _checkout_owner():
+            return  # checked out again since this owner closed it
+        self.pool = self.owner = None
+        if pool.closed:
+            super().close()
+        else:
+            pool.putconn(self)
+
+
+class _BoundedPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool that waits for a free connection when exhausted.
+
+    The stock pool raises PoolError as soon as maxconn connections are
+    checked out; with more concurrent requests than that (gevent workers)
+    callers queue here for up to DB_POOL_WAIT_SECONDS instead.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=DB_POOL_WAIT_SECONDS):
+            raise PoolError("connection pool exhausted")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._slots.release()
+
+    def closeall(self):
+        # Detach every connection first: close() ignores idle connections
+        # and other requests' checkouts
+        for conn in self._pool + list(self._used.values()):
+            conn.pool = conn.home = None
+        super().closeall()
+
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+
+def _pool_for(dsn):
+    """Return the connection pool for dsn, creating it on first use."""
+    pool = _db_pools.get(dsn)
+    if pool is None:
+        with _db_pools_lock:
+            pool = _db_pools.get(dsn)
+            if pool is None:
+                pool = _BoundedPool(
+                    DB_POOL_IDLE, DB_POOL_MAX, dsn, connect_timeout=10,
+                    connection_factory=_PooledConnection,
+                )
+                _db_pools[dsn] = pool
+    return pool
+
+
 def _connect_with_retry(dsn, retries=3, delay=1.0):
-    """Connect to DB with retry logic and connection timeout."""
+    """Check out a pooled DB connection with retry logic and connection timeout."""
     last_err = None
     for attempt in range(retries):
         try:
-            conn = psycopg2.connect(dsn, connect_timeout=10)
+            pool = _pool_for(dsn)
+            conn = pool.getconn()
+            if conn.closed:
+                # The server dropped it while idle; replace it
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+            conn.pool = conn.home = pool
+            conn.owner = _checkout_owner()
             conn.autocommit = True
+            if conn.owner is not None:
+                g.setdefault("db_conns", []).append(conn)
             return conn
         except Exception as e:
             last_err = e
@@ -193,10 +524,80 @@ def _connect_with_retry(dsn, retries=3, delay=1.0):
     raise last_err
 
 
+@app.teardown_request
+def _release_db_conns(exc):
+    """Return connections a handler checked out but never closed.
+
+    Handlers close their connections on the happy path; this covers the
+    ones that raised first, so the pool doesn't leak. A connection the
+    handler did close may already belong to another request; it is skipped.
+    """
+    owner = g._get_current_object()
+    for conn in g.pop("db_conns", ()):
+        if conn.pool is not None and conn.owner is owner:
+            conn.close()
+
+
 def get_db():
     return _connect_with_retry(DATABASE_URL)
 
 
+def _rows_to_dicts(cur):
+    """Fetch all rows from a plain tuple cursor as dicts keyed by column name."""
+    columns = [d[0] for d in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def _stream_json_rows(conn, sql, params=()):
+    """Stream a query's rows as a JSON array response, one row at a time.
+
+    Rows are read through a server-side cursor, itersize at a time, so
+    neither the result set nor the encoded body is held in memory. conn
+    stays checked out until the stream ends and is closed afterwards.
+    """
+    def generate():
+        try:
+            # Named cursors only live inside a transaction
+            conn.autocommit = False
+            with conn.cursor(name="stream_rows") as cur:
+                cur.itersize = 50
+                cur.execute(sql, params)
+                columns = None
+                sep = b"["
+                for row in cur:
+                    if columns is None:
+                        columns = [d[0] for d in cur.description]
+                    yield sep + orjson.dumps(dict(zip(columns, row)),
+                                             default=_orjson_default, option=_ORJSON_OPTS)
+                    sep = b","
+                yield b"[]\n" if columns is None else b"]\n"
+        finally:
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+_PARAM_RE = re.compile(r"%s")
+
+
+def _execute_prepared(cur, name, sql, params):
+    """Run sql as a server-side prepared statement on pooled connections.
+
+    The statement is PREPAREd the first time a pooled connection sees it, so
+    later lookups on that connection skip the parse/plan step and send only
+    the parameters. Other connections just execute sql.
+    """
+    prepared = getattr(getattr(cur, "connection", None), "prepared", None)
+    if prepared is None:
+        cur.execute(sql, params)
+        return
+    if name not in prepared:
+        counter = iter(range(1, len(params) + 1))
+        cur.execute(f"PREPARE {name} AS " + _PARAM_RE.sub(lambda _: f"${next(counter)}", sql))
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} (" + ", ".join(["%s"] * len(params)) + ")", params)
+
+
 def get_write_db():
     url = DATABASE_WRITE_URL or DATABASE_URL
     return _connect_with_retry(url)
@@ -209,9 +610,22 @@ def _get_mapper():
     return map_product
 
 
+# Persisted mapping columns, as returned by map_product_v2()/map_product()
+_QFIX_MAPPING_FIELDS = ("qfix_clothing_type", "qfix_clothing_type_id", "qfix_material",
+                        "qfix_material_id", "qfix_url")
+
+
+# Single-product lookups, keyed by brand slug (or "v2"/"v3"/"v4"), product
+# id or GTIN/article number and ?mapping= variant, plus the finished booking
+# redirect URLs. Cleared
+# whenever this process writes products or changes the mapping tables; the
+# TTL bounds staleness from other writers (scrapers, other workers).
+_product_responses = _LRUCache(maxsize=10000, ttl=300)
+
+
 # ── Parameterized brand endpoints ─────────────────────────────────────────
 
-@app.route("/<brand_slug>/product/<product_id>")
+@app.route("/<brand:brand_slug>/product/<product_id>")
 def get_brand_product(brand_slug, product_id):
     """Look up a product by brand and ID with QFix mapping.
     ---
@@ -249,23 +663,42 @@ def get_brand_product(brand_slug, product_id):
     if auth_error:
         return auth_error
 
-    brand_name = BRAND_ROUTES.get(brand_slug)
-    if not brand_name:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
+    found = _fetch_product_with_qfix(brand_slug, product_id)
+    if not found:
+        return jsonify({"error": f"Product {product_id} not found"}), 404
+
+    product, qfix = found
+    return jsonify({
+        brand_slug: product,
+        "qfix": qfix,
+    })
+
+
+def _fetch_product_with_qfix(brand_slug, product_id):
+    """Return (product, qfix) for a known brand's product, or None if missing.
+
+    Shared by the product lookup and the booking redirects and memoised in
+    _product_responses, so a redirect right after a lookup skips the DB.
+    """
+    cache_key = (brand_slug, product_id, request.args.get("mapping"))
+    found = _product_responses.get(cache_key)
+    if found is not None:
+        return found
 
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
+        _execute_prepared(
+            cur, "product_by_brand_id",
             "SELECT product_id, product_name, category, clothing_type, material_composition, materials, product_url, description, color, brand, image_url, gtin, article_number, care_text, size, country_of_origin, qfix_clothing_type, qfix_clothing_type_id, qfix_material, qfix_material_id, qfix_url FROM products_unified WHERE brand = %s AND product_id = %s",
-            (brand_name, product_id),
+            (BRAND_ROUTES[brand_slug], product_id),
         )
         row = cur.fetchone()
     conn.close()
 
     if not row:
-        return jsonify({"error": f"Product {product_id} not found"}), 404
+        return None
 
-    product = dict(row)
+    product = row
 
     # Use persisted mapping as base if available, otherwise compute live
     if product.get("qfix_url"):
@@ -279,48 +712,29 @@ def get_brand_product(brand_slug, product_id):
     else:
         qfix = catalog.enrich_qfix(_get_mapper()(product, brand=brand_slug))
 
-    return jsonify({
-        brand_slug: product,
-        "qfix": qfix,
-    })
+    found = (product, qfix)
+    _product_responses.set(cache_key, found)
+    return found
 
 
 def _redirect_to_qfix(brand_slug, service_key=None):
     """Shared helper: look up product, map to QFix, redirect with optional services_id."""
-    brand_name = BRAND_ROUTES.get(brand_slug)
-    if not brand_name:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
-
     product_id = request.args.get("productId")
     if not product_id:
         return jsonify({"error": "Missing productId query parameter"}), 400
 
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT product_id, product_name, description, category, clothing_type, material_composition, materials, brand, article_number, qfix_clothing_type, qfix_clothing_type_id, qfix_material, qfix_material_id, qfix_url FROM products_unified WHERE brand = %s AND product_id = %s",
-            (brand_name, product_id),
-        )
-        row = cur.fetchone()
-    conn.close()
+    # The finished booking URL, so repeat clicks skip the service walk and
+    # action ranking lookup
+    cache_key = ("redirect", brand_slug, product_id, service_key, request.args.get("mapping"))
+    cached_url = _product_responses.get(cache_key)
+    if cached_url is not None:
+        return redirect(cached_url, code=302)
 
-    if not row:
+    found = _fetch_product_with_qfix(brand_slug, product_id)
+    if not found:
         return jsonify({"error": f"Product {product_id} not found"}), 404
 
-    product = dict(row)
-
-    # Use persisted mapping if available, otherwise fall back to live mapping
-    if product.get("qfix_url"):
-        qfix = catalog.enrich_qfix({
-            "qfix_clothing_type": product["qfix_clothing_type"],
-            "qfix_clothing_type_id": product["qfix_clothing_type_id"],
-            "qfix_material": product["qfix_material"],
-            "qfix_material_id": product["qfix_material_id"],
-            "qfix_url": product["qfix_url"],
-        })
-    else:
-        qfix = catalog.enrich_qfix(_get_mapper()(product, brand=brand_slug))
-
+    product, qfix = found
     qfix_url = qfix.get("qfix_url")
     if not qfix_url:
         return jsonify({"error": f"No repair mapping available for product {product_id}"}), 404
@@ -345,10 +759,11 @@ def _redirect_to_qfix(brand_slug, service_key=None):
     # Validate redirect URL to prevent open redirect
     if not qfix_url.startswith("https://") or not _is_allowed_redirect(qfix_url):
         return jsonify({"error": "Invalid redirect URL"}), 400
+    _product_responses.set(cache_key, qfix_url)
     return redirect(qfix_url, code=302)
 
 
-@app.route("/<brand_slug>/repair/")
+@app.route("/<brand:brand_slug>/repair/")
 def redirect_to_repair(brand_slug):
     """Redirect to QFix repair booking page.
 
@@ -380,7 +795,7 @@ def redirect_to_repair(brand_slug):
     return _redirect_to_qfix(brand_slug, service_key="repair")
 
 
-@app.route("/<brand_slug>/adjustment/")
+@app.route("/<brand:brand_slug>/adjustment/")
 def redirect_to_adjustment(brand_slug):
     """Redirect to QFix adjustment booking page.
 
@@ -412,7 +827,7 @@ def redirect_to_adjustment(brand_slug):
     return _redirect_to_qfix(brand_slug, service_key="adjustment")
 
 
-@app.route("/<brand_slug>/care/")
+@app.route("/<brand:brand_slug>/care/")
 def redirect_to_care(brand_slug):
     """Redirect to QFix washing & care booking page.
 
@@ -444,7 +859,7 @@ def redirect_to_care(brand_slug):
     return _redirect_to_qfix(brand_slug, service_key="washing")
 
 
-@app.route("/<brand_slug>/products")
+@app.route("/<brand:brand_slug>/products")
 def list_brand_products(brand_slug):
     """List products for a brand (limit 100).
     ---
@@ -477,19 +892,13 @@ def list_brand_products(brand_slug):
     if auth_error:
         return auth_error
 
-    brand_name = BRAND_ROUTES.get(brand_slug)
-    if not brand_name:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
+    brand_name = BRAND_ROUTES[brand_slug]
 
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT product_id, product_name, category, clothing_type, material_composition, materials, description, color, brand, gtin, article_number, care_text, size, country_of_origin FROM products_unified WHERE brand = %s ORDER BY product_id LIMIT 100",
-            (brand_name,),
-        )
-        rows = cur.fetchall()
-    conn.close()
-    return jsonify(rows)
+    return _stream_json_rows(
+        get_db(),
+        "SELECT product_id, product_name, category, clothing_type, material_composition, materials, description, color, brand, gtin, article_number, care_text, size, country_of_origin FROM products_unified WHERE brand = %s ORDER BY product_id LIMIT 100",
+        (brand_name,),
+    )
 
 
 # ── Legacy v1 routes (aliases to kappahl) ─────────────────────────────────
@@ -530,6 +939,51 @@ def list_products():
 
 # ── v2 endpoints (T4V protocol xlsx) ─────────────────────────────────────
 
+def _refresh_coverage_after_write(conn):
+    """Refresh remap_coverage once a write has committed, without failing it.
+
+    /remap/status then shows slightly old counts until the next refresh,
+    e.g. until setup_db.py has created the view.
+    """
+    try:
+        refresh_remap_coverage(conn)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.warning("Could not refresh remap_coverage: %s", e)
+
+
+# Set once create_table() has run in this process; the DDL is all
+# IF NOT EXISTS, so repeating it per upload only costs locks and round-trips
+_schema_ready = False
+
+# Parsed protocol rows held in memory per bulk_upsert_products() call
+UPLOAD_CHUNK_SIZE = 10000
+
+
+def _ensure_schema(conn):
+    """Run create_table() on the first write from this process only."""
+    global _schema_ready
+    if not _schema_ready:
+        create_table(conn)
+        _schema_ready = True
+
+
+def _map_new_articles(chunk, article_mappings):
+    """Add the qfix mapping of articles first seen in chunk to article_mappings.
+
+    article_mappings is keyed by (brand, article_number). The mapping only
+    depends on article-level fields, so it is computed once per article at
+    ingest and stored with the rows for /v2/product/article.
+    """
+    for product in chunk:
+        article = product.get("article_number")
+        key = (product.get("brand"), article)
+        if article and key not in article_mappings:
+            article_mappings[key] = map_product_v2(
+                product, materials=_parse_materials(product.get("materials")))
+
+
 @app.route("/v2/upload", methods=["POST"])
 @limiter.limit("10 per minute")
 def v2_upload():
@@ -545,6 +999,12 @@ def v2_upload():
         type: file
         required: true
         description: T4V protocol .xlsx file
+      - name: mode
+        in: query
+        type: string
+        enum: [replace]
+        description: "replace: the file is the brand's full catalog; protocol-only
+          products of its brands that it no longer lists are removed"
     responses:
       200:
         description: Import result with product count
@@ -554,6 +1014,7 @@ def v2_upload():
     auth_err = _require_admin()
     if auth_err:
         return auth_err
+    replace = request.args.get("mode") == "replace"
     if "file" not in request.files:
         return jsonify({"error": "No file provided. Use multipart form with key 'file'."}), 400
 
@@ -561,28 +1022,60 @@ def v2_upload():
     if not file.filename or not file.filename.endswith(".xlsx"):
         return jsonify({"error": "File must be an .xlsx file"}), 400
 
-    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
-        file.save(tmp.name)
-        tmp_path = tmp.name
-
+    # openpyxl reads the upload stream directly; no temp file on disk, and
+    # products are written UPLOAD_CHUNK_SIZE at a time as they are parsed
+    products = iter(parse_protocol_xlsx(file.stream))
     try:
-        products = parse_protocol_xlsx(tmp_path)
-    except Exception as e:
-        os.unlink(tmp_path)
-        return jsonify({"error": f"Failed to parse xlsx: {e}"}), 400
+        try:
+            chunk = list(islice(products, UPLOAD_CHUNK_SIZE))
+        except Exception as e:
+            return jsonify({"error": f"Failed to parse xlsx: {e}"}), 400
+
+        imported = 0
+        removed = 0
+        brands = set()
+        article_mappings = {}
+        conn = get_write_db()
+        try:
+            _ensure_schema(conn)
+            # One transaction for the whole file rather than one per INSERT page
+            conn.autocommit = False
+            defer_commit_flush(conn)
+            while chunk:
+                bulk_upsert_products(conn, chunk)
+                _map_new_articles(chunk, article_mappings)
+                imported += len(chunk)
+                if replace:
+                    brands.update(p.get("brand") for p in chunk)
+                try:
+                    chunk = list(islice(products, UPLOAD_CHUNK_SIZE))
+                except Exception as e:
+                    conn.rollback()
+                    return jsonify({"error": f"Failed to parse xlsx: {e}"}), 400
+            # Once every variant is in: an article's sizes can span chunks
+            if article_mappings:
+                bulk_update_article_qfix_mappings(conn, [
+                    (brand, article, qfix)
+                    for (brand, article), qfix in article_mappings.items()])
+            if replace:
+                removed = delete_unlisted_protocol_products(conn, brands)
+            conn.commit()
+            _refresh_coverage_after_write(conn)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+            _product_responses.clear()
     finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
-
-    conn = get_write_db()
-    create_table(conn)
-    count = 0
-    for prod in products:
-        upsert_product(conn, prod)
-        count += 1
-    conn.close()
+        # Releases the openpyxl workbook if parsing stopped early
+        if hasattr(products, "close"):
+            products.close()
 
-    return jsonify({"status": "ok", "products_imported": count})
+    body = {"status": "ok", "products_imported": imported}
+    if replace:
+        body["products_removed"] = removed
+    return jsonify(body)
 
 
 @app.route("/v2/product/gtin/<gtin>")
@@ -603,9 +1096,15 @@ def v2_get_by_gtin(gtin):
       404:
         description: GTIN not found
     """
+    cache_key = ("v2", "gtin", gtin)
+    body = _product_responses.get(cache_key)
+    if body is not None:
+        return jsonify(body)
+
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
+        _execute_prepared(
+            cur, "v2_product_by_gtin",
             "SELECT gtin, article_number, product_name, description, category, size, color, materials, care_text, brand, country_of_origin FROM products_unified WHERE gtin = %s",
             (gtin,),
         )
@@ -615,13 +1114,16 @@ def v2_get_by_gtin(gtin):
     if not row:
         return jsonify({"error": f"GTIN {gtin} not found"}), 404
 
-    product = dict(row)
-    qfix = catalog.enrich_qfix(map_product_v2(product))
+    product = row
+    qfix = catalog.enrich_qfix(map_product_v2(
+        product, materials=_parse_materials(product.get("materials"))))
 
-    return jsonify({
+    body = {
         "product": product,
         "qfix": qfix,
-    })
+    }
+    _product_responses.set(cache_key, body)
+    return jsonify(body)
 
 
 @app.route("/v2/product/article/<article_number>")
@@ -642,10 +1144,16 @@ def v2_get_by_article(article_number):
       404:
         description: Article not found
     """
+    cache_key = ("v2", "article", article_number)
+    body = _product_responses.get(cache_key)
+    if body is not None:
+        return jsonify(body)
+
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT gtin, article_number, product_name, description, category, size, color, materials, care_text, brand, country_of_origin FROM products_unified WHERE article_number = %s ORDER BY size",
+        _execute_prepared(
+            cur, "v2_variants_by_article",
+            "SELECT gtin, article_number, product_name, description, category, size, color, materials, care_text, brand, country_of_origin, qfix_clothing_type, qfix_clothing_type_id, qfix_material, qfix_material_id, qfix_url FROM products_unified WHERE article_number = %s ORDER BY size",
             (article_number,),
         )
         rows = cur.fetchall()
@@ -654,15 +1162,23 @@ def v2_get_by_article(article_number):
     if not rows:
         return jsonify({"error": f"Article {article_number} not found"}), 404
 
-    products = [dict(r) for r in rows]
-    qfix = catalog.enrich_qfix(map_product_v2(products[0]))
+    products = rows
+    # Mapping persisted at upload time; the qfix columns aren't part of a variant
+    stored = [{col: variant.pop(col) for col in _QFIX_MAPPING_FIELDS} for variant in products]
+    if stored[0]["qfix_url"]:
+        qfix = catalog.enrich_qfix(stored[0])
+    else:
+        qfix = catalog.enrich_qfix(map_product_v2(
+            products[0], materials=_parse_materials(products[0].get("materials"))))
 
-    return jsonify({
+    body = {
         "article_number": article_number,
         "product_name": products[0]["product_name"],
         "variants": products,
         "qfix": qfix,
-    })
+    }
+    _product_responses.set(cache_key, body)
+    return jsonify(body)
 
 
 @app.route("/v2/products")
@@ -675,14 +1191,10 @@ def v2_list_products():
       200:
         description: Array of protocol products
     """
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT gtin, article_number, product_name, category, size, color, brand FROM products_unified WHERE gtin IS NOT NULL ORDER BY article_number, size LIMIT 200"
-        )
-        rows = cur.fetchall()
-    conn.close()
-    return jsonify(rows)
+    return _stream_json_rows(
+        get_db(),
+        "SELECT gtin, article_number, product_name, category, size, color, brand FROM products_unified WHERE gtin IS NOT NULL ORDER BY article_number, size LIMIT 200",
+    )
 
 
 # ── v3 endpoints (legacy Gina Tricot aliases) ─────────────────────────────
@@ -705,9 +1217,15 @@ def v3_get_product(product_id):
       404:
         description: Product not found
     """
+    cache_key = ("v3", product_id, request.args.get("mapping"))
+    body = _product_responses.get(cache_key)
+    if body is not None:
+        return jsonify(body)
+
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
+        _execute_prepared(
+            cur, "v3_product_by_id",
             "SELECT product_id, product_name, category, clothing_type, material_composition, product_url, description, color, brand FROM products_unified WHERE brand = %s AND product_id = %s",
             ("Gina Tricot", product_id),
         )
@@ -717,13 +1235,15 @@ def v3_get_product(product_id):
     if not row:
         return jsonify({"error": f"Product {product_id} not found"}), 404
 
-    product = dict(row)
+    product = row
     qfix = catalog.enrich_qfix(_get_mapper()(product, brand="ginatricot"))
 
-    return jsonify({
+    body = {
         "product": product,
         "qfix": qfix,
-    })
+    }
+    _product_responses.set(cache_key, body)
+    return jsonify(body)
 
 
 @app.route("/v3/products")
@@ -736,15 +1256,27 @@ def v3_list_products():
       200:
         description: Array of Gina Tricot products
     """
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT product_id, product_name, category, clothing_type, material_composition, description, color, brand FROM products_unified WHERE brand = %s ORDER BY product_id LIMIT 200",
-            ("Gina Tricot",),
-        )
-        rows = cur.fetchall()
-    conn.close()
-    return jsonify(rows)
+    return _stream_json_rows(
+        get_db(),
+        "SELECT product_id, product_name, category, clothing_type, material_composition, description, color, brand FROM products_unified WHERE brand = %s ORDER BY product_id LIMIT 200",
+        ("Gina Tricot",),
+    )
+
+
+# Shorter terms match too little for the trigram index to narrow the scan
+SEARCH_MIN_LEN = 3
+SEARCH_MAX_LEN = 64
+
+_SEARCH_WORD_RE = re.compile(r"\w+")
+
+
+def _prefix_tsquery(q):
+    """to_tsquery() text matching every word of q as a word prefix.
+
+    Only word characters are kept, so tsquery operators in q can't change
+    the query's meaning.
+    """
+    return " & ".join(f"{word}:*" for word in _SEARCH_WORD_RE.findall(q))
 
 
 @app.route("/v3/product/search")
@@ -758,61 +1290,68 @@ def v3_search():
         in: query
         type: string
         required: true
-        description: Search term (matched against product name)
+        description: "Search term (3-64 characters). A single word matches
+          anywhere in the name; several words must all start words in the
+          name, best matches first."
     responses:
       200:
         description: Array of matching products
       400:
-        description: Missing search term
+        description: Missing or too short search term
     """
-    q = request.args.get("q", "")
+    q = request.args.get("q", "").strip()[:SEARCH_MAX_LEN]
     if not q:
         return jsonify({"error": "Provide ?q= search term"}), 400
+    if len(q) < SEARCH_MIN_LEN:
+        return jsonify({"error": f"Search term must be at least {SEARCH_MIN_LEN} characters"}), 400
     conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "SELECT product_id, product_name, category, clothing_type, color, brand FROM products_unified WHERE brand = %s AND product_name ILIKE %s ORDER BY product_id LIMIT 50",
-            ("Gina Tricot", f"%{q}%"),
-        )
-        rows = cur.fetchall()
+    with conn.cursor() as cur:
+        if len(q.split()) > 1:
+            # Same products_name_fts lookup as /v4/product/search
+            cur.execute("""
+                SELECT product_id, product_name, category, clothing_type, color, brand
+                FROM products_unified, to_tsquery('simple', %s) query
+                WHERE brand = %s AND to_tsvector('simple', product_name) @@ query
+                ORDER BY ts_rank_cd(to_tsvector('simple', product_name), query) DESC, product_id
+                LIMIT 50
+            """, (_prefix_tsquery(q), "Gina Tricot"))
+        else:
+            cur.execute(
+                "SELECT product_id, product_name, category, clothing_type, color, brand FROM products_unified WHERE brand = %s AND product_name ILIKE %s ORDER BY product_id LIMIT 50",
+                ("Gina Tricot", f"%{q}%"),
+            )
+        rows = _rows_to_dicts(cur)
     conn.close()
     return jsonify(rows)
 
 
 # ── v4 endpoints (aggregated: enriched data from single table) ────────────
 
-def _merge_product(product):
-    """Build merged view from a unified product row that has both scraped and protocol data."""
-    import json as _json
-
-    merged = {
-        "product_name": product.get("product_name"),
-        "brand": product.get("brand"),
-        "color": product.get("color"),
-        "description_sv": product.get("description"),
-        "description_en": product.get("description"),
-        "category_scraped": product.get("category"),
-        "category_protocol": product.get("category"),
-        "clothing_type": product.get("clothing_type"),
-        "material_composition": product.get("material_composition"),
-        "materials_structured": product.get("materials"),
-        "care_text": product.get("care_text"),
-        "country_of_origin": product.get("country_of_origin"),
-        "product_url": product.get("product_url"),
-        "product_id": product.get("product_id"),
-        "article_number": product.get("article_number"),
-        "source": "merged" if product.get("article_number") else "scraper_only",
+def _mapping_input(merged):
+    """Rebuild the mapper's product fields from a merged v4 product row."""
+    return {
+        "product_name": merged["product_name"],
+        "category": merged["category_scraped"],
+        "clothing_type": merged["clothing_type"],
+        "material_composition": merged["material_composition"],
+        "description": merged["description_sv"],
+        "materials": merged["materials_structured"],
     }
 
-    materials_list = None
-    raw = product.get("materials")
+
+@functools.lru_cache(maxsize=8192)
+def _parse_materials(raw):
+    """Decode the materials column (a JSON string); None if absent or invalid.
+
+    Memoized on the raw text, which repeats across the size variants of an
+    article. Callers share the returned list and must not modify it.
+    """
     if raw and isinstance(raw, str):
         try:
-            materials_list = _json.loads(raw)
-        except (_json.JSONDecodeError, TypeError):
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
             pass
-
-    return merged, materials_list
+    return None
 
 
 @app.route("/v4/product/<product_id>")
@@ -833,12 +1372,23 @@ def v4_get_product(product_id):
       404:
         description: Product not found
     """
+    cache_key = ("v4", product_id, request.args.get("mapping"))
+    body = _product_responses.get(cache_key)
+    if body is not None:
+        return jsonify(body)
+
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """SELECT product_id, product_name, category, clothing_type, material_composition,
-                      product_url, description, color, brand, image_url, materials, care_text,
-                      country_of_origin, article_number,
+        _execute_prepared(
+            cur, "v4_product_by_id",
+            # The row comes back in the merged response shape, plus the
+            # persisted mapping columns
+            """SELECT product_name, brand, color,
+                      description AS description_sv, description AS description_en,
+                      category AS category_scraped, category AS category_protocol,
+                      clothing_type, material_composition, materials AS materials_structured,
+                      care_text, country_of_origin, product_url, product_id, article_number,
+                      CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source,
                       qfix_clothing_type, qfix_clothing_type_id, qfix_material,
                       qfix_material_id, qfix_url
                FROM products_unified WHERE product_id = %s LIMIT 1""",
@@ -850,29 +1400,28 @@ def v4_get_product(product_id):
     if not row:
         return jsonify({"error": f"Product {product_id} not found"}), 404
 
-    product = dict(row)
-    merged, materials_list = _merge_product(product)
+    merged = row
+    stored = {col: merged.pop(col) for col in _QFIX_MAPPING_FIELDS}
 
     # Use persisted mapping if available, otherwise compute live
-    if product.get("qfix_url"):
-        qfix = catalog.enrich_qfix({
-            "qfix_clothing_type": product["qfix_clothing_type"],
-            "qfix_clothing_type_id": product["qfix_clothing_type_id"],
-            "qfix_material": product["qfix_material"],
-            "qfix_material_id": product["qfix_material_id"],
-            "qfix_url": product["qfix_url"],
-        })
+    if stored["qfix_url"]:
+        qfix = catalog.enrich_qfix(stored)
     else:
-        brand_slug = BRAND_SLUG.get(product.get("brand"))
-        if product.get("article_number"):
+        product = _mapping_input(merged)
+        if merged["article_number"]:
+            # Only the live v2 mapping needs the decoded materials
+            materials_list = _parse_materials(product["materials"])
             qfix = catalog.enrich_qfix(map_product_v2(product, materials=materials_list))
         else:
+            brand_slug = BRAND_SLUG.get(merged["brand"])
             qfix = catalog.enrich_qfix(_get_mapper()(product, brand=brand_slug))
 
-    return jsonify({
+    body = {
         "product": merged,
         "qfix": qfix,
-    })
+    }
+    _product_responses.set(cache_key, body)
+    return jsonify(body)
 
 
 @app.route("/v4/products")
@@ -885,22 +1434,17 @@ def v4_list_products():
       200:
         description: Array of products with merge status
     """
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            SELECT product_id, product_name, category, clothing_type,
-                   material_composition, description, color, brand,
-                   article_number AS protocol_article,
-                   category AS protocol_category,
-                   care_text, country_of_origin,
-                   CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source
-            FROM products_unified
-            ORDER BY product_id
-            LIMIT 200
-        """)
-        rows = cur.fetchall()
-    conn.close()
-    return jsonify(rows)
+    return _stream_json_rows(get_db(), """
+        SELECT product_id, product_name, category, clothing_type,
+               material_composition, description, color, brand,
+               article_number AS protocol_article,
+               category AS protocol_category,
+               care_text, country_of_origin,
+               CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source
+        FROM products_unified
+        ORDER BY product_id
+        LIMIT 200
+    """)
 
 
 @app.route("/v4/product/search")
@@ -914,40 +1458,100 @@ def v4_search():
         in: query
         type: string
         required: true
-        description: Search term
+        description: "Search term (3-64 characters). A single word matches
+          anywhere in the name; several words must all start words in the
+          name, best matches first."
     responses:
       200:
         description: Array of matching products with merge status
       400:
-        description: Missing search term
+        description: Missing or too short search term
     """
-    q = request.args.get("q", "")
+    q = request.args.get("q", "").strip()[:SEARCH_MAX_LEN]
     if not q:
         return jsonify({"error": "Provide ?q= search term"}), 400
+    if len(q) < SEARCH_MIN_LEN:
+        return jsonify({"error": f"Search term must be at least {SEARCH_MIN_LEN} characters"}), 400
     conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            SELECT product_id, product_name, category, clothing_type, color, brand,
-                   CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source
-            FROM products_unified
-            WHERE product_name ILIKE %s
-            ORDER BY product_id
-            LIMIT 50
-        """, (f"%{q}%",))
-        rows = cur.fetchall()
+    with conn.cursor() as cur:
+        if len(q.split()) > 1:
+            # Several words: match word prefixes in any order, best matches
+            # first. to_tsvector('simple', product_name) is the
+            # products_name_fts index expression.
+            cur.execute("""
+                SELECT product_id, product_name, category, clothing_type, color, brand,
+                       CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source
+                FROM products_unified, to_tsquery('simple', %s) query
+                WHERE to_tsvector('simple', product_name) @@ query
+                ORDER BY ts_rank_cd(to_tsvector('simple', product_name), query) DESC, product_id
+                LIMIT 50
+            """, (_prefix_tsquery(q),))
+        else:
+            # lower(product_name) matches the products_name_trgm index expression
+            cur.execute("""
+                SELECT product_id, product_name, category, clothing_type, color, brand,
+                       CASE WHEN article_number IS NOT NULL THEN 'merged' ELSE 'scraper_only' END AS source
+                FROM products_unified
+                WHERE lower(product_name) LIKE lower(%s)
+                ORDER BY product_id
+                LIMIT 50
+            """, (f"%{q}%",))
+        rows = _rows_to_dicts(cur)
     conn.close()
     return jsonify(rows)
 
 
 # ── Vision identification endpoint ────────────────────────────────────────
 
-ALLOWED_IMAGE_TYPES = {
-    "image/jpeg": "image/jpeg",
-    "image/png": "image/png",
-    "image/webp": "image/webp",
-    "image/gif": "image/gif",
-    "image/jpg": "image/jpeg",
-}
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+# Uploads at least this large are memory-mapped when their stream is a real
+# file. Werkzeug spools smaller ones in memory, and fileno() would first
+# write those out to disk.
+MMAP_MIN_IMAGE_BYTES = 512 * 1024
+
+
+def _sniff_image_type(head):
+    """Media type for the first 12 bytes of a JPEG, PNG, WebP or GIF, else None."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _read_image_upload(file):
+    """Return (image_bytes, media_type, error_response) for an uploaded image.
+
+    The type comes from the file's magic bytes, not the client's
+    Content-Type, and is checked before the rest of the file is read.
+    """
+    head = file.stream.read(12)
+    media_type = _sniff_image_type(head)
+    if not media_type:
+        return None, None, (jsonify({"error": "Unsupported image type. Use JPEG, PNG, WebP, or GIF."}), 400)
+
+    size = file.stream.seek(0, os.SEEK_END)
+    file.stream.seek(len(head))
+    if size > MAX_IMAGE_BYTES:
+        return None, None, (jsonify({"error": "Image too large (max 20MB)"}), 413)
+    if size >= MMAP_MIN_IMAGE_BYTES:
+        # Large uploads sit in a temp file: map it instead of copying it into
+        # memory. The map is released with the last view.
+        try:
+            mapped = mmap.mmap(file.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass  # io.UnsupportedOperation: not backed by a file; read it below
+        else:
+            return memoryview(mapped), media_type, None
+
+    image_bytes = head + file.stream.read(MAX_IMAGE_BYTES - len(head) + 1)
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        return None, None, (jsonify({"error": "Image too large (max 20MB)"}), 413)
+    return image_bytes, media_type, None
 
 
 @app.route("/identify", methods=["POST"])
@@ -970,6 +1574,8 @@ def identify():
         description: Classification result with QFix repair category mapping
       400:
         description: Missing or invalid image
+      413:
+        description: Image larger than 20MB
       500:
         description: Vision API error
     """
@@ -980,13 +1586,9 @@ def identify():
     if not file.filename:
         return jsonify({"error": "Empty filename"}), 400
 
-    media_type = ALLOWED_IMAGE_TYPES.get(file.content_type)
-    if not media_type:
-        return jsonify({"error": f"Unsupported image type: {file.content_type}. Use JPEG, PNG, WebP, or GIF."}), 400
-
-    image_bytes = file.read()
-    if len(image_bytes) > 20 * 1024 * 1024:  # 20MB limit
-        return jsonify({"error": "Image too large (max 20MB)"}), 400
+    image_bytes, media_type, error = _read_image_upload(file)
+    if error:
+        return error
 
     try:
         result = classify_and_map(image_bytes, media_type)
@@ -1013,13 +1615,9 @@ def identify_redirect():
     if not file.filename:
         return jsonify({"error": "Empty filename"}), 400
 
-    media_type = ALLOWED_IMAGE_TYPES.get(file.content_type)
-    if not media_type:
-        return jsonify({"error": f"Unsupported image type: {file.content_type}"}), 400
-
-    image_bytes = file.read()
-    if len(image_bytes) > 20 * 1024 * 1024:
-        return jsonify({"error": "Image too large (max 20MB)"}), 400
+    image_bytes, media_type, error = _read_image_upload(file)
+    if error:
+        return error
 
     service = request.form.get("service", "repair")
 
@@ -1045,24 +1643,20 @@ def identify_redirect():
         all_top_actions = get_action_ranking(ranking_conn, ct_id, mat_id) or {}
         ranking_conn.close()
 
-    # Build URLs for each service type
-    slug_to_key = {"repair": "repair", "adjustment": "adjustment", "washing": "care"}
-    ranking_keys = {"repair": "repair", "adjustment": "adjustment", "care": "care"}
+    # Build URLs for each service type (customize has no redirect)
     redirect_urls = {}
 
     for svc in enriched.get("qfix_services", []):
-        svc_slug = svc.get("slug", "")
-        for slug_part, key in slug_to_key.items():
-            if slug_part in svc_slug:
-                url = base_url + ("&" if "?" in base_url else "?") + f"service_category_id={svc['id']}"
-                # Append top-ranked actions
-                ranking_key = ranking_keys.get(key, key)
-                actions = all_top_actions.get(ranking_key, [])
-                if actions:
-                    ids = ",".join(str(a["id"]) for a in actions[:5])
-                    url += f"&services_id={ids}"
-                redirect_urls[key] = url
-                break
+        key = service_key_for_slug(svc.get("slug", ""))
+        if key is None or key == "other":
+            continue
+        url = base_url + ("&" if "?" in base_url else "?") + f"service_category_id={svc['id']}"
+        # Append top-ranked actions
+        actions = all_top_actions.get(key, [])
+        if actions:
+            ids = ",".join(str(a["id"]) for a in actions[:5])
+            url += f"&services_id={ids}"
+        redirect_urls[key] = url
 
     # Keep backwards-compatible single redirect_url
     service_key_map = {"repair": "repair", "adjustment": "adjustment", "care": "care", "washing": "care"}
@@ -1093,45 +1687,42 @@ def unmapped_categories():
 
     known_brands = tuple(BRAND_ROUTES.values())
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # Aggregated in Postgres: one row per distinct brand/value pair
         cur.execute(
-            "SELECT DISTINCT brand, clothing_type, material_composition, category FROM products_unified WHERE clothing_type IS NOT NULL AND brand IN %s ORDER BY brand, clothing_type",
+            "SELECT brand, clothing_type, COUNT(DISTINCT product_id) AS products FROM products_unified WHERE clothing_type IS NOT NULL AND brand IN %s GROUP BY brand, clothing_type ORDER BY brand, clothing_type",
             (known_brands,),
         )
-        all_rows = cur.fetchall()
+        type_rows = cur.fetchall()
+        cur.execute(
+            "SELECT DISTINCT brand, material_composition FROM products_unified WHERE clothing_type IS NOT NULL AND material_composition IS NOT NULL AND brand IN %s ORDER BY brand, material_composition",
+            (known_brands,),
+        )
+        material_rows = cur.fetchall()
 
     conn.close()
 
-    # Group by brand
-    by_brand = {}
-    for row in all_rows:
-        brand = row["brand"]
-        if brand not in by_brand:
-            by_brand[brand] = []
-        by_brand[brand].append(row)
-
-    for brand_name, rows in by_brand.items():
-        slug = BRAND_SLUG.get(brand_name, brand_name.lower().replace(" ", ""))
-        unmapped_types = {}
-        unmapped_materials = set()
-
-        for row in rows:
-            ct = row["clothing_type"]
-            mat = row["material_composition"]
-            mapped_type = map_clothing_type(ct, brand=slug)
-            if mapped_type is None and ct:
-                if ct not in unmapped_types:
-                    unmapped_types[ct] = 0
-                unmapped_types[ct] += 1
-            mapped_mat = map_material(mat, brand=slug)
-            if mapped_mat == "Other/Unsure" and mat:
-                unmapped_materials.add(mat)
+    # Both queries are ordered by brand, and every brand with a material row
+    # also has a clothing type row
+    materials_by_brand = {
+        brand_name: list(rows)
+        for brand_name, rows in groupby(material_rows, key=itemgetter("brand"))
+    }
 
+    for brand_name, brand_types in groupby(type_rows, key=itemgetter("brand")):
+        brand_materials = materials_by_brand.get(brand_name, ())
+        slug = BRAND_SLUG[brand_name]
+        # Rows arrive sorted by the queries' ORDER BY, and each value once
         result[slug] = {
             "unmapped_clothing_types": [
-                {"clothing_type": ct, "distinct_products": count}
-                for ct, count in sorted(unmapped_types.items())
+                {"clothing_type": row["clothing_type"], "distinct_products": row["products"]}
+                for row in brand_types
+                if map_clothing_type(row["clothing_type"], brand=slug) is None
+            ],
+            "unmapped_materials": [
+                row["material_composition"]
+                for row in brand_materials
+                if map_material(row["material_composition"], brand=slug) == "Other/Unsure"
             ],
-            "unmapped_materials": sorted(unmapped_materials),
         }
 
     result["qfix_valid_clothing_types"] = {name: id for name, id in sorted(QFIX_CLOTHING_TYPE_IDS.items())}
@@ -1150,6 +1741,14 @@ def unmapped_categories():
     return jsonify(result)
 
 
+# QFix materials that /unmapped/add and /remap/apply accept as a target
+VALID_MAPPING_MATERIALS = frozenset({
+    "Standard textile", "Linen/Wool", "Cashmere", "Silk",
+    "Leather/Suede", "Down", "Fur", "Other/Unsure",
+})
+_SORTED_VALID_MAPPING_MATERIALS = sorted(VALID_MAPPING_MATERIALS)
+
+
 @app.route("/unmapped/add", methods=["POST"])
 def add_mapping():
     """Add a new clothing type or material mapping (in-memory, resets on redeploy).
@@ -1208,16 +1807,19 @@ def add_mapping():
                 "valid_types": sorted(QFIX_CLOTHING_TYPE_IDS.keys()),
             }), 400
         CLOTHING_TYPE_MAP[from_val] = to_val
+        _product_responses.clear()
+        _verify_mapping.cache_clear()
         return jsonify({"status": "ok", "mapped": f"'{from_val}' -> '{to_val}' (id={QFIX_CLOTHING_TYPE_IDS[to_val]})"})
 
     elif mapping_type == "material":
-        valid_materials = {"Standard textile", "Linen/Wool", "Cashmere", "Silk", "Leather/Suede", "Down", "Fur", "Other/Unsure"}
-        if to_val not in valid_materials:
+        if to_val not in VALID_MAPPING_MATERIALS:
             return jsonify({
                 "error": f"Invalid QFix material: '{to_val}'",
-                "valid_materials": sorted(valid_materials),
+                "valid_materials": _SORTED_VALID_MAPPING_MATERIALS,
             }), 400
         MATERIAL_MAP[from_val] = to_val
+        _product_responses.clear()
+        _verify_mapping.cache_clear()
         return jsonify({"status": "ok", "mapped": f"'{from_val}' -> '{to_val}'"})
 
     else:
@@ -1227,6 +1829,22 @@ def add_mapping():
 logger = logging.getLogger(__name__)
 
 
+# Products per UPDATE statement and transaction in /remap/run
+REMAP_BATCH_SIZE = 1000
+
+
+def _mapping_key(product, slug):
+    """The product fields map_product() and map_product_legacy() read."""
+    return (
+        slug,
+        product.get("clothing_type"),
+        product.get("product_name"),
+        product.get("description"),
+        product.get("material_composition"),
+        product.get("category"),
+    )
+
+
 @app.route("/remap/run", methods=["POST"])
 @limiter.limit("5 per minute")
 def remap_run():
@@ -1234,7 +1852,8 @@ def remap_run():
 
     Runs the mapping engine on every product and writes the 5 QFix columns
     (clothing_type, clothing_type_id, material, material_id, url) to the DB.
-    Products are processed in batches of 100 rows per transaction.
+    Products are written in batches of 1000 rows, one UPDATE and one
+    transaction per batch.
     ---
     tags:
       - Mapping
@@ -1281,41 +1900,40 @@ def remap_run():
     limit = request.args.get("limit", type=int)
     offset = request.args.get("offset", 0, type=int)
 
-    # Load products from DB
-    conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        base_query = (
-            "SELECT product_id, product_name, description, category, clothing_type, "
-            "material_composition, materials, brand, article_number "
-            "FROM products_unified"
-        )
-        params = []
-        if brand_filter:
-            brand_name = BRAND_ROUTES[brand_filter]
-            base_query += " WHERE brand = %s"
-            params.append(brand_name)
-        base_query += " ORDER BY id"
-        if limit:
-            base_query += " LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-        cur.execute(base_query, params)
-        rows = cur.fetchall()
-    conn.close()
+    # Only the row key and the fields _mapping_key() lists
+    base_query = (
+        "SELECT product_id, brand, product_name, description, category, clothing_type, "
+        "material_composition "
+        "FROM products_unified"
+    )
+    params = []
+    if brand_filter:
+        brand_name = BRAND_ROUTES[brand_filter]
+        base_query += " WHERE brand = %s"
+        params.append(brand_name)
+    base_query += " ORDER BY id"
+    if limit:
+        base_query += " LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
 
     mapper = _get_mapper()
-    total = len(rows)
+    total = 0
     mapped = 0
     unmapped = 0
     updated = 0
 
+    # Ensure QFix catalog is loaded for service ID resolution
+    catalog.load()
+
+    # Products are streamed from a server-side cursor, which only lives
+    # inside a transaction, while mappings are written on write_conn
+    conn = get_db()
+    conn.autocommit = False
     write_conn = get_write_db()
 
-    # Process in batches of 100
+    # Written in batches of REMAP_BATCH_SIZE
     write_conn.autocommit = False
-    batch_count = 0
-
-    # Ensure QFix catalog is loaded for service ID resolution
-    catalog.load()
+    pending = []
 
     # Slug-to-service-category mapping
     _SERVICE_SLUG_MAP = {
@@ -1325,55 +1943,70 @@ def remap_run():
         "customize": "qfix_url_other",
     }
 
-    try:
-        for row in rows:
-            product = dict(row)
-            slug = BRAND_SLUG.get(product.get("brand"))
-            qfix = mapper(product, brand=slug)
+    def _map_with_service_urls(product, slug):
+        qfix = mapper(product, brand=slug)
+
+        # Resolve service URLs
+        base_url = qfix.get("qfix_url")
+        ct_id = qfix.get("qfix_clothing_type_id")
+        mat_id = qfix.get("qfix_material_id")
+        if base_url and ct_id and mat_id:
+            service_cats = catalog.services.get((ct_id, mat_id), [])
+            for svc_cat in service_cats:
+                svc_slug = svc_cat.get("slug", "")
+                svc_id = svc_cat.get("id")
+                if svc_id:
+                    sep = "&" if "?" in base_url else "?"
+                    svc_url = f"{base_url}{sep}service_category_id={svc_id}"
+                    for key, col in _SERVICE_SLUG_MAP.items():
+                        if key in svc_slug:
+                            qfix[col] = svc_url
+                            break
+        return qfix
 
-            if qfix.get("qfix_url"):
-                mapped += 1
-            else:
-                unmapped += 1
-
-            # Resolve service URLs
-            base_url = qfix.get("qfix_url")
-            ct_id = qfix.get("qfix_clothing_type_id")
-            mat_id = qfix.get("qfix_material_id")
-            if base_url and ct_id and mat_id:
-                service_cats = catalog.services.get((ct_id, mat_id), [])
-                for svc_cat in service_cats:
-                    svc_slug = svc_cat.get("slug", "")
-                    svc_id = svc_cat.get("id")
-                    if svc_id:
-                        sep = "&" if "?" in base_url else "?"
-                        svc_url = f"{base_url}{sep}service_category_id={svc_id}"
-                        for key, col in _SERVICE_SLUG_MAP.items():
-                            if key in svc_slug:
-                                qfix[col] = svc_url
-                                break
-
-            update_qfix_mapping(
-                write_conn,
-                product["brand"],
-                product["product_id"],
-                qfix,
-            )
-            batch_count += 1
-            updated += 1
+    # Products sharing every mapper input (sizes and colours of one style,
+    # mostly) share one mapping
+    qfix_by_key = {}
 
-            if batch_count >= 100:
-                write_conn.commit()
-                batch_count = 0
+    try:
+        with conn.cursor(name="remap_stream", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = REMAP_BATCH_SIZE
+            cur.execute(base_query, params)
+            for row in cur:
+                total += 1
+                product = row
+                slug = BRAND_SLUG.get(product.get("brand"))
+                key = _mapping_key(product, slug)
+                qfix = qfix_by_key.get(key)
+                if qfix is None:
+                    qfix = qfix_by_key[key] = _map_with_service_urls(product, slug)
+
+                if qfix.get("qfix_url"):
+                    mapped += 1
+                else:
+                    unmapped += 1
+
+                pending.append((product["brand"], product["product_id"], qfix))
+                if len(pending) >= REMAP_BATCH_SIZE:
+                    defer_commit_flush(write_conn)
+                    updated += bulk_update_qfix_mappings(write_conn, pending)
+                    write_conn.commit()
+                    pending = []
 
         # Commit remaining
-        if batch_count > 0:
+        if pending:
+            defer_commit_flush(write_conn)
+            updated += bulk_update_qfix_mappings(write_conn, pending)
             write_conn.commit()
+
+        _refresh_coverage_after_write(write_conn)
     except Exception:
         write_conn.rollback()
         raise
     finally:
+        conn.close()
         write_conn.close()
+        _product_responses.clear()
 
     return jsonify({
         "total": total,
@@ -1388,6 +2021,8 @@ def remap_status():
     """Get per-brand QFix mapping coverage.
 
     Returns how many products per brand have a persisted QFix URL vs how many are unmapped.
+    Read from the remap_coverage view, refreshed by /remap/run and protocol
+    uploads; products added by scrapers are counted after the next run.
     ---
     tags:
       - Mapping
@@ -1413,18 +2048,38 @@ def remap_status():
                 description: Products without a persisted qfix_url
     """
     conn = get_db()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            SELECT brand, COUNT(*) as total,
-                   COUNT(qfix_url) as mapped,
-                   COUNT(*) - COUNT(qfix_url) as unmapped
-            FROM products_unified GROUP BY brand
-        """)
-        rows = cur.fetchall()
-    conn.close()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            try:
+                cur.execute("SELECT brand, total, mapped, unmapped FROM remap_coverage")
+            except UndefinedTable:
+                # setup_db.py hasn't created the view yet; count live
+                cur.execute("""
+                    SELECT brand, COUNT(*) AS total,
+                           COUNT(*) FILTER (WHERE qfix_url IS NOT NULL) AS mapped,
+                           COUNT(*) FILTER (WHERE qfix_url IS NULL) AS unmapped
+                    FROM products_unified GROUP BY brand
+                """)
+            rows = cur.fetchall()
+    finally:
+        conn.close()
     return jsonify(rows)
 
 
+# Brand names by slug, so ?brand=ginatricot finds "Gina Tricot"
+_BRAND_BY_SLUG = dict(BRAND_ROUTES)
+
+
+def _brand_condition(brand):
+    """SQL condition and parameter matching ?brand= case-insensitively.
+
+    Protocol uploads store the Brand cell as typed ("KAPPAHL", "kappahl"),
+    so even known brands are compared on LOWER(brand), which the
+    products_unified_lower_brand index covers.
+    """
+    return "LOWER(brand) = LOWER(%s)", _BRAND_BY_SLUG.get(brand.lower(), brand)
+
+
 @app.route("/remap/mapping-pairs")
 def remap_mapping_pairs():
     """Get all distinct (clothing_type, qfix_clothing_type) pairs per brand with counts."""
@@ -1440,8 +2095,9 @@ def remap_mapping_pairs():
         """
         params = []
         if brand:
-            query += " AND LOWER(brand) = LOWER(%s)"
-            params.append(brand)
+            clause, value = _brand_condition(brand)
+            query += f" AND {clause}"
+            params.append(value)
         query += " GROUP BY clothing_type, qfix_clothing_type, qfix_material ORDER BY clothing_type, cnt DESC"
         cur.execute(query, params)
         rows = cur.fetchall()
@@ -1463,8 +2119,9 @@ def remap_products():
         """
         params = []
         if brand:
-            query += " AND LOWER(brand) = LOWER(%s)"
-            params.append(brand)
+            clause, value = _brand_condition(brand)
+            query += f" AND {clause}"
+            params.append(value)
         if clothing_type:
             query += " AND clothing_type = %s"
             params.append(clothing_type)
@@ -1566,8 +2223,9 @@ def remap_impact_report():
         """
         params = []
         if brand_filter:
-            query += " WHERE LOWER(brand) = LOWER(%s)"
-            params.append(brand_filter)
+            clause, value = _brand_condition(brand_filter)
+            query += f" WHERE {clause}"
+            params.append(value)
         query += " ORDER BY brand, clothing_type, product_id"
         cur.execute(query, params)
         rows = cur.fetchall()
@@ -1607,6 +2265,7 @@ Available actions:
 {actions_list}
 
 Return ONLY a JSON array of the top 10 most relevant action names (as strings), ordered by likelihood. If fewer than 10 actions are physically applicable, return fewer. Example: ["Repair seam", "Replace button", "Repair tear"]"""
+_format_rank_prompt = RANK_ACTIONS_PROMPT.format_map
 
 # Keyword → action injection: Swedish/English keywords in product text → actions to boost
 # Each entry: list of keywords (any match triggers), action names to inject, which ranking category
@@ -1785,15 +2444,30 @@ KEYWORD_EXCLUSION_RULES = [
 ]
 
 
-def _inject_keyword_actions(top_actions, product_text, qfix_services, ct_id=None):
-    """Inject/exclude actions in top_actions based on keywords found in product text."""
+def _keyword_pattern(keywords):
+    """Compile keywords into one regex matching any of them as a substring."""
+    return re.compile("|".join(re.escape(kw) for kw in keywords))
+
+
+# One precompiled alternation per rule, in rule order
+_KEYWORD_ACTION_PATTERNS = [_keyword_pattern(r["keywords"]) for r in KEYWORD_ACTION_RULES]
+_KEYWORD_REQUIRE_PATTERNS = [_keyword_pattern(r["require_keywords"]) for r in KEYWORD_REQUIRE_RULES]
+_KEYWORD_EXCLUSION_PATTERNS = [_keyword_pattern(r["keywords"]) for r in KEYWORD_EXCLUSION_RULES]
+
+
+def _inject_keyword_actions(top_actions, product_text, qfix_services, ct_id=None, mat_id=None):
+    """Inject/exclude actions in top_actions based on keywords found in product text.
+
+    With ct_id and mat_id, action variants come from the catalog's prebuilt
+    name index instead of being collected from qfix_services on every call.
+    """
     if not product_text:
         return top_actions
 
     # Build set of action names to exclude per category
     excluded = {}  # category_key -> set of action names
-    for rule in KEYWORD_EXCLUSION_RULES:
-        if any(kw in product_text for kw in rule["keywords"]):
+    for rule, pattern in zip(KEYWORD_EXCLUSION_RULES, _KEYWORD_EXCLUSION_PATTERNS):
+        if pattern.search(product_text):
             cat = rule["category"]
             if cat not in excluded:
                 excluded[cat] = set()
@@ -1801,41 +2475,22 @@ def _inject_keyword_actions(top_actions, product_text, qfix_services, ct_id=None
 
     # Require-keyword rules: exclude actions when NO keyword matches
     product_text_lower = product_text.lower()
-    for rule in KEYWORD_REQUIRE_RULES:
-        if not any(kw in product_text_lower for kw in rule["require_keywords"]):
+    for rule, pattern in zip(KEYWORD_REQUIRE_RULES, _KEYWORD_REQUIRE_PATTERNS):
+        if not pattern.search(product_text_lower):
             cat = rule["category"]
             if cat not in excluded:
                 excluded[cat] = set()
             excluded[cat].update(rule["actions"])
 
-    # Build a lookup: action name -> {id, name, price} from all services
-    all_actions = {}  # name -> list of {id, name, price, category_key}
-    service_slug_to_key = {
-        "repair": "repair", "adjustment": "adjustment",
-        "washing": "care", "customize": "other",
-    }
-    for svc_cat in qfix_services:
-        svc_slug = svc_cat.get("slug", "")
-        cat_key = None
-        for slug_part, key in service_slug_to_key.items():
-            if slug_part in svc_slug:
-                cat_key = key
-                break
-        if not cat_key:
-            continue
-        for s in svc_cat.get("services", []):
-            name = s["name"]
-            if name not in all_actions:
-                all_actions[name] = []
-            all_actions[name].append({
-                "id": s["id"], "name": name,
-                "price": s.get("price"), "category_key": cat_key,
-            })
+    # Lookup: action name -> list of {id, name, price, category_key}
+    all_actions = catalog.actions_by_name.get((ct_id, mat_id))
+    if all_actions is None:
+        all_actions = index_actions_by_name(qfix_services)
 
     # Check each keyword rule — inject at most MAX_INJECTED_PER_RULE actions
     injected = {}  # category_key -> list of actions to inject
-    for rule in KEYWORD_ACTION_RULES:
-        if any(kw in product_text for kw in rule["keywords"]):
+    for rule, pattern in zip(KEYWORD_ACTION_RULES, _KEYWORD_ACTION_PATTERNS):
+        if pattern.search(product_text):
             cat = rule["category"]
             if cat not in injected:
                 injected[cat] = []
@@ -1959,7 +2614,7 @@ def remap_rank_actions():
     if not catalog.services:
         return jsonify({"error": "QFix catalog not loaded"}), 500
 
-    ai_client = anthropic.Anthropic(api_key=api_key)
+    ai_client = get_ai_client()
 
     # Optional: force re-rank specific clothing type IDs or all
     force_ct_ids = None
@@ -1985,113 +2640,110 @@ def remap_rank_actions():
     ranked = 0
     errors = 0
 
-    service_slug_to_key = {
-        "repair": "repair",
-        "adjustment": "adjustment",
-        "washing": "care",
-        "customize": "other",
-    }
-
-    for (ct_id, mat_id), svc_cats in catalog.services.items():
-        if (ct_id, mat_id) in existing:
-            continue
-
-        ct_name = catalog.items.get(ct_id, {}).get("name", f"ID {ct_id}")
-        mat_name = catalog.subitems.get(mat_id, {}).get("name", f"ID {mat_id}")
-
-        rankings = {}
+    def _persist(ct_id, mat_id, rankings):
+        # Use a fresh connection for each persist to avoid timeout
+        wc = get_write_db()
+        try:
+            upsert_action_ranking(wc, ct_id, mat_id, rankings)
+        finally:
+            wc.close()
 
-        for svc_cat in svc_cats:
-            svc_slug = svc_cat.get("slug", "")
-            svc_name = svc_cat.get("name", "")
-            services = svc_cat.get("services", [])
-
-            # Determine the key for this service category
-            ranking_key = None
-            for slug_part, key in service_slug_to_key.items():
-                if slug_part in svc_slug:
-                    ranking_key = key
-                    break
-            if not ranking_key:
+    # Persist each combo on a background thread so its write overlaps the
+    # next combo's Claude calls; leaving the block waits for the last write,
+    # and shuts the thread down if ranking raises
+    pending = []
+    with ThreadPoolExecutor(max_workers=1) as persist_pool:
+        for (ct_id, mat_id), svc_cats in catalog.services.items():
+            if (ct_id, mat_id) in existing:
                 continue
 
-            if not services:
-                rankings[ranking_key] = []
-                continue
+            ct_name = catalog.items.get(ct_id, {}).get("name", f"ID {ct_id}")
+            mat_name = catalog.subitems.get(mat_id, {}).get("name", f"ID {mat_id}")
 
-            # If 5 or fewer actions, no need to rank
-            if len(services) <= 5:
-                rankings[ranking_key] = [
-                    {"id": s["id"], "name": s["name"], "price": s.get("price")}
-                    for s in services
-                ]
-                continue
+            rankings = {}
 
-            # Build action list for Claude
-            action_names = list({s["name"] for s in services})
-            actions_list = "\n".join(f"- {name}" for name in sorted(action_names))
+            for svc_cat in svc_cats:
+                svc_slug = svc_cat.get("slug", "")
+                svc_name = svc_cat.get("name", "")
+                services = svc_cat.get("services", [])
 
-            prompt = RANK_ACTIONS_PROMPT.format(
-                clothing_type=ct_name,
-                material=mat_name,
-                service_name=svc_name,
-                actions_list=actions_list,
-            )
+                # Determine the key for this service category
+                ranking_key = service_key_for_slug(svc_slug)
+                if not ranking_key:
+                    continue
 
-            try:
-                message = ai_client.messages.create(
-                    model="claude-sonnet-4-5-20250929",
-                    max_tokens=256,
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                response_text = message.content[0].text.strip()
+                if not services:
+                    rankings[ranking_key] = []
+                    continue
+
+                # If 5 or fewer actions, no need to rank
+                if len(services) <= 5:
+                    rankings[ranking_key] = [
+                        {"id": s["id"], "name": s["name"], "price": s.get("price")}
+                        for s in services
+                    ]
+                    continue
 
-                # Parse JSON (handle markdown code blocks)
-                if response_text.startswith("```"):
-                    lines = response_text.split("\n")
-                    response_text = "\n".join(lines[1:-1])
+                # First service per action name; names go to Claude sorted so the
+                # prompt is identical across runs
+                by_name = {}
+                for s in services:
+                    by_name.setdefault(s["name"], s)
+                actions_list = "\n".join(f"- {name}" for name in sorted(by_name))
+
+                prompt = _format_rank_prompt({
+                    "clothing_type": ct_name,
+                    "material": mat_name,
+                    "service_name": svc_name,
+                    "actions_list": actions_list,
+                })
 
-                top_names = json.loads(response_text)
+                try:
+                    message = ai_client.messages.create(
+                        model="claude-sonnet-4-5-20250929",
+                        max_tokens=256,
+                        messages=[{"role": "user", "content": prompt}],
+                    )
+                    response_text = message.content[0].text.strip()
 
-                # Handle empty array (Claude says no actions apply)
-                if not top_names:
-                    rankings[ranking_key] = []
-                    continue
+                    # Parse JSON (handle markdown code blocks)
+                    top_names = json.loads(strip_code_fence(response_text))
 
-                # Match names back to service objects (keep first match for dupes)
-                top_actions = []
-                seen_names = set()
-                for name in top_names:
-                    if name in seen_names:
+                    # Handle empty array (Claude says no actions apply)
+                    if not top_names:
+                        rankings[ranking_key] = []
                         continue
-                    for s in services:
-                        if s["name"] == name and s["id"] not in {a["id"] for a in top_actions}:
+
+                    # Match names back to service objects (keep first match for dupes)
+                    top_actions = []
+                    for name in dict.fromkeys(top_names):
+                        s = by_name.get(name)
+                        if s is not None:
                             top_actions.append({
                                 "id": s["id"],
                                 "name": s["name"],
                                 "price": s.get("price"),
                             })
-                            seen_names.add(name)
-                            break
 
-                rankings[ranking_key] = top_actions[:10]
+                    rankings[ranking_key] = top_actions[:10]
 
-            except json.JSONDecodeError:
-                # Claude likely returned text like "None of these apply" — treat as empty
-                logger.info("No applicable actions for ct=%s mat=%s svc=%s (non-JSON response)",
-                           ct_id, mat_id, svc_name)
-                rankings[ranking_key] = []
-            except Exception as e:
-                logger.warning("Failed to rank actions for ct=%s mat=%s svc=%s: %s",
-                              ct_id, mat_id, svc_name, e)
-                rankings[ranking_key] = []
-                errors += 1
+                except json.JSONDecodeError:
+                    # Claude likely returned text like "None of these apply" — treat as empty
+                    logger.info("No applicable actions for ct=%s mat=%s svc=%s (non-JSON response)",
+                               ct_id, mat_id, svc_name)
+                    rankings[ranking_key] = []
+                except Exception as e:
+                    logger.warning("Failed to rank actions for ct=%s mat=%s svc=%s: %s",
+                                  ct_id, mat_id, svc_name, e)
+                    rankings[ranking_key] = []
+                    errors += 1
 
-        # Use a fresh connection for each persist to avoid timeout
+            pending.append((ct_id, ct_name, mat_id, mat_name, rankings,
+                            persist_pool.submit(_persist, ct_id, mat_id, rankings)))
+
+    for ct_id, ct_name, mat_id, mat_name, rankings, future in pending:
         try:
-            wc = get_write_db()
-            upsert_action_ranking(wc, ct_id, mat_id, rankings)
-            wc.close()
+            future.result()
             ranked += 1
             logger.info("Ranked ct=%s (%s) mat=%s (%s): %d categories",
                        ct_id, ct_name, mat_id, mat_name,
@@ -2190,7 +2842,8 @@ def remap_suggestions():
 
     for row in all_rows:
         brand_name = row["brand"]
-        slug = BRAND_SLUG.get(brand_name, brand_name.lower().replace(" ", ""))
+        # Rows are limited to known_brands, which all have a slug
+        slug = BRAND_SLUG[brand_name]
         if brand_filter and slug != brand_filter:
             continue
 
@@ -2249,8 +2902,7 @@ def remap_suggestions():
         return jsonify({"error": "ANTHROPIC_API_KEY not configured"}), 500
 
     try:
-        client = anthropic.Anthropic(api_key=api_key)
-        message = client.messages.create(
+        message = get_ai_client().messages.create(
             model="claude-sonnet-4-5-20250929",
             max_tokens=4096,
             messages=[{"role": "user", "content": prompt}],
@@ -2258,21 +2910,18 @@ def remap_suggestions():
         response_text = message.content[0].text.strip()
 
         # Parse JSON (handle markdown code blocks)
-        if response_text.startswith("```"):
-            lines = response_text.split("\n")
-            response_text = "\n".join(lines[1:-1])
-
-        result = json.loads(response_text)
+        result = orjson.loads(strip_code_fence(response_text))
 
-        # Enrich suggestions with product counts
+        # Enrich suggestions with product counts (case-insensitive match;
+        # the first value wins when several differ only by case)
+        by_lower = {}
+        for orig_val, info in unmapped_items.items():
+            by_lower.setdefault(orig_val.lower(), info)
         for s in result.get("suggestions", []):
-            from_val = s.get("from", "")
-            # Try case-insensitive match
-            for orig_val, info in unmapped_items.items():
-                if orig_val.lower() == from_val.lower():
-                    s["products_affected"] = info["count"]
-                    s["brands"] = sorted(info["brands"])
-                    break
+            info = by_lower.get(s.get("from", "").lower())
+            if info is not None:
+                s["products_affected"] = info["count"]
+                s["brands"] = sorted(info["brands"])
 
         return jsonify(result)
 
@@ -2334,8 +2983,6 @@ def remap_apply():
     if brand and brand not in BRAND_ROUTES:
         return jsonify({"error": f"Unknown brand: {brand}"}), 400
 
-    valid_materials = {"Standard textile", "Linen/Wool", "Cashmere", "Silk",
-                       "Leather/Suede", "Down", "Fur", "Other/Unsure"}
     applied = []
     errors = []
 
@@ -2369,7 +3016,7 @@ def remap_apply():
                     applied.append({"from": from_val, "to": to_val, "type": "exact_rule"})
 
         elif rule_type == "material":
-            if to_val not in valid_materials:
+            if to_val not in VALID_MAPPING_MATERIALS:
                 errors.append({"from": from_val, "error": f"Invalid material: '{to_val}'"})
                 continue
             if brand:
@@ -2382,6 +3029,9 @@ def remap_apply():
         else:
             errors.append({"from": from_val, "error": f"Invalid rule_type: '{rule_type}'"})
 
+    if applied:
+        _product_responses.clear()
+        _verify_mapping.cache_clear()
     return jsonify({
         "applied": applied,
         "applied_count": len(applied),
@@ -2432,6 +3082,7 @@ def _run_scrapers(brands):
         slug, status, msg = _run_scraper_brand(slug)
         _scraper_status["results"][slug] = {"status": status, "message": msg}
         logger.info("Scraper %s: %s — %s", slug, status, msg)
+    _product_responses.clear()
     _scraper_status["running"] = False
     _scraper_status["last_run"] = _time.strftime("%Y-%m-%dT%H:%M:%SZ", _time.gmtime())
 
@@ -2446,7 +3097,7 @@ def trigger_scrape():
     """
     if _admin_token:
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        if token != _admin_token:
+        if not hmac.compare_digest(token.encode(), _admin_token.encode()):
             return jsonify({"error": "Unauthorized"}), 401
 
     if _scraper_status["running"]:
@@ -2549,7 +3200,8 @@ def _get_filtered_actions(product_row):
         if product_text:
             svc_cats = catalog.services.get((ct_id, mat_id), [])
             if svc_cats:
-                top_actions = _inject_keyword_actions(top_actions, product_text, svc_cats, ct_id=ct_id)
+                top_actions = _inject_keyword_actions(top_actions, product_text, svc_cats,
+                                                      ct_id=ct_id, mat_id=mat_id)
 
     return top_actions
 
@@ -2565,7 +3217,7 @@ def _build_service_url(base_url, actions):
     return base_url + sep + "services_id=" + ids
 
 
-@app.route("/widget/<brand_slug>/product/<product_id>")
+@app.route("/widget/<brand:brand_slug>/product/<product_id>")
 def widget_product(brand_slug, product_id):
     """Return service URLs for a product (public, no auth).
 
@@ -2601,9 +3253,6 @@ def widget_product(brand_slug, product_id):
       404:
         description: Unknown brand or product not found
     """
-    if brand_slug not in BRAND_ROUTES:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
-
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
@@ -2640,6 +3289,25 @@ def widget_product(brand_slug, product_id):
 
 WIDGET_CURRENT_VERSION = "v1"
 
+# Precompressed variants produced at image build time (see Dockerfile), best first.
+_WIDGET_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _send_widget_js(filename, max_age):
+    """Send a widget script, preferring a precompressed sibling the client accepts."""
+    for encoding, suffix in _WIDGET_ENCODINGS:
+        if encoding in request.accept_encodings and os.path.exists(
+                os.path.join(WIDGET_DIR, filename + suffix)):
+            resp = send_from_directory(WIDGET_DIR, filename + suffix,
+                                       mimetype="application/javascript", max_age=max_age)
+            resp.headers["Content-Encoding"] = encoding
+            break
+    else:
+        resp = send_from_directory(WIDGET_DIR, filename,
+                                   mimetype="application/javascript", max_age=max_age)
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
 
 @app.route("/widget.js")
 def widget_js():
@@ -2653,8 +3321,7 @@ def widget_js():
       200:
         description: Widget JavaScript file
     """
-    resp = send_from_directory(WIDGET_DIR, f"widget.{WIDGET_CURRENT_VERSION}.js",
-                               mimetype="application/javascript")
+    resp = _send_widget_js(f"widget.{WIDGET_CURRENT_VERSION}.js", max_age=300)
     resp.headers["Cache-Control"] = "public, max-age=300"
     return resp
 
@@ -2683,15 +3350,15 @@ def widget_js_versioned(version):
     path = os.path.join(WIDGET_DIR, filename)
     if not os.path.exists(path):
         return jsonify({"error": f"Unknown widget version: {version}"}), 404
-    resp = send_from_directory(WIDGET_DIR, filename, mimetype="application/javascript")
-    resp.headers["Cache-Control"] = "public, max-age=86400"
+    resp = _send_widget_js(filename, max_age=31536000)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
     return resp
 
 
 @app.route("/demo")
 @app.route("/demo/")
 def widget_demo():
-    return send_from_directory(os.path.join(WIDGET_DIR, "demo"), "index.html")
+    return send_from_directory(os.path.join(WIDGET_DIR, "demo"), "index.html", max_age=300)
 
 
 @app.route("/demo/example")
@@ -2700,13 +3367,10 @@ def widget_example():
     return send_from_directory(os.path.join(WIDGET_DIR, "demo"), "example.html")
 
 
-@app.route("/demo/<brand_slug>")
-@app.route("/demo/<brand_slug>/")
+@app.route("/demo/<brand:brand_slug>")
+@app.route("/demo/<brand:brand_slug>/")
 def brand_demo(brand_slug):
     """Serve brand-specific demo page."""
-    allowed = {"kappahl", "ginatricot", "lindex", "eton", "nudie"}
-    if brand_slug not in allowed:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
     return send_from_directory(os.path.join(WIDGET_DIR, "demo"), f"{brand_slug}.html")
 
 
@@ -2722,16 +3386,13 @@ def docs_page():
     return send_from_directory(DOCS_DIR, "index.html")
 
 
-@app.route("/docs/brand/<brand_slug>")
-@app.route("/docs/brand/<brand_slug>/")
+@app.route("/docs/brand/<brand:brand_slug>")
+@app.route("/docs/brand/<brand:brand_slug>/")
 def docs_brand_page(brand_slug):
-    allowed = {"kappahl", "ginatricot", "lindex", "eton", "nudie"}
-    if brand_slug not in allowed:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
     return send_from_directory(DOCS_DIR, "brand.html")
 
 
-@app.route("/docs/brand/<brand_slug>/products")
+@app.route("/docs/brand/<brand:brand_slug>/products")
 def docs_brand_products(brand_slug):
     """Return products for a brand with their mappings.
 
@@ -2744,9 +3405,7 @@ def docs_brand_products(brand_slug):
       q         – search term (matches product_name or product_id)
       category  – filter by category (dam/herr/barn/baby, case-insensitive prefix)
     """
-    brand_name = BRAND_ROUTES.get(brand_slug)
-    if not brand_name:
-        return jsonify({"error": f"Unknown brand: {brand_slug}"}), 404
+    brand_name = BRAND_ROUTES[brand_slug]
 
     limit = min(int(request.args.get("limit", 50)), 500)
     offset = int(request.args.get("offset", 0))
@@ -2807,7 +3466,7 @@ def docs_brand_products(brand_slug):
             ORDER BY qfix_url IS NULL, product_name
             LIMIT %s OFFSET %s
         """, params + [limit, offset])
-        products = [dict(r) for r in cur.fetchall()]
+        products = cur.fetchall()
 
         # Clothing type distribution (always unfiltered)
         cur.execute("""
@@ -2817,7 +3476,7 @@ def docs_brand_products(brand_slug):
             GROUP BY qfix_clothing_type
             ORDER BY cnt DESC
         """, (brand_name,))
-        type_dist = [dict(r) for r in cur.fetchall()]
+        type_dist = cur.fetchall()
 
         # Material distribution (always unfiltered)
         cur.execute("""
@@ -2827,7 +3486,7 @@ def docs_brand_products(brand_slug):
             GROUP BY qfix_material
             ORDER BY cnt DESC
         """, (brand_name,))
-        material_dist = [dict(r) for r in cur.fetchall()]
+        material_dist = cur.fetchall()
 
         # Unmapped categories
         cur.execute("""
@@ -2837,7 +3496,7 @@ def docs_brand_products(brand_slug):
             GROUP BY clothing_type
             ORDER BY cnt DESC
         """, (brand_name,))
-        unmapped = [dict(r) for r in cur.fetchall()]
+        unmapped = cur.fetchall()
 
     conn.close()
 
@@ -2856,6 +3515,25 @@ def docs_brand_products(brand_slug):
     })
 
 
+@functools.lru_cache(maxsize=4096)
+def _verify_mapping(brand_slug, ct_input, mat_input, cat_input, product_name, description):
+    """Live mapping steps for /docs/verify, memoized on the mapper inputs.
+
+    Cleared whenever /unmapped/add or /remap/apply change the mapping tables.
+    """
+    ct_result = map_clothing_type(ct_input, brand=brand_slug, product_name=product_name, description=description)
+    mat_result = map_material(mat_input, brand=brand_slug)
+    subcat = map_category(cat_input)
+
+    ct_id = _resolve_clothing_type_id(ct_result, subcat) if ct_result else None
+    mat_id = _resolve_material_id(ct_id, mat_result) if ct_id and mat_result else None
+
+    live_url = None
+    if ct_id and mat_id:
+        live_url = f"https://kappahl.dev.qfixr.me/sv/?subitem_id={ct_id}&material_id={mat_id}"
+    return ct_result, mat_result, subcat, ct_id, mat_id, live_url
+
+
 @app.route("/docs/verify/<product_id>")
 def docs_verify(product_id):
     """Verify the QFix mapping for a product, showing each step.
@@ -2891,7 +3569,7 @@ def docs_verify(product_id):
     if not row:
         return jsonify({"error": f"Product {product_id} not found"}), 404
 
-    product = dict(row)
+    product = row
     brand_slug = BRAND_SLUG.get(product.get("brand"))
 
     # Run live mapping to show each step
@@ -2899,16 +3577,10 @@ def docs_verify(product_id):
     mat_input = product.get("material_composition")
     cat_input = product.get("category")
 
-    ct_result = map_clothing_type(ct_input, brand=brand_slug, product_name=product.get("product_name"), description=product.get("description"))
-    mat_result = map_material(mat_input, brand=brand_slug)
-    subcat = map_category(cat_input)
-
-    ct_id = _resolve_clothing_type_id(ct_result, subcat) if ct_result else None
-    mat_id = _resolve_material_id(ct_id, mat_result) if ct_id and mat_result else None
-
-    live_url = None
-    if ct_id and mat_id:
-        live_url = f"https://kappahl.dev.qfixr.me/sv/?subitem_id={ct_id}&material_id={mat_id}"
+    ct_result, mat_result, subcat, ct_id, mat_id, live_url = _verify_mapping(
+        brand_slug, ct_input, mat_input, cat_input,
+        product.get("product_name"), product.get("description"),
+    )
 
     # Check persisted vs live
     persisted_url = product.get("qfix_url")
@@ -2966,30 +3638,14 @@ def docs_verify(product_id):
                 catalog.load()
                 svc_cats = catalog.services.get((ct_id, mat_id), [])
                 if svc_cats:
-                    top_actions = _inject_keyword_actions(top_actions, product_text, svc_cats, ct_id=ct_id)
+                    top_actions = _inject_keyword_actions(top_actions, product_text, svc_cats,
+                                                          ct_id=ct_id, mat_id=mat_id)
     else:
         top_actions = _get_filtered_actions(product)
 
     # Fallback: if no rankings persisted, use first 5 unique per service category
     if not top_actions and enriched.get("qfix_services"):
-        service_slug_to_key = {
-            "repair": "repair", "adjustment": "adjustment",
-            "washing": "care", "customize": "other",
-        }
-        for svc_cat in enriched["qfix_services"]:
-            svc_slug = svc_cat.get("slug", "")
-            for slug_part, key in service_slug_to_key.items():
-                if slug_part in svc_slug:
-                    seen = set()
-                    actions = []
-                    for s in svc_cat.get("services", []):
-                        if s["name"] not in seen:
-                            actions.append({"id": s["id"], "name": s["name"], "price": s.get("price")})
-                            seen.add(s["name"])
-                        if len(actions) >= 5:
-                            break
-                    top_actions[key] = actions
-                    break
+        top_actions = dict(catalog.default_actions.get((ct_id, mat_id), {}))
 
     return jsonify({
         "product": {
@@ -3047,15 +3703,12 @@ def docs_rankings():
         mat_id = row["material_id"]
         ct_name = catalog.items.get(ct_id, {}).get("name", f"Unknown ({ct_id})")
         mat_name = catalog.subitems.get(mat_id, {}).get("name", f"Unknown ({mat_id})")
-        rankings = row["rankings"]
-        if isinstance(rankings, str):
-            rankings = json.loads(rankings)
         results.append({
             "clothing_type_id": ct_id,
             "clothing_type_name": ct_name,
             "material_id": mat_id,
             "material_name": mat_name,
-            "rankings": rankings,
+            "rankings": row["rankings"],
         })
 
     return jsonify(results)
@@ -3067,20 +3720,18 @@ def docs_missing_services():
     catalog.load()
 
     missing = []
-    for (ct_id, mat_id), svc_cats in catalog.services.items():
-        total_actions = sum(len(cat.get("services", [])) for cat in svc_cats)
-        if total_actions == 0:
-            ct_info = catalog.items.get(ct_id, {})
-            mat_info = catalog.subitems.get(mat_id, {})
-            parent = ct_info.get("parent", {})
-            missing.append({
-                "clothing_type_id": ct_id,
-                "clothing_type_name": ct_info.get("name", f"Unknown ({ct_id})"),
-                "parent_category": parent.get("name", "Unknown"),
-                "material_id": mat_id,
-                "material_name": mat_info.get("name", f"Unknown ({mat_id})"),
-                "service_categories": len(svc_cats),
-            })
+    for ct_id, mat_id in catalog.empty_combos:
+        ct_info = catalog.items.get(ct_id, {})
+        mat_info = catalog.subitems.get(mat_id, {})
+        parent = ct_info.get("parent", {})
+        missing.append({
+            "clothing_type_id": ct_id,
+            "clothing_type_name": ct_info.get("name", f"Unknown ({ct_id})"),
+            "parent_category": parent.get("name", "Unknown"),
+            "material_id": mat_id,
+            "material_name": mat_info.get("name", f"Unknown ({mat_id})"),
+            "service_categories": len(catalog.services[(ct_id, mat_id)]),
+        })
 
     # Group by clothing type for summary
     by_type = {}
@@ -3323,7 +3974,6 @@ def api_catalog_gaps(brand_slug=None):
         return ai_action_ids
 
     # Cache blocked services per (ct_id, mat_id)
-    slug_map = {"repair": "repair", "adjustment": "adjustment", "washing": "care"}
     blocked_cache = {}
 
     def get_blocked_services(ct_id, mat_id):
@@ -3333,13 +3983,8 @@ def api_catalog_gaps(brand_slug=None):
         svc_cats = catalog.services.get(key, [])
         blocked = {}  # action_id -> info
         for svc_cat in svc_cats:
-            svc_slug = svc_cat.get("slug", "")
-            cat_key = None
-            for slug_part, cat in slug_map.items():
-                if slug_part in svc_slug:
-                    cat_key = cat
-                    break
-            if not cat_key:
+            cat_key = service_key_for_slug(svc_cat.get("slug", ""))
+            if cat_key is None or cat_key == "other":
                 continue
             for s in svc_cat.get("services", []):
                 action_id = s["id"]
@@ -3467,6 +4112,295 @@ def docs_keyword_stats():
     })
 
 
+# Concurrent Claude requests per keyword validation run
+VALIDATE_MAX_CONCURRENCY = 8
+VALIDATE_SAMPLES_PER_RULE = 2
+# Attempts on 429/5xx/connection errors; the SDK backs off exponentially
+# with jitter between them
+VALIDATE_MAX_RETRIES = 5
+
+# Output budget per category: five names by default, the whole pool with ?full=1
+VALIDATE_TOP5_MAX_TOKENS = 80
+VALIDATE_FULL_MAX_TOKENS = 512
+
+# Claude's answer for a validation prompt, keyed by a digest of the prompt.
+# The prompt is a pure function of the product fields and candidate pool, so
+# re-validating an unchanged product reuses the earlier answer.
+_validation_responses = _LRUCache(maxsize=4096)
+
+
+def _prompt_digest(prompt):
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+
+VALIDATE_RANKING_PROMPT = """For a specific product: "{product_name}" ({clothing_type} made of {material}).
+
+Product description: {description}
+
+For each category below, rank its actions by how likely a customer owning THIS SPECIFIC product would need them. Consider the product's specific features mentioned in the name and description.
+
+{blocks}
+
+Return ONLY a JSON object mapping each category to an array of its action names ordered by likelihood (most likely first). {scope} Example: {{"repair": ["Repair seam", "Replace button"]}}"""
+_format_validate_prompt = VALIDATE_RANKING_PROMPT.format_map
+
+_VALIDATE_PRODUCT_COLUMNS = """id, product_id, product_name, description, brand,
+                       clothing_type, material_composition,
+                       qfix_clothing_type, qfix_clothing_type_id,
+                       qfix_material, qfix_material_id"""
+
+
+def _sample_keyword_products(conn, samples_per_rule):
+    """Return {rule_idx: [product rows]} of random mapped products per keyword rule.
+
+    One scan: each mapped product is tagged with the indexes of the rules it
+    triggers, then random rows are picked within each rule.
+    """
+    rule_cases = []
+    params = []
+    for rule_idx, rule in enumerate(KEYWORD_ACTION_RULES):
+        conditions = []
+        for kw in rule["keywords"]:
+            conditions.append("(LOWER(product_name) LIKE %s OR LOWER(description) LIKE %s)")
+            params.extend([f"%{kw}%", f"%{kw}%"])
+        rule_cases.append(f"CASE WHEN {' OR '.join(conditions)} THEN {rule_idx} END")
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""
+            WITH tagged AS (
+                SELECT {_VALIDATE_PRODUCT_COLUMNS},
+                       unnest(ARRAY_REMOVE(ARRAY[{", ".join(rule_cases)}], NULL)) AS rule_idx
+                FROM products_unified
+                WHERE qfix_clothing_type_id IS NOT NULL
+            )
+            SELECT * FROM (
+                SELECT tagged.*,
+                       row_number() OVER (PARTITION BY rule_idx ORDER BY random()) AS rn
+                FROM tagged
+            ) sampled
+            WHERE rn <= %s
+        """, params + [samples_per_rule])
+        products_by_rule = {}
+        for row in cur.fetchall():
+            products_by_rule.setdefault(row["rule_idx"], []).append(row)
+    return products_by_rule
+
+
+def _keyword_validation_tasks(conn, products_by_rule, full=False):
+    """Group sampled rows by product and build one Claude task per product."""
+    products = {}
+    rules_by_product = {}
+    for rule_idx in range(len(KEYWORD_ACTION_RULES)):
+        for product in products_by_rule.get(rule_idx, []):
+            products[product["id"]] = product
+            rules_by_product.setdefault(product["id"], []).append(rule_idx)
+
+    rankings = get_action_rankings(conn, {
+        (p["qfix_clothing_type_id"], p["qfix_material_id"]) for p in products.values()
+    })
+    tasks = []
+    for row_id, rule_idxs in rules_by_product.items():
+        task = _keyword_validation_task(rankings, products[row_id], rule_idxs, full=full)
+        if task:
+            tasks.append(task)
+    return tasks
+
+
+def _keyword_validation_task(rankings, product, rule_idxs, full=False):
+    """Build the Claude ranking task for one sampled product.
+
+    Every category whose ranking the product's keyword rules change goes into
+    a single prompt. Returns a dict with the product, the rule indexes, the
+    merged actions and rules per category, and the prompt. Returns None when
+    injection changes nothing. rankings is the prefetched
+    {(ct_id, mat_id): rankings} map.
+
+    Claude is asked for the top 5 per category only, which is all the
+    comparison uses; full=True asks for the whole ranked pool instead.
+    """
+    ct_id = product["qfix_clothing_type_id"]
+    mat_id = product["qfix_material_id"]
+
+    # Get AI-ranked top 5
+    ai_top = rankings.get((ct_id, mat_id)) or {}
+    if not ai_top:
+        return None
+
+    # Get the full service list for this clothing type
+    svc_cats = catalog.services.get((ct_id, mat_id), [])
+    if not svc_cats:
+        return None
+
+    # Build product text and run keyword injection
+    product_text = " ".join(filter(None, [
+        product.get("product_name", ""),
+        product.get("description", ""),
+        product.get("clothing_type", ""),
+    ])).lower()
+
+    # Skip the injection pass entirely when none of the rules actually match
+    rule_idxs = [rule_idx for rule_idx in rule_idxs
+                 if _KEYWORD_ACTION_PATTERNS[rule_idx].search(product_text)]
+    if not rule_idxs:
+        return None
+
+    merged = _inject_keyword_actions(ai_top, product_text, svc_cats, ct_id=ct_id, mat_id=mat_id)
+
+    categories = {}
+    for rule_idx in rule_idxs:
+        category = KEYWORD_ACTION_RULES[rule_idx]["category"]
+        if category in categories:
+            categories[category]["rules"].append(rule_idx)
+            continue
+
+        ai_actions = ai_top.get(category, [])
+        if not ai_actions:
+            continue
+        merged_actions = merged.get(category, [])
+
+        # Check if injection actually changed the list
+        ai_names = {a["name"] for a in ai_actions}
+        merged_names = {a["name"] for a in merged_actions}
+        if ai_names == merged_names:
+            continue  # No injection happened
+
+        # Merged pool first, then AI actions that got bumped out
+        all_candidates = list(dict.fromkeys(
+            [a["name"] for a in merged_actions] + [a["name"] for a in ai_actions]
+        ))
+
+        categories[category] = {
+            "merged": merged_actions,
+            "candidates": all_candidates,
+            "rules": [rule_idx],
+        }
+
+    if not categories:
+        return None
+
+    # Ask Claude to rank every changed category for this specific product
+    if full:
+        scope = "Return ALL actions of each category, not just top 5."
+    else:
+        scope = "Return only the TOP 5 actions of each category."
+    blocks = "\n\n".join(
+        f"{category} actions:\n" + "\n".join(f"- {name}" for name in info["candidates"])
+        for category, info in categories.items()
+    )
+    prompt = _format_validate_prompt({
+        "product_name": (product.get("product_name") or "")[:200],
+        "clothing_type": (product.get("qfix_clothing_type") or "")[:100],
+        "material": (product.get("qfix_material") or "")[:100],
+        "description": (product.get("description") or "N/A")[:300],
+        "blocks": blocks,
+        "scope": scope,
+    })
+    return {
+        "product": product,
+        "rule_idxs": rule_idxs,
+        "categories": categories,
+        "full": full,
+        "prompt": prompt,
+    }
+
+
+def _keyword_validation_params(task):
+    """Claude request parameters for one keyword validation task."""
+    return {
+        "model": "claude-sonnet-4-5-20250929",
+        "max_tokens": len(task["categories"]) * (
+            VALIDATE_FULL_MAX_TOKENS if task["full"] else VALIDATE_TOP5_MAX_TOKENS),
+        "messages": [{"role": "user", "content": task["prompt"]}],
+    }
+
+
+def _keyword_comparisons(task, response_text):
+    """Compare our score-based top 5 with Claude's ranking, one row per rule.
+
+    An answer that is not a JSON object (or a bare list for a single
+    category) still yields its rows, with ai_top5 and the overlap fields set
+    to None, so it is reported rather than dropped.
+    """
+    product = task["product"]
+    try:
+        result = orjson.loads(strip_code_fence(response_text.strip()))
+    except orjson.JSONDecodeError:
+        logger.warning("Unparseable validation answer for product %s: %s",
+                      product["product_id"], response_text[:200])
+        result = None
+    if isinstance(result, list) and len(task["categories"]) == 1:
+        result = {next(iter(task["categories"])): result}
+    elif not isinstance(result, dict):
+        result = None
+
+    comparisons = []
+    for category, info in task["categories"].items():
+        our_top5 = [a["name"] for a in info["merged"][:5]]
+        if result is None:
+            ai_ranking = ai_top5 = overlap = only_ours = only_ai = None
+        else:
+            ai_ranking = result.get(category)
+            if not isinstance(ai_ranking, list):
+                continue
+            # Action names only; anything else can't be compared or sorted
+            ai_ranking = [name for name in ai_ranking if isinstance(name, str)]
+
+            # Compare: our score-based top 5 vs AI's top 5
+            ai_top5 = ai_ranking[:5]
+
+            # Calculate overlap and position differences (sorted so the JSON
+            # body is deterministic)
+            our_set = frozenset(our_top5)
+            ai_set = frozenset(ai_top5)
+            overlap = sorted(our_set & ai_set)
+            only_ours = sorted(our_set - ai_set)
+            only_ai = sorted(ai_set - our_set)
+
+        for rule_idx in info["rules"]:
+            comparison = {
+                "product_id": product["product_id"],
+                "product_name": product.get("product_name"),
+                "brand": product.get("brand"),
+                "clothing_type": product.get("qfix_clothing_type"),
+                "keyword_rule": KEYWORD_ACTION_RULES[rule_idx]["keywords"],
+                "category": category,
+                "our_top5": our_top5,
+                "ai_top5": ai_top5,
+                "overlap_count": len(overlap) if overlap is not None else None,
+                "overlap": overlap,
+                "only_in_ours": only_ours,
+                "only_in_ai": only_ai,
+            }
+            if task["full"]:
+                comparison["ai_full_ranking"] = ai_ranking
+            comparisons.append(comparison)
+    return comparisons
+
+
+def _keyword_validation_summary(comparisons):
+    """Response body shared by the synchronous and batch validation routes.
+
+    Rows whose answer could not be parsed are counted separately and left
+    out of the average.
+    """
+    overlaps = [c["overlap_count"] for c in comparisons if c["overlap_count"] is not None]
+    avg_overlap = sum(overlaps) / len(overlaps) if overlaps else 0
+
+    return {
+        "total_comparisons": len(comparisons),
+        "unparsed_comparisons": len(comparisons) - len(overlaps),
+        "avg_overlap_out_of_5": round(avg_overlap, 2),
+        "comparisons": comparisons,
+    }
+
+
+def _batch_custom_id(task):
+    """Batch request id encoding the product row id, rule indexes and ?full flag."""
+    rules = "_".join(str(rule_idx) for rule_idx in task["rule_idxs"])
+    custom_id = f"p{task['product']['id']}-r{rules}"
+    return custom_id + "-full" if task["full"] else custom_id
+
+
 @app.route("/remap/validate-keyword-scores", methods=["POST"])
 @limiter.limit("2 per minute")
 def validate_keyword_scores():
@@ -3475,6 +4409,11 @@ def validate_keyword_scores():
     Picks sample products per keyword rule, builds the merged pool of AI-ranked +
     keyword-injected actions, and asks Claude to rank them for that specific product.
     Compares AI ranking vs our score-based ranking.
+
+    Answers are cached per prompt; pass ?nocache=1 to ask Claude again.
+    Pass ?full=1 to have Claude rank every candidate and include
+    ai_full_ranking in each comparison. Pass ?stream=1 to get NDJSON instead:
+    one comparison per line as Claude answers, then a summary line.
     """
     auth_err = _require_admin()
     if auth_err:
@@ -3484,145 +4423,185 @@ def validate_keyword_scores():
         return jsonify({"error": "ANTHROPIC_API_KEY not configured"}), 500
 
     catalog.load()
-    ai_client = anthropic.Anthropic(api_key=api_key)
+    ai_client = get_ai_client().with_options(max_retries=VALIDATE_MAX_RETRIES)
     conn = get_db()
 
-    samples_per_rule = 2
-    comparisons = []
-
-    for rule in KEYWORD_ACTION_RULES:
-        # Find sample products that trigger this rule and have a qfix mapping
-        conditions = []
-        params = []
-        for kw in rule["keywords"]:
-            conditions.append("(LOWER(product_name) LIKE %s OR LOWER(description) LIKE %s)")
-            params.extend([f"%{kw}%", f"%{kw}%"])
+    # Build every prompt first, then ask Claude for all of them concurrently
+    products_by_rule = _sample_keyword_products(conn, VALIDATE_SAMPLES_PER_RULE)
+    tasks = _keyword_validation_tasks(conn, products_by_rule,
+                                      full=request.args.get("full") == "1")
+    # Everything Claude needs is in the tasks; don't hold the connection
+    # through the API calls
+    conn.close()
 
-        where = " OR ".join(conditions)
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(f"""
-                SELECT product_id, product_name, description, brand,
-                       clothing_type, material_composition,
-                       qfix_clothing_type, qfix_clothing_type_id,
-                       qfix_material, qfix_material_id
-                FROM products_unified
-                WHERE ({where}) AND qfix_clothing_type_id IS NOT NULL
-                ORDER BY RANDOM()
-                LIMIT %s
-            """, params + [samples_per_rule])
-            products = cur.fetchall()
+    use_cache = request.args.get("nocache") != "1"
 
-        for product in products:
-            ct_id = product["qfix_clothing_type_id"]
-            mat_id = product["qfix_material_id"]
+    # Products with identical prompts (the same article listed twice, or the
+    # same name and description across colours) share one Claude call
+    tasks_by_digest = {}
+    for task in tasks:
+        tasks_by_digest.setdefault(_prompt_digest(task["prompt"]), []).append(task)
 
-            # Get AI-ranked top 5
-            ai_top = get_action_ranking(conn, ct_id, mat_id) or {}
-            ai_repair = ai_top.get(rule["category"], [])
+    def _compare(item):
+        digest, same_prompt = item
+        try:
+            response_text = _validation_responses.get(digest) if use_cache else None
+            if response_text is None:
+                message = ai_client.messages.create(**_keyword_validation_params(same_prompt[0]))
+                response_text = message.content[0].text
+            comparisons = []
+            for task in same_prompt:
+                comparisons.extend(_keyword_comparisons(task, response_text))
+            if all(c["ai_top5"] is not None for c in comparisons):
+                _validation_responses.set(digest, response_text)
+            return comparisons
+        except Exception as e:
+            logger.warning("Failed to validate for product %s: %s",
+                          same_prompt[0]["product"]["product_id"], e)
+            return []
+
+    if request.args.get("stream") == "1":
+        def _stream():
+            total = 0
+            ranked = 0
+            overlap_sum = 0
+            if tasks_by_digest:
+                with ThreadPoolExecutor(max_workers=VALIDATE_MAX_CONCURRENCY) as pool:
+                    futures = [pool.submit(_compare, item) for item in tasks_by_digest.items()]
+                    for future in as_completed(futures):
+                        for comparison in future.result():
+                            total += 1
+                            if comparison["overlap_count"] is not None:
+                                ranked += 1
+                                overlap_sum += comparison["overlap_count"]
+                            yield orjson.dumps(comparison, option=_ORJSON_OPTS) + b"\n"
+            yield orjson.dumps({
+                "total_comparisons": total,
+                "unparsed_comparisons": total - ranked,
+                "avg_overlap_out_of_5": round(overlap_sum / ranked, 2) if ranked else 0,
+            }, option=_ORJSON_OPTS) + b"\n"
+
+        return Response(_stream(), mimetype="application/x-ndjson")
 
-            if not ai_repair:
-                continue
+    comparisons = []
+    if tasks_by_digest:
+        with ThreadPoolExecutor(max_workers=VALIDATE_MAX_CONCURRENCY) as pool:
+            for prompt_comparisons in pool.map(_compare, tasks_by_digest.items()):
+                comparisons.extend(prompt_comparisons)
 
-            # Get the full service list for this clothing type
-            svc_cats = catalog.services.get((ct_id, mat_id), [])
-            if not svc_cats:
-                continue
+    return jsonify(_keyword_validation_summary(comparisons))
 
-            # Build product text and run keyword injection
-            product_text = " ".join(filter(None, [
-                product.get("product_name", ""),
-                product.get("description", ""),
-                product.get("clothing_type", ""),
-            ])).lower()
 
-            merged = _inject_keyword_actions(ai_top, product_text, svc_cats, ct_id=ct_id)
-            merged_actions = merged.get(rule["category"], [])
+@app.route("/remap/validate-keyword-scores/batch", methods=["POST"])
+@limiter.limit("2 per minute")
+def validate_keyword_scores_batch():
+    """Submit keyword validation as an Anthropic Message Batch.
 
-            # Check if injection actually changed the list
-            ai_names = {a["name"] for a in ai_repair}
-            merged_names = {a["name"] for a in merged_actions}
-            if ai_names == merged_names:
-                continue  # No injection happened
+    Same sampling and prompts as /remap/validate-keyword-scores, but sent as
+    one batch (half the cost, no request held open). Returns the batch id;
+    collect the comparisons from GET /remap/validate-keyword-scores/batch/<batch_id>.
+    """
+    auth_err = _require_admin()
+    if auth_err:
+        return auth_err
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        return jsonify({"error": "ANTHROPIC_API_KEY not configured"}), 500
 
-            # Collect all candidate action names (merged pool)
-            action_names = [a["name"] for a in merged_actions]
+    catalog.load()
+    conn = get_db()
+    products_by_rule = _sample_keyword_products(conn, VALIDATE_SAMPLES_PER_RULE)
+    tasks = _keyword_validation_tasks(conn, products_by_rule,
+                                      full=request.args.get("full") == "1")
+    conn.close()
 
-            # Also include AI actions that got bumped out
-            all_candidates = list(action_names)
-            for a in ai_repair:
-                if a["name"] not in all_candidates:
-                    all_candidates.append(a["name"])
+    if not tasks:
+        return jsonify({"batch_id": None, "requests": 0})
 
-            # Ask Claude to rank these for this specific product
-            actions_list = "\n".join(f"- {name}" for name in all_candidates)
-            prompt = f"""For a specific product: "{product.get('product_name', '')}" ({product.get('qfix_clothing_type', '')} made of {product.get('qfix_material', '')}).
+    batch = get_ai_client().messages.batches.create(requests=[
+        {"custom_id": _batch_custom_id(task), "params": _keyword_validation_params(task)}
+        for task in tasks
+    ])
+    return jsonify({
+        "batch_id": batch.id,
+        "status": batch.processing_status,
+        "requests": len(tasks),
+    }), 202
 
-Product description: {(product.get('description') or 'N/A')[:300]}
 
-Rank these {rule['category']} actions by how likely a customer owning THIS SPECIFIC product would need them. Consider the product's specific features mentioned in the name and description.
+@app.route("/remap/validate-keyword-scores/batch/<batch_id>")
+def validate_keyword_scores_batch_results(batch_id):
+    """Collect the comparisons of a keyword validation batch.
 
-Available actions:
-{actions_list}
+    While the batch is still processing, returns its status and request
+    counts. Once it has ended, rebuilds each task from the current rankings
+    and returns the same body as /remap/validate-keyword-scores.
+    """
+    auth_err = _require_admin()
+    if auth_err:
+        return auth_err
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        return jsonify({"error": "ANTHROPIC_API_KEY not configured"}), 500
 
-Return ONLY a JSON array of the action names ordered by likelihood (most likely first). Return ALL of them, not just top 5."""
+    ai_client = get_ai_client()
+    batch = ai_client.messages.batches.retrieve(batch_id)
+    if batch.processing_status != "ended":
+        counts = batch.request_counts
+        return jsonify({
+            "batch_id": batch.id,
+            "status": batch.processing_status,
+            "request_counts": {
+                "processing": counts.processing,
+                "succeeded": counts.succeeded,
+                "errored": counts.errored,
+                "canceled": counts.canceled,
+                "expired": counts.expired,
+            },
+        })
 
-            try:
-                message = ai_client.messages.create(
-                    model="claude-sonnet-4-5-20250929",
-                    max_tokens=512,
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                response_text = message.content[0].text.strip()
-                if response_text.startswith("```"):
-                    lines = response_text.split("\n")
-                    response_text = "\n".join(lines[1:-1])
-
-                ai_ranking = json.loads(response_text)
-
-                # Compare: our score-based top 5 vs AI's top 5
-                our_top5 = [a["name"] for a in merged_actions[:5]]
-                ai_top5 = ai_ranking[:5]
-
-                # Calculate overlap and position differences
-                our_set = set(our_top5)
-                ai_set = set(ai_top5)
-                overlap = our_set & ai_set
-                only_ours = our_set - ai_set
-                only_ai = ai_set - our_set
-
-                comparisons.append({
-                    "product_id": product["product_id"],
-                    "product_name": product.get("product_name"),
-                    "brand": product.get("brand"),
-                    "clothing_type": product.get("qfix_clothing_type"),
-                    "keyword_rule": rule["keywords"],
-                    "category": rule["category"],
-                    "our_top5": our_top5,
-                    "ai_top5": ai_top5,
-                    "ai_full_ranking": ai_ranking,
-                    "overlap_count": len(overlap),
-                    "overlap": list(overlap),
-                    "only_in_ours": list(only_ours),
-                    "only_in_ai": list(only_ai),
-                })
+    responses = {}
+    for entry in ai_client.messages.batches.results(batch_id):
+        if entry.result.type == "succeeded":
+            responses[entry.custom_id] = entry.result.message.content[0].text
+        else:
+            logger.warning("Batch request %s did not succeed: %s",
+                          entry.custom_id, entry.result.type)
 
-            except Exception as e:
-                logger.warning("Failed to validate for product %s: %s",
-                              product["product_id"], e)
+    keys = []
+    for custom_id in responses:
+        product_part, rules_part, *flags = custom_id.split("-")
+        keys.append((custom_id, int(product_part[1:]),
+                     [int(r) for r in rules_part[1:].split("_")], "full" in flags))
 
+    catalog.load()
+    conn = get_db()
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"SELECT {_VALIDATE_PRODUCT_COLUMNS} FROM products_unified WHERE id = ANY(%s)",
+                    ([row_id for _, row_id, _, _ in keys],))
+        products = {row["id"]: row for row in cur.fetchall()}
+    rankings = get_action_rankings(conn, {
+        (p["qfix_clothing_type_id"], p["qfix_material_id"]) for p in products.values()
+    })
     conn.close()
 
-    # Summary stats
-    if comparisons:
-        avg_overlap = sum(c["overlap_count"] for c in comparisons) / len(comparisons)
-    else:
-        avg_overlap = 0
+    comparisons = []
+    for custom_id, row_id, rule_idxs, full in keys:
+        product = products.get(row_id)
+        task = _keyword_validation_task(rankings, product, rule_idxs, full=full) if product else None
+        if not task:
+            continue
+        response_text = responses[custom_id]
+        try:
+            task_comparisons = _keyword_comparisons(task, response_text)
+            comparisons.extend(task_comparisons)
+            if all(c["ai_top5"] is not None for c in task_comparisons):
+                _validation_responses.set(_prompt_digest(task["prompt"]), response_text)
+        except Exception as e:
+            logger.warning("Failed to validate for product %s: %s",
+                          product["product_id"], e)
 
-    return jsonify({
-        "total_comparisons": len(comparisons),
-        "avg_overlap_out_of_5": round(avg_overlap, 2),
-        "comparisons": comparisons,
-    })
+    return jsonify(_keyword_validation_summary(comparisons))
 
 
 # ── Shop demo pages ───────────────────────────────────────────────────────
@@ -3639,8 +4618,6 @@ def shop_kappahl_product(product_id):
 
 
 if __name__ == "__main__":
-    from dotenv import load_dotenv
-    load_dotenv()
-    import database
-    database.DATABASE_URL = os.environ.get("DATABASE_URL")
-    app.run(debug=True, port=8000)
+    # Local development only; production serves wsgi:app from gunicorn gevent
+    # workers configured in gunicorn.conf.py (see Dockerfile)
+    app.run(debug=True, port=8000, threaded=True)
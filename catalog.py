@@ -7,6 +7,8 @@ that was previously spread across module-level globals in api.py.
 import json
 import logging
 import os
+import threading
+import time
 
 import requests as http_requests
 
@@ -17,58 +19,113 @@ QFIX_CATEGORIES_URL = "https://dev.qfixr.me/wp-json/qfix/v1/product-categories?p
 # Service key -> slug fragment mapping (used for matching L5 categories)
 _SLUG_MAP = {"repair": "repair", "adjustment": "adjustment", "care": "washing"}
 
-
-class QFixCatalog:
-    """QFix category tree and service filtering.
-
-    Loads the catalog from the QFix API on first call to load(),
-    then provides filtering and enrichment methods.
+# L5 slug fragment -> service key, checked in this order
+SERVICE_SLUG_KEYS = {
+    "repair": "repair",
+    "adjustment": "adjustment",
+    "washing": "care",
+    "customize": "other",
+}
+
+# Actions listed per service key when no AI ranking exists for a combo
+DEFAULT_ACTIONS_PER_KEY = 5
+
+# Seconds between background catalog refreshes; 0 disables the refresher
+CATALOG_REFRESH_SECONDS = int(os.environ.get("QFIX_CATALOG_REFRESH_SECONDS", "600"))
+
+
+def service_key_for_slug(slug):
+    """Return the service key (repair/adjustment/care/other) for an L5 slug."""
+    for slug_part, key in SERVICE_SLUG_KEYS.items():
+        if slug_part in slug:
+            return key
+    return None
+
+
+def index_actions_by_name(svc_cats):
+    """Return {action name: [{id, name, price, category_key}]} for a combo's services."""
+    actions = {}
+    for svc_cat in svc_cats:
+        key = service_key_for_slug(svc_cat.get("slug", ""))
+        if not key:
+            continue
+        for s in svc_cat.get("services", []):
+            actions.setdefault(s["name"], []).append({
+                "id": s["id"], "name": s["name"],
+                "price": s.get("price"), "category_key": key,
+            })
+    return actions
+
+
+class _CatalogSnapshot:
+    """One fetched catalog together with the lookup tables derived from it.
+
+    QFixCatalog publishes a new snapshot with a single attribute assignment,
+    so a reader holding one always sees services and indexes that belong
+    together. Snapshots are not modified once published.
     """
 
-    def __init__(self):
-        self.items = {}            # L3 clothing types: {id: {name, slug, link, parent}}
-        self.subitems = {}         # L4 materials: {id: {name, slug, link}}
-        self.services = {}         # {(L3_id, L4_id): [service_categories]}
-        self.assigned_categories = {}  # {action_id: set(L3 category IDs)}
-        self._loaded = False
-
-        # Legacy allowlist filter
-        self._allowed_services = {}  # {ct_id_str: {mat_id_str: {svc_key: [{id, name}]}}}
-
-        # Filter strategy from env
-        self.filter_mode = os.environ.get("QFIX_SERVICE_FILTER", "assigned_categories")
-        if os.environ.get("QFIX_FILTER_SERVICES") == "0":
-            self.filter_mode = "off"
-
-    @property
-    def loaded(self):
-        return self._loaded
-
-    def load(self):
-        """Fetch the QFix category tree and build lookup dicts. Idempotent."""
-        if self._loaded:
-            return
-        try:
-            resp = http_requests.get(QFIX_CATEGORIES_URL, timeout=30)
-            resp.raise_for_status()
-            tree = resp.json()
-        except Exception as e:
-            logger.warning("Failed to fetch QFix catalog: %s", e)
-            return
-
+    def __init__(self, items=None, subitems=None, services=None, assigned_categories=None):
+        self.items = items or {}            # L3 clothing types: {id: {name, slug, link, parent}}
+        self.subitems = subitems or {}      # L4 materials: {id: {name, slug, link}}
+        self.services = services or {}      # {(L3_id, L4_id): [service_categories]}
+        self.assigned_categories = assigned_categories or {}  # {action_id: set(L3 category IDs)}
+
+        # [(L3_id, L4_id)] whose categories hold no actions
+        self.empty_combos = [
+            key for key, svc_cats in self.services.items()
+            if not any(cat.get("services") for cat in svc_cats)
+        ]
+
+        # {(L3_id, L4_id): {svc_key: [first unique actions]}}
+        self.default_actions = {}
+        for combo, svc_cats in self.services.items():
+            by_key = {}
+            for svc_cat in svc_cats:
+                key = service_key_for_slug(svc_cat.get("slug", ""))
+                if not key:
+                    continue
+                seen = set()
+                actions = []
+                for s in svc_cat.get("services", []):
+                    if s["name"] not in seen:
+                        actions.append({"id": s["id"], "name": s["name"], "price": s.get("price")})
+                        seen.add(s["name"])
+                    if len(actions) >= DEFAULT_ACTIONS_PER_KEY:
+                        break
+                by_key[key] = actions
+            if by_key:
+                self.default_actions[combo] = by_key
+
+        # {(L3_id, L4_id): {action name: [action variants]}}
+        self.actions_by_name = {
+            combo: index_actions_by_name(svc_cats)
+            for combo, svc_cats in self.services.items()
+        }
+
+        # {(L3_id, L4_id): enrich_qfix fields}
+        self.pair_fields = {combo: self.catalog_fields(*combo) for combo in self.services}
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Build a snapshot from the QFix product-categories response."""
+        items = {}
+        subitems = {}
+        services = {}
+        assigned_categories = {}
         for l1 in tree:
             for l2 in l1.get("children", []):
                 for l3 in l2.get("children", []):
                     l3_id = l3.get("id")
-                    if l3_id not in self.items:
-                        self.items[l3_id] = {
+                    if l3_id not in items:
+                        items[l3_id] = {
                             **_build_catalog_node(l3),
                             "parent": _build_catalog_node(l2),
                         }
                     for l4 in l3.get("children", []):
                         l4_id = l4.get("id")
-                        if l4_id not in self.subitems:
-                            self.subitems[l4_id] = _build_catalog_node(l4)
+                        if l4_id not in subitems:
+                            subitems[l4_id] = _build_catalog_node(l4)
 
                         service_categories = []
                         for l5 in l4.get("children", []):
@@ -94,19 +151,147 @@ class QFixCatalog:
                                 }
                                 svc_cat["services"].append(service)
                                 ac = prod.get("assigned_categories", "")
-                                if ac and prod["id"] not in self.assigned_categories:
-                                    self.assigned_categories[prod["id"]] = set(
+                                if ac and prod["id"] not in assigned_categories:
+                                    assigned_categories[prod["id"]] = set(
                                         int(c) for c in ac.split(",") if c.strip()
                                     )
                             service_categories.append(svc_cat)
-                        self.services[(l3_id, l4_id)] = service_categories
+                        services[(l3_id, l4_id)] = service_categories
+        return cls(items, subitems, services, assigned_categories)
+
+    def catalog_fields(self, ct_id, mat_id):
+        """The qfix_item/qfix_subitem/qfix_services entries for one pair."""
+        fields = {}
+        if ct_id and ct_id in self.items:
+            fields["qfix_item"] = self.items[ct_id]
+        if mat_id and mat_id in self.subitems:
+            fields["qfix_subitem"] = self.subitems[mat_id]
+        if ct_id and mat_id:
+            fields["qfix_services"] = self.services.get((ct_id, mat_id), [])
+        return fields
+
+
+# _CatalogSnapshot arguments; the other attributes are derived from them
+_SNAPSHOT_SOURCES = ("items", "subitems", "services", "assigned_categories")
+
+
+def _snapshot_attr(name, settable=False):
+    """Property reading name from the catalog's current snapshot.
+
+    Settable ones (the source data, for tests and scripts that set catalog
+    data by hand) publish a rebuilt snapshot.
+    """
+    def setter(self, value):
+        snap = self._snapshot
+        sources = {field: getattr(snap, field) for field in _SNAPSHOT_SOURCES}
+        sources[name] = value
+        self._snapshot = _CatalogSnapshot(**sources)
+
+    return property(lambda self: getattr(self._snapshot, name), setter if settable else None)
+
+
+class QFixCatalog:
+    """QFix category tree and service filtering.
+
+    Loads the catalog from the QFix API on first call to load(),
+    then provides filtering and enrichment methods.
+    """
+
+    # Read through to the current _CatalogSnapshot
+    items = _snapshot_attr("items", settable=True)
+    subitems = _snapshot_attr("subitems", settable=True)
+    services = _snapshot_attr("services", settable=True)
+    assigned_categories = _snapshot_attr("assigned_categories", settable=True)
+    empty_combos = _snapshot_attr("empty_combos")
+    default_actions = _snapshot_attr("default_actions")
+    actions_by_name = _snapshot_attr("actions_by_name")
+    pair_fields = _snapshot_attr("pair_fields")
+
+    def __init__(self):
+        self._snapshot = _CatalogSnapshot()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._refresher_pid = None
+
+        # Legacy allowlist filter
+        self._allowed_services = {}  # {ct_id_str: {mat_id_str: {svc_key: [{id, name}]}}}
 
+        # Filter strategy from env
+        self.filter_mode = os.environ.get("QFIX_SERVICE_FILTER", "assigned_categories")
+        if os.environ.get("QFIX_FILTER_SERVICES") == "0":
+            self.filter_mode = "off"
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        """Fetch the QFix category tree and build lookup dicts. Idempotent.
+
+        Concurrent first callers wait on a lock so the catalog is fetched
+        once; after that this is a single attribute check.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            self._fetch()
+
+    def start_refresher(self, interval=CATALOG_REFRESH_SECONDS):
+        """Fetch the catalog on a background thread now and every interval seconds.
+
+        Requests keep reading the current catalog while a refresh runs, and a
+        failed refresh keeps the previous one. Threads don't survive fork, so
+        a forked worker calling this again starts its own refresher.
+        """
+        if interval <= 0:
+            return
+        with self._load_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        threading.Thread(target=self._refresh_loop, args=(interval,),
+                         name="qfix-catalog-refresh", daemon=True).start()
+
+    def _refresh_loop(self, interval):
+        # The first fetch goes through load(), so a first request waits for
+        # it instead of starting its own. Later ones run without the lock;
+        # requests keep reading the current snapshot meanwhile.
+        self.load()
+        while True:
+            time.sleep(interval)
+            self._fetch()
+
+    def _fetch(self):
+        """Download the category tree and swap in freshly built lookups."""
+        try:
+            resp = http_requests.get(QFIX_CATEGORIES_URL, timeout=30)
+            resp.raise_for_status()
+            tree = resp.json()
+        except Exception as e:
+            logger.warning("Failed to fetch QFix catalog: %s", e)
+            return
+
+        snapshot = _CatalogSnapshot.from_tree(tree)
+        # One assignment publishes the catalog and all its indexes together
+        self._snapshot = snapshot
         self._loaded = True
         logger.info(
             "QFix catalog loaded: %d items, %d subitems, %d service combos, %d actions with assigned_categories",
-            len(self.items), len(self.subitems), len(self.services), len(self.assigned_categories),
+            len(snapshot.items), len(snapshot.subitems), len(snapshot.services),
+            len(snapshot.assigned_categories),
         )
 
+    def reindex(self):
+        """Republish the current catalog data with freshly derived lookup tables.
+
+        For callers that changed the services dicts in place.
+        """
+        snap = self._snapshot
+        self._snapshot = _CatalogSnapshot(
+            snap.items, snap.subitems, snap.services, snap.assigned_categories)
+
     def _load_allowed_services(self):
         """Load the legacy allowlist from JSON file."""
         if self._allowed_services:
@@ -118,16 +303,18 @@ class QFixCatalog:
             logger.info("Loaded QFix service allowlist: %d clothing types", len(self._allowed_services))
 
     def enrich_qfix(self, qfix):
-        """Add catalog item, subitem, and service data to a qfix mapping dict."""
+        """Add catalog item, subitem, and service data to a qfix mapping dict.
+
+        Pairs the catalog has services for are prebuilt by reindex(); any
+        other pair is looked up on the spot.
+        """
         self.load()
-        ct_id = qfix.get("qfix_clothing_type_id")
-        mat_id = qfix.get("qfix_material_id")
-        if ct_id and ct_id in self.items:
-            qfix["qfix_item"] = self.items[ct_id]
-        if mat_id and mat_id in self.subitems:
-            qfix["qfix_subitem"] = self.subitems[mat_id]
-        if ct_id and mat_id:
-            qfix["qfix_services"] = self.services.get((ct_id, mat_id), [])
+        snap = self._snapshot
+        pair = (qfix.get("qfix_clothing_type_id"), qfix.get("qfix_material_id"))
+        fields = snap.pair_fields.get(pair)
+        if fields is None:
+            fields = snap.catalog_fields(*pair)
+        qfix.update(fields)
         return qfix
 
     def swap_to_valid_variants(self, actions, ct_id, mat_id, service_key):
@@ -137,24 +324,25 @@ class QFixCatalog:
         isn't in assigned_categories for this ct_id, look for another variant
         with the same name (e.g. #1395) that IS valid, and swap it in.
         """
-        if not self.assigned_categories:
+        snap = self._snapshot
+        if not snap.assigned_categories:
             return actions
 
         slug_pattern = _SLUG_MAP.get(service_key, service_key)
-        svc_cats = self.services.get((ct_id, mat_id), [])
+        svc_cats = snap.services.get((ct_id, mat_id), [])
 
         name_to_valid = {}
         for svc_cat in svc_cats:
             if slug_pattern not in svc_cat.get("slug", ""):
                 continue
             for s in svc_cat.get("services", []):
-                if ct_id in self.assigned_categories.get(s["id"], set()):
+                if ct_id in snap.assigned_categories.get(s["id"], set()):
                     name_to_valid.setdefault(s["name"], []).append(s)
 
         result = []
         for a in actions:
             aid = a.get("id")
-            if ct_id in self.assigned_categories.get(aid, set()):
+            if ct_id in snap.assigned_categories.get(aid, set()):
                 result.append(a)
                 continue
             variants = name_to_valid.get(a.get("name"), [])
@@ -167,24 +355,25 @@ class QFixCatalog:
 
     def filter_by_assigned_categories(self, actions, ct_id, mat_id, service_key, max_actions=5):
         """Filter actions by assigned_categories, backfilling if needed."""
-        if not self.assigned_categories:
+        snap = self._snapshot
+        if not snap.assigned_categories:
             return actions
 
         filtered = [a for a in actions
-                    if ct_id in self.assigned_categories.get(a.get("id"), set())]
+                    if ct_id in snap.assigned_categories.get(a.get("id"), set())]
 
         if len(filtered) < max_actions:
             seen_ids = {a["id"] for a in filtered}
             slug_pattern = _SLUG_MAP.get(service_key, service_key)
 
-            svc_cats = self.services.get((ct_id, mat_id), [])
+            svc_cats = snap.services.get((ct_id, mat_id), [])
             for svc_cat in svc_cats:
                 if slug_pattern not in svc_cat.get("slug", ""):
                     continue
                 for s in svc_cat.get("services", []):
                     if s["id"] in seen_ids:
                         continue
-                    if ct_id not in self.assigned_categories.get(s["id"], set()):
+                    if ct_id not in snap.assigned_categories.get(s["id"], set()):
                         continue
                     filtered.append({"id": s["id"], "name": s["name"], "price": s.get("price")})
                     seen_ids.add(s["id"])
@@ -1,11 +1,10 @@
-import json
 import logging
 import os
 import threading
 import time
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, execute_values
 
 logger = logging.getLogger(__name__)
 
@@ -89,6 +88,113 @@ def create_table(conn):
             cur.execute(f"ALTER TABLE products_unified ADD COLUMN IF NOT EXISTS {col} {col_type};")
 
 
+def create_indexes(conn):
+    """Create the search indexes, the remap_coverage view and pg_trgm.
+
+    Run by setup_db.py, not from request handlers: CREATE EXTENSION usually
+    needs a privileged role, and the indexes are built CONCURRENTLY so
+    writers aren't blocked while they build, which requires conn to be in
+    autocommit mode.
+    """
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        # Trigram index so the Gina Tricot name search (ILIKE '%q%') can use
+        # an index instead of scanning every row
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_name_trgm
+            ON products_unified USING gin (product_name gin_trgm_ops)
+            WHERE brand = 'Gina Tricot';
+        """)
+        # Same for the cross-brand /v4 search, which matches on lower(product_name)
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_name_trgm
+            ON products_unified USING gin (lower(product_name) gin_trgm_ops);
+        """)
+        # Full-text index for multi-word /v4 searches
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_name_fts
+            ON products_unified USING gin (to_tsvector('simple', product_name));
+        """)
+        # Unmapped products only: shrinks as mapping improves, and covers the
+        # per-brand unmapped counts and category breakdowns
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_unmapped
+            ON products_unified (brand, clothing_type) WHERE qfix_url IS NULL;
+        """)
+        # /v4/product and /docs/verify look products up by id alone, which
+        # the (brand, product_id) unique index can't serve
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_product_id
+            ON products_unified (product_id);
+        """)
+        # GTIN lookups for /v2/product/gtin. Partial, since scraped rows have
+        # no GTIN, and not UNIQUE: one GTIN can arrive under several brands
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_gtin
+            ON products_unified (gtin) WHERE gtin IS NOT NULL;
+        """)
+        # Size variants in order for /v2/product/article and /v2/products,
+        # without a sort
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_article_size
+            ON products_unified (article_number, size);
+        """)
+        # ?brand= filters of the /remap endpoints compare case-insensitively,
+        # since protocol uploads store the Brand cell as typed
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS products_unified_lower_brand
+            ON products_unified (LOWER(brand));
+        """)
+        # Per-brand mapping coverage for /remap/status, refreshed by
+        # refresh_remap_coverage() after bulk writes. The unique index is
+        # what REFRESH ... CONCURRENTLY requires.
+        cur.execute("""
+            CREATE MATERIALIZED VIEW IF NOT EXISTS remap_coverage AS
+            SELECT brand, COUNT(*) AS total,
+                   COUNT(*) FILTER (WHERE qfix_url IS NOT NULL) AS mapped,
+                   COUNT(*) FILTER (WHERE qfix_url IS NULL) AS unmapped
+            FROM products_unified GROUP BY brand;
+        """)
+        cur.execute("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS remap_coverage_brand ON remap_coverage (brand);")
+
+
+_PRODUCT_INSERT = """
+    INSERT INTO products_unified (product_id, brand, sub_brand, product_name, description, category,
+        clothing_type, material_composition, materials, color, size,
+        gtin, article_number, product_url, image_url, care_text, country_of_origin,
+        last_seen_in_sitemap)
+"""
+
+_PRODUCT_VALUES = """(%(product_id)s, %(brand)s, %(sub_brand)s, %(product_name)s, %(description)s, %(category)s,
+        %(clothing_type)s, %(material_composition)s, %(materials)s, %(color)s, %(size)s,
+        %(gtin)s, %(article_number)s, %(product_url)s, %(image_url)s, %(care_text)s, %(country_of_origin)s,
+        CURRENT_TIMESTAMP)"""
+
+# Positional form of _PRODUCT_VALUES for tuple rows in PRODUCT_COLUMNS order
+_PRODUCT_ROW = "(" + ", ".join(["%s"] * len(PRODUCT_COLUMNS)) + ", CURRENT_TIMESTAMP)"
+
+_PRODUCT_ON_CONFLICT = """
+    ON CONFLICT (brand, product_id) DO UPDATE SET
+        sub_brand = EXCLUDED.sub_brand,
+        product_name = EXCLUDED.product_name,
+        description = EXCLUDED.description,
+        category = EXCLUDED.category,
+        clothing_type = EXCLUDED.clothing_type,
+        material_composition = EXCLUDED.material_composition,
+        materials = EXCLUDED.materials,
+        color = EXCLUDED.color,
+        size = EXCLUDED.size,
+        gtin = EXCLUDED.gtin,
+        article_number = EXCLUDED.article_number,
+        product_url = EXCLUDED.product_url,
+        image_url = EXCLUDED.image_url,
+        care_text = EXCLUDED.care_text,
+        country_of_origin = EXCLUDED.country_of_origin,
+        last_seen_in_sitemap = CURRENT_TIMESTAMP,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
 def upsert_product(conn, product):
     """Upsert a product into products_unified.
 
@@ -98,35 +204,53 @@ def upsert_product(conn, product):
     # Build the dict with defaults for missing keys
     values = {col: product.get(col) for col in PRODUCT_COLUMNS}
 
+    with conn.cursor() as cur:
+        cur.execute(_PRODUCT_INSERT + "VALUES " + _PRODUCT_VALUES + _PRODUCT_ON_CONFLICT, values)
+
+
+def bulk_upsert_products(conn, products, page_size=1000):
+    """Upsert many products with one multi-row INSERT per page.
+
+    Same semantics as calling upsert_product() for each product in order:
+    when a (brand, product_id) appears more than once, the last one wins.
+    Products without a product_id (protocol rows) never conflict and are all
+    inserted. Returns the number of distinct products written.
+    """
+    # ON CONFLICT cannot update the same row twice within one statement
+    rows = {}
+    for i, product in enumerate(products):
+        product_id = product.get("product_id")
+        key = (product.get("brand"), product_id) if product_id is not None else i
+        rows[key] = tuple(product.get(col) for col in PRODUCT_COLUMNS)
+
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            _PRODUCT_INSERT + "VALUES %s" + _PRODUCT_ON_CONFLICT,
+            list(rows.values()),
+            template=_PRODUCT_ROW,
+            page_size=page_size,
+        )
+    return len(rows)
+
+
+def delete_unlisted_protocol_products(conn, brands):
+    """Delete protocol-only products of brands that the current upload skipped.
+
+    Call after bulk_upsert_products() in the same transaction: every row the
+    upload wrote has updated_at = CURRENT_TIMESTAMP (the transaction start),
+    so older rows weren't in the file. Rows with a product_url came from a
+    scraper and are kept. Returns the number of rows deleted.
+    """
+    if not brands:
+        return 0
     with conn.cursor() as cur:
         cur.execute("""
-            INSERT INTO products_unified (product_id, brand, sub_brand, product_name, description, category,
-                clothing_type, material_composition, materials, color, size,
-                gtin, article_number, product_url, image_url, care_text, country_of_origin,
-                last_seen_in_sitemap)
-            VALUES (%(product_id)s, %(brand)s, %(sub_brand)s, %(product_name)s, %(description)s, %(category)s,
-                %(clothing_type)s, %(material_composition)s, %(materials)s, %(color)s, %(size)s,
-                %(gtin)s, %(article_number)s, %(product_url)s, %(image_url)s, %(care_text)s, %(country_of_origin)s,
-                CURRENT_TIMESTAMP)
-            ON CONFLICT (brand, product_id) DO UPDATE SET
-                sub_brand = EXCLUDED.sub_brand,
-                product_name = EXCLUDED.product_name,
-                description = EXCLUDED.description,
-                category = EXCLUDED.category,
-                clothing_type = EXCLUDED.clothing_type,
-                material_composition = EXCLUDED.material_composition,
-                materials = EXCLUDED.materials,
-                color = EXCLUDED.color,
-                size = EXCLUDED.size,
-                gtin = EXCLUDED.gtin,
-                article_number = EXCLUDED.article_number,
-                product_url = EXCLUDED.product_url,
-                image_url = EXCLUDED.image_url,
-                care_text = EXCLUDED.care_text,
-                country_of_origin = EXCLUDED.country_of_origin,
-                last_seen_in_sitemap = CURRENT_TIMESTAMP,
-                updated_at = CURRENT_TIMESTAMP;
-        """, values)
+            DELETE FROM products_unified
+            WHERE brand = ANY(%s) AND gtin IS NOT NULL AND product_url IS NULL
+              AND updated_at < CURRENT_TIMESTAMP
+        """, (sorted(brands),))
+        return cur.rowcount
 
 
 def update_qfix_mapping(conn, brand, product_id, qfix_data):
@@ -165,6 +289,105 @@ def update_qfix_mapping(conn, brand, product_id, qfix_data):
         })
 
 
+_QFIX_MAPPING_COLUMNS = [
+    "qfix_clothing_type", "qfix_clothing_type_id", "qfix_material",
+    "qfix_material_id", "qfix_url", "qfix_url_repair", "qfix_url_adjustment",
+    "qfix_url_care", "qfix_url_other",
+]
+
+
+def bulk_update_qfix_mappings(conn, mappings, page_size=1000):
+    """update_qfix_mapping() for many products, one UPDATE ... FROM per page.
+
+    mappings is an iterable of (brand, product_id, qfix_data) tuples.
+    Returns the number of mappings sent.
+    """
+    rows = [
+        (brand, product_id, *(qfix_data.get(col) for col in _QFIX_MAPPING_COLUMNS))
+        for brand, product_id, qfix_data in mappings
+    ]
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            UPDATE products_unified AS p
+            SET qfix_clothing_type = v.qfix_clothing_type,
+                qfix_clothing_type_id = v.qfix_clothing_type_id,
+                qfix_material = v.qfix_material,
+                qfix_material_id = v.qfix_material_id,
+                qfix_url = v.qfix_url,
+                qfix_url_repair = v.qfix_url_repair,
+                qfix_url_adjustment = v.qfix_url_adjustment,
+                qfix_url_care = v.qfix_url_care,
+                qfix_url_other = v.qfix_url_other
+            FROM (VALUES %s) AS v (brand, product_id, """ + ", ".join(_QFIX_MAPPING_COLUMNS) + """)
+            WHERE p.brand = v.brand AND p.product_id = v.product_id
+            """,
+            rows,
+            # Casts so all-NULL id columns in a page still type as integer
+            template="(%s, %s, %s, %s::integer, %s, %s::integer, %s, %s, %s, %s, %s)",
+            page_size=page_size,
+        )
+    return len(rows)
+
+
+_ARTICLE_QFIX_COLUMNS = _QFIX_MAPPING_COLUMNS[:5]
+
+
+def bulk_update_article_qfix_mappings(conn, mappings, page_size=1000):
+    """Persist map_product_v2() results on every variant of an article.
+
+    mappings is an iterable of (brand, article_number, qfix_data) tuples.
+    Protocol rows have no product_id, so they are matched on brand and
+    article_number instead. Returns the number of mappings sent.
+    """
+    rows = [
+        (brand, article_number, *(qfix_data.get(col) for col in _ARTICLE_QFIX_COLUMNS))
+        for brand, article_number, qfix_data in mappings
+    ]
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            UPDATE products_unified AS p
+            SET qfix_clothing_type = v.qfix_clothing_type,
+                qfix_clothing_type_id = v.qfix_clothing_type_id,
+                qfix_material = v.qfix_material,
+                qfix_material_id = v.qfix_material_id,
+                qfix_url = v.qfix_url
+            FROM (VALUES %s) AS v (brand, article_number, """ + ", ".join(_ARTICLE_QFIX_COLUMNS) + """)
+            WHERE p.brand = v.brand AND p.article_number = v.article_number
+              AND p.gtin IS NOT NULL
+            """,
+            rows,
+            template="(%s, %s, %s, %s::integer, %s, %s::integer, %s)",
+            page_size=page_size,
+        )
+    return len(rows)
+
+
+def defer_commit_flush(conn):
+    """Let the current transaction commit without waiting for its WAL flush.
+
+    For bulk writes that can simply be rerun (uploads, remaps): a server
+    crash may lose the last few hundred milliseconds of commits but never
+    leaves them half-applied. SET LOCAL lasts only until the transaction
+    ends, so pooled connections go back with the server default.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL synchronous_commit = off;")
+
+
+def refresh_remap_coverage(conn):
+    """Recompute the remap_coverage view without blocking readers.
+
+    Fails if setup_db.py hasn't created the view, or if conn's role
+    doesn't own it.
+    """
+    with conn.cursor() as cur:
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY remap_coverage;")
+
+
 def create_action_rankings_table(conn):
     with conn.cursor() as cur:
         cur.execute("""
@@ -186,7 +409,7 @@ def upsert_action_ranking(conn, clothing_type_id, material_id, rankings):
             ON CONFLICT (clothing_type_id, material_id) DO UPDATE SET
                 rankings = EXCLUDED.rankings,
                 updated_at = CURRENT_TIMESTAMP;
-        """, (clothing_type_id, material_id, json.dumps(rankings)))
+        """, (clothing_type_id, material_id, Json(rankings)))
 
 
 def get_action_ranking(conn, clothing_type_id, material_id):
@@ -197,10 +420,26 @@ def get_action_ranking(conn, clothing_type_id, material_id):
             (clothing_type_id, material_id),
         )
         row = cur.fetchone()
-        if row:
-            r = row["rankings"]
-            return r if isinstance(r, dict) else json.loads(r)
-        return None
+        # rankings is JSONB, which psycopg2 decodes to a dict itself
+        return row["rankings"] if row else None
+
+
+def get_action_rankings(conn, pairs):
+    """Fetch rankings for many (clothing_type_id, material_id) pairs in one query.
+
+    Returns {(clothing_type_id, material_id): rankings} for the pairs that exist.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return {}
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT clothing_type_id, material_id, rankings FROM qfix_action_rankings "
+            "WHERE (clothing_type_id, material_id) IN "
+            "(SELECT * FROM unnest(%s::int[], %s::int[]))",
+            ([ct_id for ct_id, _ in pairs], [mat_id for _, mat_id in pairs]),
+        )
+        return {(ct_id, mat_id): rankings for ct_id, mat_id, rankings in cur.fetchall()}
 
 
 # ── Robust scraper runner ──────────────────────────────────────────────
@@ -0,0 +1,17 @@
+"""Gunicorn settings for production (see Dockerfile).
+
+One gevent worker multiplexes requests that wait on Postgres, QFix and the
+Anthropic API. WEB_CONCURRENCY adds worker processes on machines with more
+than one CPU; each worker has its own DB pool, catalog and caches.
+
+The app is not preloaded: catalog.start_refresher() runs when api.py is
+imported, and its thread must start in the worker, not in the master.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "gevent"
+worker_connections = 100
+# /remap/run and keyword validation can take minutes
+timeout = 600
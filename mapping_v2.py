@@ -4,6 +4,7 @@ Maps T4V protocol product data (English) to QFix repair service categories.
 Uses the same QFix IDs as mapping.py but maps from English category/material
 names found in T4V Public Data Protocol xlsx files.
 """
+import json
 import re
 
 from mapping import QFIX_CLOTHING_TYPE_IDS, QFIX_SUBCATEGORY_IDS, VALID_MATERIAL_IDS, _resolve_material_id
@@ -162,8 +163,6 @@ def map_product_v2(product, materials=None):
     product: dict with category, product_name, etc.
     materials: list of material dicts (or parsed from product["materials"] JSON).
     """
-    import json
-
     if materials is None:
         raw = product.get("materials")
         if raw and isinstance(raw, str):
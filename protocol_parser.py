@@ -9,27 +9,29 @@ import re
 
 from openpyxl import load_workbook
 
-# Only load sheets we actually need (skip large reference sheets)
-NEEDED_SHEETS = {"Product", "Material", "Care", "Brand", "Supply chain"}
-
 PID_COL = "Product Identification Value (GTIN, SKU ID value, Style ID value)"
 
 
-def _read_sheet_rows(ws):
-    """Read a worksheet into a list of dicts using the first row as headers.
+def _iter_sheet_rows(ws):
+    """Yield a worksheet's rows as dicts using the first row as headers.
 
-    Streams rows to avoid keeping full sheet in memory.
+    Rows are read one at a time, so no sheet is held in memory as a whole.
     """
     headers = None
-    result = []
     for row in ws.iter_rows(values_only=True):
         if headers is None:
             headers = [str(h).strip() if h else f"col_{i}" for i, h in enumerate(row)]
             continue
         if not any(row):
             continue
-        result.append(dict(zip(headers, row)))
-    return result
+        yield dict(zip(headers, row))
+
+
+def _sheet_rows(wb, name):
+    """Rows of the named sheet, or nothing if the workbook lacks it."""
+    if name in wb.sheetnames:
+        return _iter_sheet_rows(wb[name])
+    return iter(())
 
 
 def _extract_color_name_and_code(color_str):
@@ -63,29 +65,32 @@ def _parse_percentage(value):
 
 
 def parse_protocol_xlsx(filepath):
-    """Parse a T4V protocol xlsx file and return a list of product dicts.
+    """Parse a T4V protocol xlsx file, yielding one product dict per row.
+
+    filepath may be a path or a binary file object (e.g. an upload stream).
+    The workbook stays open until the generator is exhausted or closed.
 
     Each dict has keys matching the products_v2 table columns:
     gtin, article_number, product_name, description, category, size, color,
     materials (JSON string), care_text, brand, country_of_origin.
     """
     wb = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        yield from _build_products(wb)
+    finally:
+        wb.close()
 
-    # Read only the sheets we need, one at a time, to minimize memory
-    sheets = {}
-    for name in NEEDED_SHEETS:
-        if name in wb.sheetnames:
-            sheets[name] = _read_sheet_rows(wb[name])
-        else:
-            sheets[name] = []
-
-    wb.close()
 
-    products_raw = sheets["Product"]
+def _build_products(wb):
+    """Index the per-product sheets, then join them onto the Product sheet.
 
+    Each sheet is consumed straight from the read-only workbook and
+    products are yielded as their rows are read, so only the lookup
+    indexes are kept in memory.
+    """
     # Material sheet → group by product key
     materials_by_key = {}
-    for row in sheets["Material"]:
+    for row in _sheet_rows(wb, "Material"):
         key = str(row.get(PID_COL, "")).strip()
         if not key:
             continue
@@ -98,31 +103,27 @@ def parse_protocol_xlsx(filepath):
 
     # Care sheet → index by product key
     care_by_key = {}
-    for row in sheets["Care"]:
+    for row in _sheet_rows(wb, "Care"):
         key = str(row.get(PID_COL, "")).strip()
         if key:
             care_by_key[key] = str(row.get("Care Text", "") or "").strip()
 
     # Brand sheet → index by product key
     brand_by_key = {}
-    for row in sheets["Brand"]:
+    for row in _sheet_rows(wb, "Brand"):
         key = str(row.get(PID_COL, "")).strip()
         if key:
             brand_by_key[key] = str(row.get("Brand", "") or "").strip()
 
     # Supply chain sheet → index by product key
     origin_by_key = {}
-    for row in sheets["Supply chain"]:
+    for row in _sheet_rows(wb, "Supply chain"):
         key = str(row.get(PID_COL, "")).strip()
         if key:
             origin_by_key[key] = str(row.get("Country of Origin - Confection", "") or "").strip()
 
-    # Free intermediate data
-    del sheets
-
     # Build unified product records
-    results = []
-    for prod in products_raw:
+    for prod in _sheet_rows(wb, "Product"):
         gtin = str(prod.get(PID_COL, "") or "").strip()
         article_number = str(prod.get("Article Number", "") or "").strip()
         product_name = str(prod.get("Product Name", "") or "").strip()
@@ -142,7 +143,7 @@ def parse_protocol_xlsx(filepath):
         brand = brand_by_key.get(product_key, "") if product_key else ""
         country = origin_by_key.get(product_key, "") if product_key else ""
 
-        results.append({
+        yield {
             "gtin": gtin,
             "article_number": article_number,
             "product_name": product_name,
@@ -154,6 +155,4 @@ def parse_protocol_xlsx(filepath):
             "care_text": care_text,
             "brand": brand,
             "country_of_origin": country,
-        })
-
-    return results
+        }
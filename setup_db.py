@@ -1,7 +1,8 @@
 """One-time database setup script.
 
-Run this to create the products_unified table and all required columns.
-Only needed when setting up a fresh database.
+Run this to create the products_unified table, all required columns and
+its indexes. Needed when setting up a fresh database, and again after
+upgrades that add indexes (every step is IF NOT EXISTS).
 
 Usage: python setup_db.py
 """
@@ -11,7 +12,7 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from database import get_connection, create_table
+from database import get_connection, create_table, create_indexes
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,6 +27,8 @@ def main():
     conn = get_connection()
     logger.info("Creating tables and columns...")
     create_table(conn)
+    logger.info("Creating indexes...")
+    create_indexes(conn)
     conn.close()
     logger.info("Database setup complete.")
 
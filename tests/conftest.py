@@ -6,6 +6,9 @@ import tempfile
 
 import pytest
 
+# No background catalog fetches from the test process
+os.environ.setdefault("QFIX_CATALOG_REFRESH_SECONDS", "0")
+
 
 def _create_tables_sqlite(conn):
     """Create the unified table using SQLite-compatible SQL."""
@@ -73,10 +76,18 @@ def app_client(tmp_path):
     from psycopg2.extras import RealDictCursor
 
     class _SqliteRealDictCursor:
-        """Adapter to make SQLite cursor behave like psycopg2 RealDictCursor."""
-        def __init__(self, conn):
+        """Adapter to make SQLite cursor behave like a psycopg2 cursor.
+
+        Rows come back as dicts for RealDictCursor and as tuples otherwise.
+        """
+        def __init__(self, conn, as_dict=True):
             self._conn = conn
             self._cursor = conn.cursor()
+            self._row = dict if as_dict else tuple
+
+        @property
+        def description(self):
+            return self._cursor.description
 
         def execute(self, query, params=None):
             query = query.replace("%s", "?")
@@ -90,10 +101,13 @@ def app_client(tmp_path):
             row = self._cursor.fetchone()
             if row is None:
                 return None
-            return dict(row)
+            return self._row(row)
 
         def fetchall(self):
-            return [dict(r) for r in self._cursor.fetchall()]
+            return [self._row(r) for r in self._cursor.fetchall()]
+
+        def __iter__(self):
+            return iter(self.fetchall())
 
         def close(self):
             try:
@@ -114,8 +128,8 @@ def app_client(tmp_path):
             self._conn.row_factory = sqlite3.Row
             self.autocommit = True
 
-        def cursor(self, cursor_factory=None):
-            return _SqliteRealDictCursor(self._conn)
+        def cursor(self, name=None, cursor_factory=None):
+            return _SqliteRealDictCursor(self._conn, as_dict=cursor_factory is RealDictCursor)
 
         def close(self):
             self._conn.close()
@@ -127,6 +141,8 @@ def app_client(tmp_path):
         pass
 
     api_module.app.config["TESTING"] = True
+    api_module._product_responses.clear()
+    api_module._verify_mapping.cache_clear()
     with patch.object(api_module, "get_db", _mock_get_db), \
          patch.object(api_module, "create_table", _noop):
         with api_module.app.test_client() as client:
@@ -0,0 +1,27 @@
+"""Tests for the shared Anthropic client helpers (no actual API calls)."""
+import threading
+from unittest.mock import patch
+
+from ai_client import get_ai_client, strip_code_fence
+
+
+def test_strip_code_fence():
+    assert strip_code_fence('```json\n["a", "b"]\n```') == '["a", "b"]'
+    assert strip_code_fence('```\n{"x": 1}\n```') == '{"x": 1}'
+    # Unclosed fence is left alone rather than losing the last line
+    assert strip_code_fence('```json\n["a"]') == '```json\n["a"]'
+    assert strip_code_fence('["a"]') == '["a"]'
+
+
+@patch("ai_client._client", None)
+@patch("ai_client.anthropic.Anthropic")
+def test_get_ai_client_creates_one_client_across_threads(mock_anthropic):
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(get_ai_client()))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    mock_anthropic.assert_called_once()
+    assert all(c is mock_anthropic.return_value for c in clients)
@@ -1,9 +1,12 @@
 """Integration tests for API endpoints using Flask test client."""
 import io
 import json
+import os
 import sqlite3
 from unittest.mock import patch
 
+import pytest
+
 
 def _seed_product(db_path, product_id, brand, product_name, category, clothing_type,
                   material_composition, product_url, description, color,
@@ -136,6 +139,15 @@ def test_kappahl_get_product_not_found(app_client):
     assert resp.status_code == 404
 
 
+def test_unknown_brand_rejected_at_routing(app_client):
+    client, db_path = app_client
+    with patch("api.get_db") as get_db:
+        resp = client.get("/acme/product/131367")
+    assert resp.status_code == 404
+    assert resp.get_json() == {"error": "Not found"}
+    get_db.assert_not_called()
+
+
 def test_kappahl_list_products(app_client):
     client, db_path = app_client
     _seed_kappahl_product(db_path)
@@ -147,6 +159,14 @@ def test_kappahl_list_products(app_client):
     assert data[0]["product_id"] == "131367"
 
 
+def test_list_products_streams_empty_array(app_client):
+    client, db_path = app_client
+    resp = client.get("/eton/products")
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert resp.get_json() == []
+
+
 # ── v2 protocol endpoints ────────────────────────────────────────────────
 
 def test_v2_get_by_gtin(app_client):
@@ -160,6 +180,17 @@ def test_v2_get_by_gtin(app_client):
     assert data["product"]["product_name"] == "Structure maxi skirt"
 
 
+def test_v2_lookups_map_once_per_key(app_client):
+    import api
+    client, db_path = app_client
+    _seed_v2_product(db_path)
+    with patch.object(api, "map_product_v2", wraps=api.map_product_v2) as mapper:
+        for _ in range(2):
+            assert client.get("/v2/product/gtin/7394712345678").status_code == 200
+            assert client.get("/v2/product/article/26414").status_code == 200
+    assert mapper.call_count == 2
+
+
 def test_v2_get_by_gtin_not_found(app_client):
     client, db_path = app_client
     resp = client.get("/v2/product/gtin/0000000000000")
@@ -177,6 +208,54 @@ def test_v2_get_by_article(app_client):
     assert len(data["variants"]) >= 1
 
 
+def test_v2_get_by_article_uses_mapping_stored_at_upload(app_client):
+    import api
+    client, db_path = app_client
+    _seed_v2_product(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        UPDATE products_unified SET qfix_clothing_type = 'Skirt', qfix_clothing_type_id = 1,
+            qfix_material = 'Cotton', qfix_material_id = 2, qfix_url = 'https://example.com/q'
+        WHERE article_number = '26414'
+    """)
+    conn.commit()
+    conn.close()
+
+    with patch.object(api, "map_product_v2") as mapper:
+        data = client.get("/v2/product/article/26414").get_json()
+    mapper.assert_not_called()
+    assert data["qfix"]["qfix_url"] == "https://example.com/q"
+    assert "qfix_url" not in data["variants"][0]
+
+
+def test_v2_upload_maps_variants_across_chunks(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    products = [{"brand": "KappAhl", "article_number": "A", "size": s} for s in "SML"]
+    products.append({"brand": "Lindex", "article_number": "A", "size": "M"})
+    table = []
+
+    def store(conn, mappings):
+        by_key = {(brand, article): qfix for brand, article, qfix in mappings}
+        for row in table:
+            row.update(by_key.get((row["brand"], row["article_number"]), {}))
+
+    with patch("api.parse_protocol_xlsx", return_value=iter(products)), \
+         patch("api.UPLOAD_CHUNK_SIZE", 2), \
+         patch("api.get_write_db", return_value=MagicMock()), \
+         patch("api.bulk_upsert_products", side_effect=lambda conn, chunk: table.extend(
+             dict(p) for p in chunk)), \
+         patch("api._refresh_coverage_after_write"), \
+         patch("api.map_product_v2", side_effect=lambda p, materials: {
+             "qfix_url": f"{p['brand']}/{p['article_number']}"}) as mapper, \
+         patch("api.bulk_update_article_qfix_mappings", side_effect=store):
+        resp = client.post("/v2/upload", data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                           content_type="multipart/form-data")
+    assert resp.status_code == 200
+    assert mapper.call_count == 2
+    assert [row["qfix_url"] for row in table] == ["KappAhl/A"] * 3 + ["Lindex/A"]
+
+
 def test_v2_list_products(app_client):
     client, db_path = app_client
     _seed_v2_product(db_path)
@@ -236,6 +315,12 @@ def test_v3_search_no_query(app_client):
     assert resp.status_code == 400
 
 
+def test_v3_search_short_query(app_client):
+    client, db_path = app_client
+    resp = client.get("/v3/product/search?q=ma")
+    assert resp.status_code == 400
+
+
 # ── v4 aggregated endpoints ──────────────────────────────────────────────
 
 def test_v4_get_product_merged(app_client):
@@ -252,6 +337,20 @@ def test_v4_get_product_merged(app_client):
     assert data["product"]["clothing_type"] == "kjolar > langkjolar"
 
 
+def test_v4_get_product_shape_comes_from_sql(app_client):
+    client, db_path = app_client
+    _seed_gt_product_with_protocol(db_path)
+
+    product = client.get("/v4/product/225549000").get_json()["product"]
+    assert set(product) == {
+        "product_name", "brand", "color", "description_sv", "description_en",
+        "category_scraped", "category_protocol", "clothing_type", "material_composition",
+        "materials_structured", "care_text", "country_of_origin", "product_url",
+        "product_id", "article_number", "source"}
+    assert product["description_sv"] == product["description_en"] == "En fin kjol"
+    assert product["category_scraped"] == "klader"
+
+
 def test_v4_get_product_scraper_only(app_client):
     """When no protocol data exists, should return scraper_only."""
     client, db_path = app_client
@@ -269,6 +368,21 @@ def test_v4_get_product_not_found(app_client):
     assert resp.status_code == 404
 
 
+def test_v4_get_product_served_from_cache(app_client):
+    client, db_path = app_client
+    _seed_gt_product(db_path)
+    assert client.get("/v4/product/225549000").status_code == 200
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM products_unified")
+    conn.commit()
+    conn.close()
+
+    resp = client.get("/v4/product/225549000")
+    assert resp.status_code == 200
+    assert resp.get_json()["product"]["product_id"] == "225549000"
+
+
 def test_v4_list_products(app_client):
     client, db_path = app_client
     _seed_gt_product(db_path)
@@ -279,6 +393,18 @@ def test_v4_list_products(app_client):
     assert len(data) >= 1
 
 
+def test_v4_endpoints_check_out_one_connection_and_run_no_ddl(app_client):
+    import api
+    client, db_path = app_client
+    _seed_gt_product(db_path)
+    for url in ("/v4/product/225549000", "/v4/products", "/v4/product/search?q=maxi"):
+        with patch.object(api, "get_db", wraps=api.get_db) as get_db, \
+             patch.object(api, "create_table") as create_table:
+            assert client.get(url).status_code == 200
+        assert get_db.call_count == 1, url
+        create_table.assert_not_called()
+
+
 def test_v4_search(app_client):
     client, db_path = app_client
     _seed_gt_product(db_path)
@@ -289,6 +415,53 @@ def test_v4_search(app_client):
     assert len(data) >= 1
 
 
+def test_v4_search_case_insensitive(app_client):
+    client, db_path = app_client
+    _seed_gt_product(db_path)
+
+    resp = client.get("/v4/product/search?q=MAXI")
+    assert resp.status_code == 200
+    assert len(resp.get_json()) >= 1
+    assert client.get("/v4/product/search?q=ma").status_code == 400
+
+
+def test_v4_search_multiword_uses_full_text(app_client):
+    from unittest.mock import MagicMock
+    client, db_path = app_client
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.description = [("product_id",)]
+    cur.fetchall.return_value = [("225549000",)]
+    with patch("api.get_db", return_value=conn):
+        resp = client.get("/v4/product/search?q=maxi skirt")
+    assert resp.get_json() == [{"product_id": "225549000"}]
+    sql, params = cur.execute.call_args.args
+    assert "to_tsquery('simple', %s)" in sql
+    assert params == ("maxi:* & skirt:*",)
+
+
+def test_prefix_tsquery_keeps_only_words():
+    from api import _prefix_tsquery
+    assert _prefix_tsquery("maxi ski") == "maxi:* & ski:*"
+    assert _prefix_tsquery("jeans | !(x) & 'y'") == "jeans:* & x:* & y:*"
+    assert _prefix_tsquery("långärmad topp") == "långärmad:* & topp:*"
+
+
+def test_v3_search_multiword_uses_full_text(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.description = [("product_id",)]
+    cur.fetchall.return_value = [("225549000",)]
+    with patch("api.get_db", return_value=conn):
+        resp = client.get("/v3/product/search?q=maxi skirt")
+    assert resp.get_json() == [{"product_id": "225549000"}]
+    sql, params = cur.execute.call_args.args
+    assert "to_tsquery('simple', %s)" in sql
+    assert params == ("maxi:* & skirt:*", "Gina Tricot")
+
+
 # ── Eton endpoints ──────────────────────────────────────────────────────
 
 def test_eton_get_product(app_client):
@@ -410,9 +583,10 @@ def test_identify(mock_classify, app_client):
         },
     }
 
-    data = {"image": (io.BytesIO(b"fake image data"), "test.jpg", "image/jpeg")}
+    data = {"image": (io.BytesIO(b"\xff\xd8\xff\xe0fake image data"), "test.jpg", "image/jpeg")}
     resp = client.post("/identify", data=data, content_type="multipart/form-data")
     assert resp.status_code == 200
+    assert mock_classify.call_args.args[1] == "image/jpeg"
     result = resp.get_json()
     assert result["classification"]["clothing_type"] == "Trousers"
     assert result["qfix"]["qfix_url"] is not None
@@ -422,3 +596,765 @@ def test_identify_no_image(app_client):
     client, db_path = app_client
     resp = client.post("/identify")
     assert resp.status_code == 400
+
+
+@patch("api.classify_and_map")
+def test_identify_rejects_non_image_bytes(mock_classify, app_client):
+    client, db_path = app_client
+    data = {"image": (io.BytesIO(b"%PDF-1.7 not an image"), "test.jpg", "image/jpeg")}
+    resp = client.post("/identify", data=data, content_type="multipart/form-data")
+    assert resp.status_code == 400
+    mock_classify.assert_not_called()
+
+
+@patch("api.classify_and_map")
+def test_identify_maps_spooled_upload(mock_classify, app_client):
+    client, db_path = app_client
+    mock_classify.return_value = {"classification": {}, "qfix": {}}
+    image = b"\x89PNG\r\n\x1a\n" + b"\x00" * (600 * 1024)
+    data = {"image": (io.BytesIO(image), "big.png", "image/png")}
+    resp = client.post("/identify", data=data, content_type="multipart/form-data")
+    assert resp.status_code == 200
+    sent, media_type = mock_classify.call_args.args
+    assert isinstance(sent, memoryview)
+    assert media_type == "image/png"
+    assert len(sent) == len(image)
+
+
+@patch("api.classify_and_map")
+def test_identify_reads_large_upload_without_file(mock_classify, app_client):
+    import api
+    client, _ = app_client
+    mock_classify.return_value = {"classification": {}, "qfix": {}}
+    image = b"\x89PNG\r\n\x1a\n" + b"\x00" * (600 * 1024)
+    with patch.object(api._Request, "_get_file_stream", lambda *a, **kw: io.BytesIO()):
+        resp = client.post("/identify", data={"image": (io.BytesIO(image), "big.png")},
+                           content_type="multipart/form-data")
+    assert resp.status_code == 200
+    assert mock_classify.call_args.args[0] == image
+
+
+@patch("api.classify_and_map")
+def test_identify_rejects_oversized_upload(mock_classify, app_client):
+    client, _ = app_client
+    with patch("api.MAX_IMAGE_BYTES", 1024):
+        image = b"\x89PNG\r\n\x1a\n" + b"\x00" * 2048
+        resp = client.post("/identify", data={"image": (io.BytesIO(image), "big.png")},
+                           content_type="multipart/form-data")
+    assert resp.status_code == 413
+    mock_classify.assert_not_called()
+
+
+def test_sniff_image_type():
+    from api import _sniff_image_type
+    assert _sniff_image_type(b"\x89PNG\r\n\x1a\n\x00\x00\x00\r") == "image/png"
+    assert _sniff_image_type(b"RIFF\x00\x00\x00\x00WEBP") == "image/webp"
+    assert _sniff_image_type(b"GIF89a") == "image/gif"
+    assert _sniff_image_type(b"RIFF\x00\x00\x00\x00WAVE") is None
+
+
+def test_docs_mappings(app_client):
+    client, _ = app_client
+    resp = client.get("/docs/mappings")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/json"
+    data = resp.get_json()
+    assert "clothing_type_map" in data
+    assert "material_map" in data
+
+
+def test_lru_cache_evicts_least_recently_used():
+    from api import _LRUCache
+    cache = _LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_expires_entries_after_ttl():
+    from api import _LRUCache
+    cache = _LRUCache(maxsize=2, ttl=10)
+    with patch("api._time.monotonic", return_value=100.0):
+        cache.set("a", 1)
+    with patch("api._time.monotonic", return_value=109.0):
+        assert cache.get("a") == 1
+    with patch("api._time.monotonic", return_value=110.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_keyword_comparisons_one_row_per_rule():
+    from api import _keyword_comparisons
+    task = {
+        "product": {"id": 1, "product_id": "131367", "product_name": "Jacket",
+                    "brand": "KappAhl", "qfix_clothing_type": "Jacket"},
+        "rule_idxs": [0, 1],
+        "categories": {
+            "repair": {
+                "merged": [{"name": "Replace zipper"}, {"name": "Repair seam"}],
+                "candidates": ["Replace zipper", "Repair seam", "Repair tear"],
+                "rules": [0, 1],
+            },
+        },
+        "full": False,
+        "prompt": "",
+    }
+    response = '```json\n{"repair": ["Repair seam", "Repair tear", "Replace zipper"]}\n```'
+    rows = _keyword_comparisons(task, response)
+    assert len(rows) == 2
+    assert rows[0]["category"] == "repair"
+    assert rows[0]["overlap_count"] == 2
+    assert rows[0]["overlap"] == ["Repair seam", "Replace zipper"]
+    assert rows[0]["only_in_ai"] == ["Repair tear"]
+    assert "ai_full_ranking" not in rows[0]
+
+
+def test_keyword_comparisons_keeps_unparseable_answers():
+    from api import _keyword_comparisons, _keyword_validation_summary
+    task = {
+        "product": {"id": 1, "product_id": "131367", "product_name": "Jacket"},
+        "rule_idxs": [0],
+        "categories": {
+            "repair": {"merged": [{"name": "Replace zipper"}], "candidates": [], "rules": [0]},
+        },
+        "full": False,
+        "prompt": "",
+    }
+    rows = _keyword_comparisons(task, "Sorry, I can't rank these.")
+    assert len(rows) == 1
+    assert rows[0]["ai_top5"] is None
+    assert rows[0]["overlap_count"] is None
+    summary = _keyword_validation_summary(rows)
+    assert summary["unparsed_comparisons"] == 1
+    assert summary["avg_overlap_out_of_5"] == 0
+
+
+def _two_category_task():
+    return {
+        "product": {"id": 1, "product_id": "131367", "product_name": "Jacket"},
+        "rule_idxs": [0, 1],
+        "categories": {
+            "repair": {"merged": [{"name": "Replace zipper"}], "candidates": [], "rules": [0]},
+            "adjustment": {"merged": [{"name": "Shorten sleeves"}], "candidates": [], "rules": [1]},
+        },
+        "full": True,
+        "prompt": "",
+    }
+
+
+@pytest.mark.parametrize("response", ['["Replace zipper", "Shorten sleeves"]', '"none"', "42"])
+def test_keyword_comparisons_reports_non_object_answers(response):
+    from api import _keyword_comparisons
+    rows = _keyword_comparisons(_two_category_task(), response)
+    assert [r["category"] for r in rows] == ["repair", "adjustment"]
+    assert all(r["ai_top5"] is None and r["overlap_count"] is None for r in rows)
+
+
+def test_keyword_comparisons_ignores_non_string_ranking_items():
+    from api import _keyword_comparisons
+    response = '{"repair": ["Replace zipper", {"name": "x"}, 3, null], "adjustment": []}'
+    rows = _keyword_comparisons(_two_category_task(), response)
+    assert rows[0]["ai_top5"] == ["Replace zipper"]
+    assert rows[0]["overlap"] == ["Replace zipper"]
+    assert rows[0]["ai_full_ranking"] == ["Replace zipper"]
+    assert rows[1]["overlap_count"] == 0
+
+
+def test_validate_keyword_scores_streams_ndjson(app_client, monkeypatch):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    task = {
+        "product": {"id": 1, "product_id": "131367", "product_name": "Jacket",
+                    "brand": "KappAhl", "qfix_clothing_type": "Jacket"},
+        "rule_idxs": [0],
+        "categories": {
+            "repair": {
+                "merged": [{"name": "Replace zipper"}, {"name": "Repair seam"}],
+                "candidates": ["Replace zipper", "Repair seam"],
+                "rules": [0],
+            },
+        },
+        "full": False,
+        "prompt": "stream test prompt",
+    }
+    ai_client = MagicMock()
+    ai_client.with_options.return_value = ai_client
+    ai_client.messages.create.return_value.content = [
+        MagicMock(text='{"repair": ["Repair seam", "Repair tear"]}')]
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    with patch("api.catalog.load"), \
+         patch("api._sample_keyword_products", return_value={}), \
+         patch("api._keyword_validation_tasks", return_value=[task]), \
+         patch("api.get_ai_client", return_value=ai_client):
+        resp = client.post("/remap/validate-keyword-scores?stream=1&nocache=1")
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+    assert resp.mimetype == "application/x-ndjson"
+    assert lines[0]["overlap"] == ["Repair seam"]
+    assert lines[-1] == {"total_comparisons": 1, "unparsed_comparisons": 0,
+                         "avg_overlap_out_of_5": 1.0}
+
+
+def test_keyword_validation_task_skips_products_without_keyword_match():
+    from api import _keyword_validation_task
+    from catalog import _CatalogSnapshot
+    product = {"id": 1, "product_id": "1", "product_name": "Plain shirt",
+               "description": "", "clothing_type": "Shirt",
+               "qfix_clothing_type_id": 1, "qfix_material_id": 2}
+    rankings = {(1, 2): {"repair": [{"name": "Repair seam"}]}}
+    snapshot = _CatalogSnapshot(services={(1, 2): [{"slug": "repair", "services": []}]})
+    with patch("api.catalog._snapshot", snapshot), \
+         patch("api._inject_keyword_actions") as inject:
+        assert _keyword_validation_task(rankings, product, [0]) is None
+    inject.assert_not_called()
+
+
+def test_keyword_pattern_matches_substrings():
+    from api import _keyword_pattern
+    pattern = _keyword_pattern(["zip", "tank top", "a.b"])
+    assert pattern.search("zipper jacket")
+    assert pattern.search("black tank top")
+    assert pattern.search("a.b")
+    assert not pattern.search("axb")
+    assert not pattern.search("wool coat")
+
+
+def test_get_db_checks_out_from_one_pool_per_dsn():
+    import api
+    from unittest.mock import MagicMock
+    pool = MagicMock()
+    pool.getconn.return_value.closed = 0
+    with patch("api._BoundedPool", return_value=pool) as pool_cls, \
+         patch.dict("api._db_pools", clear=True):
+        first = api._connect_with_retry("postgresql://test")
+        api._connect_with_retry("postgresql://test")
+    pool_cls.assert_called_once()
+    assert first.pool is pool
+    assert first.autocommit is True
+
+
+def test_connections_left_open_by_a_request_are_returned():
+    import api
+    from unittest.mock import MagicMock
+    pool = MagicMock()
+    conn = pool.getconn.return_value
+    conn.closed = 0
+    conn.pool = None
+    with patch("api._BoundedPool", return_value=pool), \
+         patch.dict("api._db_pools", clear=True):
+        with api.app.test_request_context():
+            api._connect_with_retry("postgresql://test")
+            assert api.g.db_conns == [conn]
+    conn.close.assert_called_once()
+
+
+class _FakeConn:
+    """Runs _PooledConnection.close(); a physical close would raise TypeError."""
+    pool = owner = home = None
+    closed = 0
+
+    def close(self):
+        import api
+        api._PooledConnection.close(self)
+
+
+class _FakePool:
+    """Just enough of _BoundedPool for _connect_with_retry()."""
+    closed = False
+
+    def __init__(self):
+        self._pool = [_FakeConn(), _FakeConn()]
+
+    def getconn(self):
+        return self._pool.pop()
+
+    def putconn(self, conn, close=False):
+        self._pool.append(conn)
+
+
+def test_closed_connection_checked_out_again_is_not_released_twice():
+    import threading
+    import api
+    pool = _FakePool()
+    checked_out, finish = threading.Event(), threading.Event()
+    other = []
+
+    def other_request():
+        with api.app.test_request_context():
+            other.append(api._connect_with_retry("postgresql://test"))
+            checked_out.set()
+            finish.wait(5)
+
+    with patch("api._BoundedPool", return_value=pool), \
+         patch.dict("api._db_pools", clear=True):
+        with api.app.test_request_context():
+            conn = api._connect_with_retry("postgresql://test")
+            conn.close()
+            thread = threading.Thread(target=other_request)
+            thread.start()
+            checked_out.wait(5)
+            assert other == [conn]
+            # A stale close and this request's teardown leave it to its new owner
+            conn.close()
+            api._release_db_conns(None)
+            assert conn.pool is pool and conn not in pool._pool
+        finish.set()
+        thread.join(5)
+    assert conn in pool._pool
+
+
+def test_repeated_close_leaves_idle_connection_open():
+    import api
+    pool = _FakePool()
+    with patch("api._BoundedPool", return_value=pool), \
+         patch.dict("api._db_pools", clear=True):
+        conn = api._connect_with_retry("postgresql://test")
+        conn.close()
+        conn.close()
+    assert pool._pool.count(conn) == 1
+
+
+def test_bounded_pool_waits_for_a_free_connection():
+    import api
+    from unittest.mock import MagicMock
+    from psycopg2.pool import PoolError
+    with patch("psycopg2.connect", side_effect=lambda *a, **kw: MagicMock(closed=0)):
+        pool = api._BoundedPool(0, 1, "postgresql://test")
+        conn = pool.getconn()
+        with patch("api.DB_POOL_WAIT_SECONDS", 0.01), pytest.raises(PoolError):
+            pool.getconn()
+        pool.putconn(conn)
+        assert pool.getconn() is not None
+
+
+def test_execute_prepared_prepares_once_per_connection():
+    from unittest.mock import MagicMock
+    from api import _execute_prepared
+    cur = MagicMock()
+    cur.connection.prepared = set()
+    sql = "SELECT 1 FROM products_unified WHERE brand = %s AND product_id = %s"
+    _execute_prepared(cur, "lookup", sql, ("KappAhl", "1"))
+    _execute_prepared(cur, "lookup", sql, ("KappAhl", "2"))
+    calls = [c.args for c in cur.execute.call_args_list]
+    assert calls == [
+        ("PREPARE lookup AS SELECT 1 FROM products_unified WHERE brand = $1 AND product_id = $2",),
+        ("EXECUTE lookup (%s, %s)", ("KappAhl", "1")),
+        ("EXECUTE lookup (%s, %s)", ("KappAhl", "2")),
+    ]
+
+
+def test_v2_gtin_lookup_uses_prepared_statement(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.connection.prepared = set()
+    cur.fetchone.return_value = None
+    with patch("api.get_db", return_value=conn):
+        assert client.get("/v2/product/gtin/7394712345678").status_code == 404
+    assert cur.connection.prepared == {"v2_product_by_gtin"}
+    assert cur.execute.call_args.args == ("EXECUTE v2_product_by_gtin (%s)", ("7394712345678",))
+
+
+def test_apispec_built_once(app_client):
+    import api
+    client, _ = app_client
+    with patch.object(api.swagger, "get_apispecs", wraps=api.swagger.get_apispecs) as build, \
+         patch("api._apispec_body", None):
+        first = client.get("/apispec.json")
+        second = client.get("/apispec.json")
+    assert first.status_code == 200
+    assert "/v4/product/{product_id}" in first.get_json()["paths"]
+    assert second.data == first.data
+    build.assert_called_once()
+
+
+def test_valid_api_key_bypasses_rate_limit():
+    import api
+    with patch.dict("api._api_keys", {"kappahl": "secret"}, clear=True), \
+         patch.dict("api._key_to_brand", {"secret": "kappahl"}, clear=True):
+        with api.app.test_request_context("/kappahl/product/1", headers={"X-API-Key": "secret"}):
+            assert api._has_valid_api_key()
+        with api.app.test_request_context("/kappahl/products", headers={"X-API-Key": "secret"}):
+            assert api._has_valid_api_key()
+        with api.app.test_request_context("/kappahl/product/1", headers={"X-API-Key": "guess"}):
+            assert not api._has_valid_api_key()
+        with api.app.test_request_context("/kappahl/product/1"):
+            assert not api._has_valid_api_key()
+
+
+def test_api_key_does_not_exempt_other_routes():
+    import api
+    with patch.dict("api._api_keys", {"kappahl": "secret", "lindex": "other"}, clear=True), \
+         patch.dict("api._key_to_brand", {"secret": "kappahl", "other": "lindex"}, clear=True):
+        for method, path in (("POST", "/remap/run"), ("POST", "/v2/upload"),
+                             ("GET", "/lindex/product/1")):
+            with api.app.test_request_context(path, method=method, headers={"X-API-Key": "secret"}):
+                assert api.request.endpoint, path
+                assert not api._has_valid_api_key(), path
+
+
+def test_rate_limit_key_computed_once_per_request():
+    import api
+    with api.app.test_request_context(headers={"X-API-Key": "secret"}):
+        assert api._rate_limit_key() == "key:secret"
+        with patch("api.request") as req:
+            assert api._rate_limit_key() == "key:secret"
+        req.headers.get.assert_not_called()
+    with api.app.test_request_context(environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        assert api._rate_limit_key() == "ip:10.0.0.1"
+
+
+def test_check_api_key_compares_brand_key(app_client):
+    import api
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    with patch.dict("api._api_keys", {"kappahl": "secret"}, clear=True):
+        assert client.get("/kappahl/product/131367",
+                          headers={"X-API-Key": "secret"}).status_code == 200
+        assert client.get("/kappahl/product/131367",
+                          headers={"X-API-Key": "secreT"}).status_code == 401
+
+
+def test_json_provider_matches_flask_defaults():
+    import datetime
+    import decimal
+    import api
+    with api.app.app_context():
+        body = api.jsonify({
+            "b": decimal.Decimal("1.50"),
+            "a": datetime.datetime(2024, 1, 2, 3, 4, 5),
+            1: "int key",
+        })
+    assert body.mimetype == "application/json"
+    assert json.loads(body.data) == {
+        "1": "int key",
+        "a": "Tue, 02 Jan 2024 03:04:05 GMT",
+        "b": "1.50",
+    }
+    assert body.data.index(b'"a"') < body.data.index(b'"b"')
+
+
+def test_parse_materials():
+    from api import _parse_materials
+    assert _parse_materials('[{"name": "Cotton", "percentage": 0.57}]') == [
+        {"name": "Cotton", "percentage": 0.57}]
+    assert _parse_materials("not json") is None
+    raw = '[{"name": "Wool", "percentage": 1.0}]'
+    assert _parse_materials(raw) is _parse_materials(raw)
+    assert _parse_materials(None) is None
+
+
+def test_redirect_reuses_cached_product_lookup(app_client):
+    import api
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE products_unified SET qfix_url = ?, qfix_clothing_type_id = 173, "
+                 "qfix_material_id = 69", ("https://dev.qfixr.me/sv/product/jeans/",))
+    conn.commit()
+    conn.close()
+
+    with patch("api.catalog.load"), \
+         patch("api._get_filtered_actions", return_value={}), \
+         patch("api.get_db", wraps=api.get_db) as get_db:
+        assert client.get("/kappahl/product/131367").status_code == 200
+        resp = client.get("/kappahl/repair/?productId=131367")
+    assert resp.status_code == 302
+    assert resp.headers["Location"].startswith("https://dev.qfixr.me/sv/product/jeans/")
+    assert get_db.call_count == 1
+
+
+def test_redirect_url_cached(app_client):
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE products_unified SET qfix_url = ?, qfix_clothing_type_id = 173, "
+                 "qfix_material_id = 69", ("https://dev.qfixr.me/sv/product/jeans/",))
+    conn.commit()
+    conn.close()
+
+    with patch("api.catalog.load"), \
+         patch("api._get_filtered_actions", return_value={"repair": [{"id": 916}]}) as actions:
+        first = client.get("/kappahl/repair/?productId=131367")
+        second = client.get("/kappahl/repair/?productId=131367")
+    assert first.headers["Location"] == second.headers["Location"]
+    assert "services_id=916" in second.headers["Location"]
+    actions.assert_called_once()
+
+
+def test_cache_control_by_endpoint(app_client):
+    client, db_path = app_client
+    _seed_gt_product(db_path)
+    _seed_kappahl_product(db_path)
+    assert client.get("/v4/product/225549000").headers["Cache-Control"] == \
+        "public, max-age=600, s-maxage=600"
+    assert client.get("/kappahl/product/131367").headers["Cache-Control"] == \
+        "private, max-age=600"
+    assert "Cache-Control" not in client.get("/v4/product/000000000").headers
+
+
+def test_product_lookup_revalidates_with_etag(app_client):
+    client, db_path = app_client
+    _seed_gt_product(db_path)
+    first = client.get("/v4/product/225549000")
+    etag = first.headers["ETag"]
+    second = client.get("/v4/product/225549000", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.data == b""
+    assert "ETag" not in client.get("/v4/products").headers
+
+
+def test_remap_run_maps_identical_inputs_once(app_client):
+    from unittest.mock import MagicMock
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    _seed_product(db_path,
+        product_id='131368', brand='KappAhl', product_name='Bootcut jeans',
+        category='dam', clothing_type='Jeans > Bootcut',
+        material_composition='75% Bomull', product_url='https://kappahl.com/131368',
+        description='Snygga jeans', color='Blå')
+
+    with patch("api.catalog.load"), \
+         patch("api.get_write_db", return_value=MagicMock()), \
+         patch("api.bulk_update_qfix_mappings", side_effect=lambda conn, rows: len(rows)) as write, \
+         patch("api.map_product", return_value={"qfix_url": None}) as mapper, \
+         patch("api.refresh_remap_coverage") as refresh:
+        resp = client.post("/remap/run?brand=kappahl")
+
+    assert resp.get_json() == {"total": 2, "mapped": 0, "unmapped": 2, "updated": 2}
+    mapper.assert_called_once()
+    refresh.assert_called_once()
+    assert [r[1] for r in write.call_args.args[1]] == ["131367", "131368"]
+
+
+def test_unmapped_counts_come_from_sql(app_client):
+    from unittest.mock import MagicMock
+    client, db_path = app_client
+    type_rows = [
+        {"brand": "KappAhl", "clothing_type": "Jeans > Bootcut", "products": 5},
+        {"brand": "KappAhl", "clothing_type": "Zzz > Qqq", "products": 2},
+    ]
+    material_rows = [
+        {"brand": "KappAhl", "material_composition": "100% Unobtainium"},
+        {"brand": "KappAhl", "material_composition": "75% Bomull"},
+    ]
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value.fetchall.side_effect = [type_rows, material_rows]
+    with patch("api.get_db", return_value=conn):
+        data = client.get("/unmapped").get_json()
+
+    assert data["kappahl"] == {
+        "unmapped_clothing_types": [{"clothing_type": "Zzz > Qqq", "distinct_products": 2}],
+        "unmapped_materials": ["100% Unobtainium"],
+    }
+
+
+def test_add_mapping_rejects_unknown_material(app_client):
+    client, db_path = app_client
+    resp = client.post("/unmapped/add", json={"type": "material", "from": "Tweed", "to": "Tweed"})
+    assert resp.status_code == 400
+    assert resp.get_json()["valid_materials"][0] == "Cashmere"
+
+
+def test_remap_suggestions_parses_fenced_answer(app_client):
+    from unittest.mock import MagicMock
+    client, db_path = app_client
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value.fetchall.return_value = [
+        {"brand": "KappAhl", "clothing_type": "Zzz > Qqq", "material_composition": "75% Bomull",
+         "category": "dam"},
+    ]
+    ai_client = MagicMock()
+    ai_client.messages.create.return_value.content = [MagicMock(
+        text='```json\n{"suggestions": [{"from": "zzz > qqq", "to": "Jacket"}]}\n```')]
+    with patch("api.get_db", return_value=conn), \
+         patch("api.get_ai_client", return_value=ai_client), \
+         patch.dict(os.environ, {"ANTHROPIC_API_KEY": "test"}):
+        resp = client.get("/remap")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["suggestions"] == [
+        {"from": "zzz > qqq", "to": "Jacket", "products_affected": 1, "brands": ["kappahl"]},
+    ]
+
+
+def test_widget_serves_precompressed_variant(app_client, tmp_path, monkeypatch):
+    import gzip
+    import api
+    client, _ = app_client
+    (tmp_path / "widget.v1.js").write_text("console.log(1);")
+    (tmp_path / "widget.v1.js.gz").write_bytes(gzip.compress(b"console.log(1);"))
+    monkeypatch.setattr(api, "WIDGET_DIR", str(tmp_path))
+
+    resp = client.get("/widget/v1.js", headers={"Accept-Encoding": "gzip, br"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert gzip.decompress(resp.data) == b"console.log(1);"
+
+    plain = client.get("/widget/v1.js")
+    assert "Content-Encoding" not in plain.headers
+    assert plain.data == b"console.log(1);"
+
+
+def test_docs_verify_memoizes_mapping_steps(app_client):
+    import api
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    with patch.object(api, "map_clothing_type", wraps=api.map_clothing_type) as mapper:
+        first = client.get("/docs/verify/131367")
+        second = client.get("/docs/verify/131367")
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+    mapper.assert_called_once()
+
+
+def test_v2_upload_writes_chunks_in_one_transaction(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    products = [{"brand": "KappAhl", "product_id": str(i)} for i in range(5)]
+    with patch("api.parse_protocol_xlsx", return_value=iter(products)), \
+         patch("api.UPLOAD_CHUNK_SIZE", 2), \
+         patch("api.get_write_db", return_value=conn), \
+         patch("api.bulk_upsert_products") as upsert, \
+         patch("api._refresh_coverage_after_write") as refresh:
+        resp = client.post("/v2/upload", data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                           content_type="multipart/form-data")
+    assert resp.get_json() == {"status": "ok", "products_imported": 5}
+    assert [c.args for c in upsert.call_args_list] == [
+        (conn, products[0:2]), (conn, products[2:4]), (conn, products[4:5])]
+    assert conn.autocommit is False
+    conn.commit.assert_called_once()
+    refresh.assert_called_once_with(conn)
+    conn.rollback.assert_not_called()
+    conn.close.assert_called_once()
+
+
+def test_v2_upload_replace_mode_removes_unlisted_products(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    products = [{"brand": "KappAhl", "product_id": "1"}, {"brand": "Lindex", "product_id": "2"}]
+    with patch("api.parse_protocol_xlsx", return_value=iter(products)), \
+         patch("api.get_write_db", return_value=conn), \
+         patch("api.bulk_upsert_products"), \
+         patch("api._refresh_coverage_after_write"), \
+         patch("api.delete_unlisted_protocol_products", return_value=3) as delete:
+        resp = client.post("/v2/upload?mode=replace",
+                           data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                           content_type="multipart/form-data")
+    assert resp.get_json() == {"status": "ok", "products_imported": 2, "products_removed": 3}
+    delete.assert_called_once_with(conn, {"KappAhl", "Lindex"})
+    conn.commit.assert_called_once()
+
+
+def test_v2_upload_parse_error_rolls_back_and_closes_parser(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    closed = []
+
+    def parse(stream):
+        try:
+            yield {"brand": "KappAhl", "product_id": "1"}
+            raise ValueError("bad row")
+        finally:
+            closed.append(True)
+
+    with patch("api.parse_protocol_xlsx", side_effect=parse), \
+         patch("api.UPLOAD_CHUNK_SIZE", 1), \
+         patch("api.get_write_db", return_value=conn), \
+         patch("api.bulk_upsert_products"), \
+         patch("api.refresh_remap_coverage"):
+        resp = client.post("/v2/upload", data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                           content_type="multipart/form-data")
+    assert resp.status_code == 400
+    assert "bad row" in resp.get_json()["error"]
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+    assert closed == [True]
+
+
+def test_v2_upload_creates_schema_once_per_process(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    with patch("api.parse_protocol_xlsx", side_effect=lambda stream: iter(())), \
+         patch("api.get_write_db", return_value=MagicMock()), \
+         patch("api.bulk_upsert_products"), \
+         patch("api.refresh_remap_coverage"), \
+         patch("api._schema_ready", False), \
+         patch("api.create_table") as create:
+        for _ in range(2):
+            client.post("/v2/upload", data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                        content_type="multipart/form-data")
+    create.assert_called_once()
+
+
+def test_remap_products_brand_filter_ignores_case(app_client):
+    from api import _brand_condition
+    client, db_path = app_client
+    _seed_kappahl_product(db_path)
+    # Protocol uploads keep the xlsx spelling of the brand
+    _seed_product(db_path, product_id='999', brand='KAPPAHL', product_name='Jeans',
+                  category='dam', clothing_type='Jeans > Bootcut', material_composition=None,
+                  product_url=None, description=None, color=None)
+    assert _brand_condition("KAPPAHL") == ("LOWER(brand) = LOWER(%s)", "KappAhl")
+    assert _brand_condition("ginatricot") == ("LOWER(brand) = LOWER(%s)", "Gina Tricot")
+    assert _brand_condition("Acme") == ("LOWER(brand) = LOWER(%s)", "Acme")
+    rows = client.get("/remap/products?brand=kappahl").get_json()
+    assert sorted(r["product_id"] for r in rows) == ["131367", "999"]
+
+
+def test_remap_status_counts_live_without_coverage_view(app_client):
+    from unittest.mock import MagicMock
+    from psycopg2.errors import UndefinedTable
+    client, _ = app_client
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.execute.side_effect = [UndefinedTable("remap_coverage"), None]
+    cur.fetchall.return_value = [{"brand": "KappAhl", "total": 2, "mapped": 1, "unmapped": 1}]
+    with patch("api.get_db", return_value=conn):
+        resp = client.get("/remap/status")
+    assert resp.get_json() == [{"brand": "KappAhl", "total": 2, "mapped": 1, "unmapped": 1}]
+    assert "FROM products_unified" in cur.execute.call_args.args[0]
+    conn.close.assert_called_once()
+
+
+def test_v2_upload_survives_coverage_refresh_failure(app_client):
+    import psycopg2
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    conn = MagicMock()
+    with patch("api.parse_protocol_xlsx", return_value=iter([{"brand": "KappAhl"}])), \
+         patch("api.get_write_db", return_value=conn), \
+         patch("api.bulk_upsert_products"), \
+         patch("api.refresh_remap_coverage", side_effect=psycopg2.Error("must be owner")):
+        resp = client.post("/v2/upload", data={"file": (io.BytesIO(b"x"), "protocol.xlsx")},
+                           content_type="multipart/form-data")
+    assert resp.get_json() == {"status": "ok", "products_imported": 1}
+    conn.commit.assert_called_once()
+    conn.rollback.assert_called_once()
+
+
+def test_v2_upload_is_spooled_in_memory(app_client):
+    from unittest.mock import MagicMock
+    client, _ = app_client
+    seen = {}
+
+    def parse(stream):
+        seen["rolled_to_disk"] = stream._file.__class__ is not io.BytesIO
+        return iter(())
+
+    big = b"x" * (600 * 1024)
+    with patch("api.parse_protocol_xlsx", side_effect=parse), \
+         patch("api.get_write_db", return_value=MagicMock()), \
+         patch("api.bulk_upsert_products"), \
+         patch("api._refresh_coverage_after_write"):
+        client.post("/v2/upload", data={"file": (io.BytesIO(big), "protocol.xlsx")},
+                    content_type="multipart/form-data")
+    assert seen == {"rolled_to_disk": False}
@@ -1,6 +1,9 @@
 """Tests for QFixCatalog — service filtering and variant swapping."""
+import threading
+from unittest.mock import MagicMock, patch
+
 import pytest
-from catalog import QFixCatalog
+from catalog import QFixCatalog, service_key_for_slug
 
 
 @pytest.fixture
@@ -46,6 +49,7 @@ def cat():
         1323: {93, 85},
         1349: {93},
     }
+    c.reindex()
     return c
 
 
@@ -145,3 +149,125 @@ class TestEnrichQfix:
         qfix = {"qfix_clothing_type_id": None, "qfix_material_id": None}
         result = cat.enrich_qfix(qfix)
         assert "qfix_item" not in result
+
+    def test_prebuilt_pair_skips_lookup(self, cat):
+        with patch.object(cat._snapshot, "catalog_fields", wraps=cat._snapshot.catalog_fields) as lookup:
+            mapped = cat.enrich_qfix({"qfix_clothing_type_id": 93, "qfix_material_id": 69})
+            unmapped = cat.enrich_qfix({"qfix_clothing_type_id": None, "qfix_material_id": None})
+        # (93, 69) is prebuilt by reindex(); only the unmapped pair is looked up
+        assert lookup.call_count == 1
+        assert mapped["qfix_subitem"]["name"] == "Standard textile"
+        assert "qfix_services" not in unmapped
+
+
+class TestReindex:
+    def test_empty_combos(self, cat):
+        assert cat.empty_combos == []
+        cat.services[(93, 70)] = [
+            {"id": 37, "name": "Repair", "slug": "service-category-clothing-repair", "services": []},
+        ]
+        cat.reindex()
+        assert cat.empty_combos == [(93, 70)]
+
+    def test_default_actions_first_unique_names(self, cat):
+        defaults = cat.default_actions[(93, 69)]
+        assert [a["id"] for a in defaults["repair"]] == [1395, 920]
+        assert [a["id"] for a in defaults["care"]] == [1323, 1349]
+        assert "adjustment" not in defaults
+
+    def test_actions_by_name_groups_variants(self, cat):
+        by_name = cat.actions_by_name[(93, 69)]
+        assert [a["id"] for a in by_name["Replace main zipper"]] == [1395, 1401]
+        assert by_name["Waterwash"] == [
+            {"id": 1349, "name": "Waterwash", "price": 99, "category_key": "care"},
+        ]
+
+
+class TestServiceKeyForSlug:
+    def test_known_slugs(self):
+        assert service_key_for_slug("service-category-clothing-repair") == "repair"
+        assert service_key_for_slug("service-category-clothing-washing") == "care"
+        assert service_key_for_slug("customize-it") == "other"
+        assert service_key_for_slug("unknown") is None
+
+
+class TestLoad:
+    TREE = [{"children": [{"id": 10, "name": "Men's Clothing", "children": [
+        {"id": 93, "name": "Jacket", "children": [
+            {"id": 69, "name": "Standard textile", "children": [
+                {"id": 37, "name": "Repair", "slug": "service-category-clothing-repair", "products": [
+                    {"id": 1395, "name": "Replace main zipper", "price": 199,
+                     "assigned_categories": "93,85"},
+                ]},
+            ]},
+        ]},
+    ]}]}]
+
+    def test_concurrent_loads_fetch_once(self):
+        resp = MagicMock()
+        resp.json.return_value = self.TREE
+        c = QFixCatalog()
+        with patch("catalog.http_requests.get", return_value=resp) as mock_get:
+            threads = [threading.Thread(target=c.load) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert mock_get.call_count == 1
+        assert c.loaded
+        assert c.items[93]["parent"]["name"] == "Men's Clothing"
+        assert c.assigned_categories[1395] == {93, 85}
+        assert c.default_actions[(93, 69)]["repair"][0]["id"] == 1395
+
+    def test_failed_refresh_keeps_previous_catalog(self):
+        resp = MagicMock()
+        resp.json.return_value = self.TREE
+        c = QFixCatalog()
+        with patch("catalog.http_requests.get", return_value=resp):
+            c.load()
+        with patch("catalog.http_requests.get", side_effect=OSError("down")):
+            c._fetch()
+        assert c.loaded
+        assert 93 in c.items
+
+    def test_refresher_started_once_per_process(self):
+        c = QFixCatalog()
+        with patch("catalog.threading.Thread") as thread, \
+             patch("catalog.os.getpid", return_value=100):
+            c.start_refresher(interval=60)
+            c.start_refresher(interval=60)
+        assert thread.call_count == 1
+        with patch("catalog.threading.Thread") as thread, \
+             patch("catalog.os.getpid", return_value=101):
+            c.start_refresher(interval=60)
+        assert thread.call_count == 1
+
+    def test_refresh_publishes_one_snapshot(self):
+        resp = MagicMock()
+        resp.json.return_value = self.TREE
+        c = QFixCatalog()
+        with patch("catalog.http_requests.get", return_value=resp):
+            c.load()
+            before = c._snapshot
+            c._fetch()
+        assert c._snapshot is not before
+        # Readers holding the old snapshot keep a consistent view
+        assert before.pair_fields[(93, 69)]["qfix_services"] is before.services[(93, 69)]
+        assert c.pair_fields[(93, 69)]["qfix_services"] is c.services[(93, 69)]
+
+    def test_refresh_downloads_outside_the_load_lock(self):
+        resp = MagicMock()
+        resp.json.return_value = self.TREE
+        c = QFixCatalog()
+        lock_held = []
+
+        def get(*args, **kwargs):
+            lock_held.append(c._load_lock.locked())
+            return resp
+
+        with patch("catalog.http_requests.get", side_effect=get), \
+             patch("catalog.time.sleep", side_effect=[None, StopIteration]), \
+             pytest.raises(StopIteration):
+            c._refresh_loop(60)
+        # The first load waits under the lock; the periodic refresh doesn't
+        assert lock_held == [True, False]
@@ -70,6 +70,19 @@ def test_create_table_idempotent(db_conn):
     _create_tables_sqlite(db_conn)
 
 
+def test_create_indexes_builds_concurrently():
+    from unittest.mock import MagicMock
+    from database import create_indexes
+    conn = MagicMock()
+    create_indexes(conn)
+    cur = conn.cursor.return_value.__enter__.return_value
+    statements = [" ".join(c.args[0].split()) for c in cur.execute.call_args_list]
+    assert statements[0] == "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+    indexes = [s for s in statements if "INDEX" in s]
+    assert indexes
+    assert all("INDEX CONCURRENTLY IF NOT EXISTS" in s for s in indexes)
+
+
 # ── Upsert products (various brands) ─────────────────────────────────────
 
 def test_upsert_product_insert(db_conn):
@@ -264,3 +277,96 @@ def test_unique_constraint_same_brand_product_id(db_conn):
     ).fetchall()
     assert len(rows) == 1
     assert rows[0]["product_name"] == "Second"
+
+
+# ── Bulk upsert ───────────────────────────────────────────────────────────
+
+def test_bulk_upsert_products_last_duplicate_wins():
+    """One row per (brand, product_id), keeping the last occurrence, in one call."""
+    from unittest.mock import MagicMock, patch
+    from database import PRODUCT_COLUMNS, bulk_upsert_products
+
+    products = [
+        _make_product(product_id="1", product_name="First"),
+        _make_product(product_id="2"),
+        _make_product(product_id="1", product_name="Second"),
+    ]
+    with patch("database.execute_values") as execute_values:
+        count = bulk_upsert_products(MagicMock(), products)
+
+    assert count == 2
+    execute_values.assert_called_once()
+    rows = [dict(zip(PRODUCT_COLUMNS, r)) for r in execute_values.call_args.args[2]]
+    assert [(r["product_id"], r["product_name"]) for r in rows] == [
+        ("1", "Second"), ("2", "Bootcut jeans")]
+    assert rows[0]["gtin"] is None
+    assert execute_values.call_args.kwargs["template"].count("%s") == len(PRODUCT_COLUMNS)
+
+
+def test_bulk_upsert_products_keeps_every_row_without_product_id():
+    """Protocol rows have no product_id and must not collapse into one."""
+    from unittest.mock import MagicMock, patch
+    from database import bulk_upsert_products
+
+    products = [{"brand": "KappAhl", "gtin": "1"}, {"brand": "KappAhl", "gtin": "2"}]
+    with patch("database.execute_values") as execute_values:
+        count = bulk_upsert_products(MagicMock(), products)
+
+    assert count == 2
+    assert len(execute_values.call_args.args[2]) == 2
+
+
+def test_bulk_update_qfix_mappings_rows_in_column_order():
+    from unittest.mock import MagicMock, patch
+    from database import bulk_update_qfix_mappings
+
+    mappings = [
+        ("KappAhl", "1", {"qfix_clothing_type": "Jeans", "qfix_clothing_type_id": 173,
+                          "qfix_url": "https://example.com/jeans"}),
+        ("KappAhl", "2", {}),
+    ]
+    with patch("database.execute_values") as execute_values:
+        count = bulk_update_qfix_mappings(MagicMock(), mappings)
+
+    assert count == 2
+    execute_values.assert_called_once()
+    rows = execute_values.call_args.args[2]
+    assert rows[0] == ("KappAhl", "1", "Jeans", 173, None, None,
+                       "https://example.com/jeans", None, None, None, None)
+    assert rows[1] == ("KappAhl", "2") + (None,) * 9
+
+
+def test_defer_commit_flush_is_transaction_local():
+    from unittest.mock import MagicMock
+    from database import defer_commit_flush
+    conn = MagicMock()
+    defer_commit_flush(conn)
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.execute.assert_called_once_with("SET LOCAL synchronous_commit = off;")
+
+
+def test_delete_unlisted_protocol_products_keeps_scraped_rows():
+    from unittest.mock import MagicMock
+    from database import delete_unlisted_protocol_products
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 4
+    assert delete_unlisted_protocol_products(conn, {"Lindex", "KappAhl"}) == 4
+    sql, params = cur.execute.call_args.args
+    assert "product_url IS NULL" in sql and "updated_at < CURRENT_TIMESTAMP" in sql
+    assert params == (["KappAhl", "Lindex"],)
+    assert delete_unlisted_protocol_products(conn, set()) == 0
+
+
+def test_bulk_update_article_qfix_mappings_matches_on_article():
+    from unittest.mock import MagicMock, patch
+    from database import bulk_update_article_qfix_mappings
+
+    with patch("database.execute_values") as execute_values:
+        count = bulk_update_article_qfix_mappings(
+            MagicMock(), [("Gina Tricot", "26414", {"qfix_clothing_type_id": 1, "qfix_url": "u"})])
+
+    assert count == 1
+    sql, rows = execute_values.call_args.args[1:3]
+    assert "p.brand = v.brand AND p.article_number = v.article_number" in sql
+    assert rows == [("Gina Tricot", "26414", None, 1, None, None, "u")]
@@ -0,0 +1,42 @@
+"""Tests for the T4V protocol xlsx parser."""
+import io
+
+from openpyxl import Workbook
+
+from protocol_parser import PID_COL, parse_protocol_xlsx
+
+
+def _protocol_xlsx():
+    wb = Workbook()
+    product = wb.active
+    product.title = "Product"
+    product.append([PID_COL, "Article Number", "Product Name", "Size", "Color (Brand)"])
+    product.append(["7300000000001", "A100", "Bootcut jeans", "M", "Blue (4410)"])
+    product.append([None, None, None, None, None])
+    product.append(["7300000000002", "A100", "Bootcut jeans", "L", "Blue (4410)"])
+    material = wb.create_sheet("Material")
+    material.append([PID_COL, "material Content Name", "Content Value (material Composition)",
+                     "Component"])
+    material.append(["A1004410", "Cotton", 0.98, "Shell"])
+    material.append(["A1004410", "Elastane", 2, "Shell"])
+    brand = wb.create_sheet("Brand")
+    brand.append([PID_COL, "Brand"])
+    brand.append(["A1004410", "KappAhl"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def test_parse_protocol_joins_sheets_onto_products():
+    products = list(parse_protocol_xlsx(_protocol_xlsx()))
+
+    assert [p["gtin"] for p in products] == ["7300000000001", "7300000000002"]
+    first = products[0]
+    assert first["color"] == "Blue"
+    assert first["brand"] == "KappAhl"
+    assert first["care_text"] == ""
+    assert first["materials"] == (
+        '[{"name": "Cotton", "percentage": 0.98, "component": "Shell"}, '
+        '{"name": "Elastane", "percentage": 0.02, "component": "Shell"}]'
+    )
@@ -54,3 +54,29 @@ def test_classify_and_map_unknown(mock_identify):
 
     assert result["qfix"]["qfix_clothing_type"] == "Other"
     assert result["qfix"]["qfix_clothing_type_id"] == 105
+
+
+@patch("ai_client._client", None)
+@patch("ai_client.anthropic.Anthropic")
+def test_identify_product_strips_code_fence(mock_anthropic):
+    from vision import identify_product
+    mock_anthropic.return_value.messages.create.return_value.content = [MagicMock(
+        text='```json\n{"clothing_type": "Jacket", "material": "Leather"}\n```')]
+
+    result = identify_product(b"fake image", "image/jpeg")
+
+    assert result["clothing_type"] == "Jacket"
+    assert result["material"] == "Leather"
+
+
+@patch("ai_client._client", None)
+@patch("ai_client.anthropic.Anthropic")
+def test_identify_product_reuses_client(mock_anthropic):
+    from vision import identify_product
+    mock_anthropic.return_value.messages.create.return_value.content = [MagicMock(
+        text='{"clothing_type": "Jacket"}')]
+
+    identify_product(b"fake image", "image/jpeg")
+    identify_product(b"fake image", "image/jpeg")
+
+    mock_anthropic.assert_called_once()
@@ -3,14 +3,13 @@ import base64
 import io
 import json
 import logging
-import os
 
-import anthropic
 from PIL import Image
 
+from ai_client import get_ai_client, strip_code_fence
+
 logger = logging.getLogger(__name__)
 
-ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 
 VISION_PROMPT = """Look at this image of a garment or clothing item. Identify the following properties:
 
@@ -40,13 +39,14 @@ def identify_product(image_bytes, media_type="image/jpeg"):
     """Send an image to Claude Vision API and get product classification.
 
     Args:
-        image_bytes: Raw image bytes
+        image_bytes: Raw image bytes, or any bytes-like buffer such as a
+            memoryview of a mapped upload
         media_type: MIME type (image/jpeg, image/png, image/webp, image/gif)
 
     Returns:
         dict with clothing_type, material, color, category
     """
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    client = get_ai_client()
 
     # Resize if image exceeds 5 MB API limit
     MAX_BYTES = 5 * 1024 * 1024
@@ -85,12 +85,8 @@ def identify_product(image_bytes, media_type="image/jpeg"):
         ],
     )
 
-    response_text = message.content[0].text.strip()
-
     # Parse JSON from response (handle markdown code blocks)
-    if response_text.startswith("```"):
-        lines = response_text.split("\n")
-        response_text = "\n".join(lines[1:-1])
+    response_text = strip_code_fence(message.content[0].text.strip())
 
     try:
         classification = json.loads(response_text)
@@ -0,0 +1,17 @@
+"""WSGI entry point for gunicorn gevent workers.
+
+Patches the standard library and psycopg2 for gevent before the app is
+imported, so DB queries, Anthropic calls and catalog fetches yield to other
+requests while waiting on the network.
+
+Usage: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+from api import app  # noqa: E402,F401